@@ -103,7 +103,7 @@ elif [ "$1" == "--worker" ]; then
 
     newrelic-admin run-program \
                    /app/venv/bin/celery multi start ${CELERY_WORKER} -A sync.worker \
-                   --concurrency=1 \
+                   --concurrency=${CELERY_CONCURRENCY:-4} \
                    --pidfile=${CELERY_PID_FILE} \
                    --logfile=${CELERY_LOG_FILE} --loglevel=DEBUG
 
@@ -8,8 +8,8 @@ import pygit2
 import log
 import commit as sync_commit
 from env import Environment
-from lock import MutGuard, RepoLock, mut, constructor
-from repos import pygit2_get
+from lock import MutGuard, RepoLock, SyncLock, mut, constructor
+from repos import cache_path, pygit2_get, read_cache, write_cache
 
 env = Environment()
 
@@ -69,13 +69,118 @@ class IdentityMap(type):
         return value
 
 
-def iter_tree(pygit2_repo, root_path=""):
-    """Iterator over all paths ins a tree"""
-    ref = pygit2_repo.references[env.config["sync"]["ref"]]
-    root_obj = pygit2_repo[ref.peel().tree.id]
+class DataSnapshot(object):
+    """Read-only view of the sync data at a single commit.
 
-    tree_entry = root_obj[root_path]
-    root_tree = pygit2_repo[tree_entry.id]
+    Trees are cached by path, so repeated reads from the same directory
+    don't walk down from the root tree each time.
+
+    A snapshot may be opened for a repository by using it as a context
+    manager; until the outermost context exits, all reads of the sync data
+    in this process go through that snapshot, giving consistent reads across
+    e.g. a whole handler invocation. Commits made to the sync data through
+    CommitBuilder move the open snapshot to the new commit, so a process always
+    sees its own writes.
+
+    with DataSnapshot(pygit2_repo):
+        # All reads here see the same commit
+        ...
+    """
+
+    # Map of repository path to the open snapshot for that repository
+    _open = {}
+
+    def __init__(self, pygit2_repo, commit=None):
+        self.pygit2_repo = pygit2_repo
+        self.ref_name = env.config["sync"]["ref"]
+        if commit is None:
+            commit = pygit2_repo.references[self.ref_name].peel()
+        self.set_commit(commit)
+        self._count = 0
+
+    @classmethod
+    def get(cls, pygit2_repo):
+        """Get the open snapshot for a repository or, if there isn't one,
+        a new snapshot of the current sync data commit."""
+        snapshot = cls._open.get(pygit2_repo.path)
+        if snapshot is None:
+            snapshot = cls(pygit2_repo)
+        return snapshot
+
+    @classmethod
+    def update_open(cls, pygit2_repo, ref_name, commit_id):
+        """Move the open snapshot for a repository, if any, to a new commit on ref_name"""
+        snapshot = cls._open.get(pygit2_repo.path)
+        if snapshot is not None and snapshot.ref_name == ref_name:
+            snapshot.set_commit(pygit2_repo[commit_id])
+
+    def __enter__(self):
+        snapshot = self._open.get(self.pygit2_repo.path)
+        if snapshot is None:
+            snapshot = self
+            self._open[self.pygit2_repo.path] = self
+        snapshot._count += 1
+        return snapshot
+
+    def __exit__(self, *args, **kwargs):
+        snapshot = self._open[self.pygit2_repo.path]
+        snapshot._count -= 1
+        if snapshot._count == 0:
+            del self._open[self.pygit2_repo.path]
+
+    @classmethod
+    def refresh_open(cls):
+        """Move all open snapshots to the current commit of the sync data"""
+        for snapshot in cls._open.itervalues():
+            commit = snapshot.pygit2_repo.references[snapshot.ref_name].peel()
+            if commit.id != snapshot.commit.id:
+                snapshot.set_commit(commit)
+
+    def set_commit(self, commit):
+        self.commit = commit
+        self._trees = {"": commit.tree}
+
+    def tree(self, path=""):
+        """Get the Tree at path, or None if there is no tree at that path"""
+        path = path.strip("/")
+        if path not in self._trees:
+            entry = self.entry(path)
+            if entry is not None and entry.type == "tree":
+                self._trees[path] = self.pygit2_repo[entry.id]
+            else:
+                self._trees[path] = None
+        return self._trees[path]
+
+    def entry(self, path):
+        """Get the TreeEntry for path, or None if the path doesn't exist"""
+        parent_path, _, name = path.strip("/").rpartition("/")
+        parent = self.tree(parent_path)
+        if parent is None or name not in parent:
+            return None
+        return parent[name]
+
+    def read(self, path):
+        """Get the data of the blob at path, or None if there is no blob at that path"""
+        entry = self.entry(path)
+        if entry is None or entry.type != "blob":
+            return None
+        return self.pygit2_repo[entry.id].data
+
+
+def iter_tree(pygit2_repo, root_path="", rev=None):
+    """Iterator over all paths in a tree
+
+    :param pygit2_repo: pygit2 repo
+    :param root_path: Path to the tree to iterate over
+    :param rev: Commit to read from. Defaults to the sync data."""
+    if rev is not None:
+        root_tree = rev.tree
+        if root_path:
+            root_tree = pygit2_repo[root_tree[root_path].id]
+    else:
+        root_tree = DataSnapshot.get(pygit2_repo).tree(root_path)
+        if root_tree is None:
+            raise KeyError(root_path)
 
     stack = []
     stack.append((root_path, root_tree))
@@ -94,16 +199,12 @@ def iter_tree(pygit2_repo, root_path=""):
 
 def iter_process_names(pygit2_repo, kind=["sync", "try"]):
     """Iterator over all ProcessName objects"""
-    ref = pygit2_repo.references[env.config["sync"]["ref"]]
-    root = pygit2_repo[ref.peel().tree.id]
+    snapshot = DataSnapshot.get(pygit2_repo)
     stack = []
     for root_path in kind:
-        try:
-            tree_entry = root[root_path]
-        except KeyError:
+        tree = snapshot.tree(root_path)
+        if tree is None:
             continue
-        tree = pygit2_repo[tree_entry.id]
-
         stack.append((root_path, tree))
 
     while stack:
@@ -119,8 +220,18 @@ def iter_process_names(pygit2_repo, kind=["sync", "try"]):
 
 
 class ProcessNameIndex(object):
+    """Index of all the ProcessNames in the sync data.
+
+    The index is built lazily on first use. The built index is stored
+    in a local cache file along with the id of the sync data commit it
+    corresponds to, so that later processes only need to apply the changes
+    between that commit and the current one rather than walking every
+    process in the data."""
     __metaclass__ = IdentityMap
 
+    kind = ("sync", "try")
+    cache_name = "process-names.json"
+
     def __init__(self, repo):
         self.repo = repo
         self.pygit2_repo = pygit2_get(repo)
@@ -138,10 +249,68 @@ class ProcessNameIndex(object):
         self._built = False
 
     def build(self):
-        for process_name in iter_process_names(self.pygit2_repo):
-            self.insert(process_name)
+        commit = DataSnapshot.get(self.pygit2_repo).commit
+        path = cache_path(self.repo, self.cache_name)
+
+        cached = read_cache(path)
+        base_commit = None
+        if cached is not None:
+            try:
+                base_commit = self.pygit2_repo[cached["commit"]]
+            except (KeyError, ValueError):
+                base_commit = None
+
+        if base_commit is None:
+            for process_name in iter_process_names(self.pygit2_repo, kind=self.kind):
+                self.insert(process_name)
+        else:
+            for name in cached["names"]:
+                self.insert(ProcessName.from_path(str(name)))
+            if base_commit.id != commit.id:
+                self._apply_diff(base_commit.tree, commit.tree)
         self._built = True
 
+        if ((base_commit is None or base_commit.id != commit.id) and
+            CommitBuilder.get_transaction(self.repo, env.config["sync"]["ref"]) is None):
+            # Outside a transaction, names inserted by this process before the
+            # index was built are already in the data for the current commit
+            write_cache(path, {"commit": str(commit.id),
+                               "names": sorted(str(item) for item in self._all)})
+
+    def _apply_diff(self, old_tree, new_tree):
+        for root_path in self.kind:
+            old_id = old_tree[root_path].id if root_path in old_tree else None
+            new_id = new_tree[root_path].id if root_path in new_tree else None
+            if old_id == new_id:
+                continue
+            if old_id is None:
+                old_subtree = self.pygit2_repo[self.pygit2_repo.TreeBuilder().write()]
+            else:
+                old_subtree = self.pygit2_repo[old_id]
+            if new_id is None:
+                new_subtree = self.pygit2_repo[self.pygit2_repo.TreeBuilder().write()]
+            else:
+                new_subtree = self.pygit2_repo[new_id]
+            for delta in old_subtree.diff_to_tree(new_subtree).deltas:
+                if delta.status == pygit2.GIT_DELTA_DELETED:
+                    process_name = ProcessName.from_path("%s/%s" % (root_path,
+                                                                    delta.old_file.path))
+                    if process_name is not None:
+                        self.remove(process_name)
+                else:
+                    process_name = ProcessName.from_path("%s/%s" % (root_path,
+                                                                    delta.new_file.path))
+                    if process_name is not None:
+                        self.insert(process_name)
+
+    @classmethod
+    def reset_all(cls):
+        """Reset all the live ProcessNameIndex instances, so they are rebuilt from
+        the current sync data on next use"""
+        for (item_cls, _), value in IdentityMap._cache.items():
+            if item_cls is cls:
+                value.reset()
+
     def insert(self, process_name):
         self._all.add(process_name)
 
@@ -150,6 +319,13 @@ class ProcessNameIndex(object):
                 process_name.subtype][
                     process_name.obj_id].add(process_name)
 
+    def remove(self, process_name):
+        self._all.discard(process_name)
+        self._data[
+            process_name.obj_type][
+                process_name.subtype][
+                    process_name.obj_id].discard(process_name)
+
     def has(self, process_name):
         if not self._built:
             self.build()
@@ -354,8 +530,11 @@ class BranchRefObject(VcsRefObject):
 
 
 class CommitBuilder(object):
+    # Map of (repository path, ref) to the CommitBuilder for an open transaction on that ref
+    _transactions = {}
+
     def __init__(self, repo, message, ref=None, commit_cls=sync_commit.Commit,
-                 initial_empty=False):
+                 initial_empty=False, transaction=False):
         """Object to be used as a context manager for commiting changes to the repo.
 
         This class provides low-level access to the git repository in order to
@@ -379,8 +558,16 @@ class CommitBuilder(object):
         may be called either with an existing commit_builder instance or create a new
         instance, and in either case use a with block.
 
+        A CommitBuilder created with transaction=True collects changes from every
+        other CommitBuilder for the same ref that is entered while it is active,
+        and creates a single commit containing all those changes when it exits.
+        CommitBuilders that join a transaction don't create a commit themselves,
+        so their get() method returns None.
+
         In order to improve the performance of the low-level access here, we use libgit2
-        to access the repository.
+        to access the repository. Changes are staged as a map of path to blob, and on
+        exit only the trees containing changed paths are rebuilt; all other subtrees
+        are reused from the parent commit.
         """
         # Class state
         self.repo = repo
@@ -388,6 +575,7 @@ class CommitBuilder(object):
         self.message = message if message is not None else ""
         self.commit_cls = commit_cls
         self.initial_empty = initial_empty
+        self.is_transaction = transaction
         if not ref:
             self.ref = None
         elif hasattr(ref, "path"):
@@ -395,24 +583,45 @@ class CommitBuilder(object):
         else:
             self.ref = ref
 
+        assert not (transaction and (initial_empty or self.ref is None))
+
         self._count = 0
 
         # State set for the life of the context manager
         self.lock = RepoLock(repo)
         self.parents = None
         self.commit = None
-        self.index = None
+        self.base_tree = None
+        self.staged = None
         self.has_changes = False
+        self.transaction = None
+        self.committing = False
+        self._pre_commit = None
+
+    @classmethod
+    def get_transaction(cls, repo, ref):
+        """Get the CommitBuilder for the transaction currently open on a ref, if any"""
+        if hasattr(ref, "path"):
+            ref = ref.path
+        return cls._transactions.get((repo.working_dir, ref))
 
     def __enter__(self):
         self._count += 1
         if self._count != 1:
             return self
 
+        if self.ref is not None and not self.initial_empty and not self.is_transaction:
+            transaction = self.get_transaction(self.repo, self.ref)
+            if transaction is not None:
+                self.transaction = transaction
+                transaction.__enter__()
+                return self
+
         self.lock.__enter__()
 
-        # First we create an empty index
-        self.index = pygit2.Index()
+        # Map of path to blob id, or None for deleted paths
+        self.staged = {}
+        self.base_tree = None
 
         if self.ref is not None:
             try:
@@ -422,23 +631,53 @@ class CommitBuilder(object):
             else:
                 self.parents = [ref.peel().id]
                 if not self.initial_empty:
-                    self.index.read_tree(ref.peel().tree)
+                    self.base_tree = ref.peel().tree
         else:
             self.parents = []
+
+        if self.is_transaction:
+            self.transaction = self
+            self._pre_commit = []
+            self._transactions[(self.repo.working_dir, self.ref)] = self
         return self
 
     def __exit__(self, *args, **kwargs):
+        if self._count == 1 and self.is_transaction:
+            # Run the deferred writes while the builder is still active
+            self.committing = True
+            try:
+                for _, callback in self._pre_commit:
+                    callback(self)
+            except Exception:
+                self._count = 0
+                del self._transactions[(self.repo.working_dir, self.ref)]
+                self.lock.__exit__(*args, **kwargs)
+                raise
+
         self._count -= 1
         if self._count != 0:
             return
 
+        if self.transaction is not None and self.transaction is not self:
+            if self.has_changes:
+                self.transaction.message += self.message
+            self.transaction.__exit__(*args, **kwargs)
+            self.transaction = None
+            return
+
+        if self.is_transaction:
+            del self._transactions[(self.repo.working_dir, self.ref)]
+            self.transaction = None
+            self.committing = False
+            self._pre_commit = None
+
         if not self.has_changes:
             if self.parents:
                 sha1 = self.parents[0]
             else:
                 return None
         else:
-            tree_id = self.index.write_tree(self.pygit2_repo)
+            tree_id = self._write_tree()
 
             sha1 = self.pygit2_repo.create_commit(self.ref,
                                                   self.pygit2_repo.default_signature,
@@ -446,21 +685,97 @@ class CommitBuilder(object):
                                                   self.message,
                                                   tree_id,
                                                   self.parents)
+            DataSnapshot.update_open(self.pygit2_repo, self.ref, sha1)
         self.lock.__exit__(*args, **kwargs)
         self.commit = self.commit_cls(self.repo, sha1)
 
-    def add_tree(self, tree):
+    def add_pre_commit(self, key, callback):
+        """Register a callback to run just before the transaction commit is created.
+
+        :param key: Hashable key identifying the callback. A callback is only
+                    registered once for each key.
+        :param callback: Function taking the transaction CommitBuilder as its
+                         only argument."""
+        assert self.is_transaction
+        if not any(item_key == key for item_key, _ in self._pre_commit):
+            self._pre_commit.append((key, callback))
+
+    def _target(self):
+        # Builders that joined a transaction stage their changes in the transaction
         self.has_changes = True
+        if self.transaction is not None:
+            self.transaction.has_changes = True
+            return self.transaction
+        return self
+
+    def add_tree(self, tree):
+        target = self._target()
         for path, data in tree.iteritems():
-            blob = self.pygit2_repo.create_blob(data)
-            index_entry = pygit2.IndexEntry(path, blob, pygit2.GIT_FILEMODE_BLOB)
-            self.index.add(index_entry)
+            target.staged[path] = self.pygit2_repo.create_blob(data)
 
     def delete(self, delete):
-        self.has_changes = True
+        target = self._target()
         if delete:
             for path in delete:
-                self.index.remove(path)
+                target.staged[path] = None
+
+    def read(self, path):
+        """Get the data for a path as staged in this CommitBuilder, or None if
+        the path doesn't exist."""
+        target = self.transaction if self.transaction is not None else self
+        if path in target.staged:
+            blob_id = target.staged[path]
+        elif target.base_tree is None:
+            return None
+        else:
+            try:
+                entry = target.base_tree[path]
+            except KeyError:
+                return None
+            if entry.type != "blob":
+                return None
+            blob_id = entry.id
+        if blob_id is None:
+            return None
+        return self.pygit2_repo[blob_id].data
+
+    def _write_tree(self):
+        # Arrange the staged changes into a tree of dicts matching the directory
+        # structure, so that only the directories containing changes are rebuilt
+        changes = {}
+        for path, blob_id in self.staged.iteritems():
+            sync_commit.add_tree_change(changes, path, blob_id)
+
+        tree_id = self._build_tree(self.base_tree, changes)
+        if tree_id is None:
+            tree_id = self.pygit2_repo.TreeBuilder().write()
+        return tree_id
+
+    def _build_tree(self, tree, changes):
+        if tree is not None:
+            builder = self.pygit2_repo.TreeBuilder(tree)
+        else:
+            builder = self.pygit2_repo.TreeBuilder()
+
+        for name, change in changes.iteritems():
+            if isinstance(change, dict):
+                subtree = None
+                if tree is not None and name in tree and tree[name].type == "tree":
+                    subtree = self.pygit2_repo[tree[name].id]
+                subtree_id = self._build_tree(subtree, change)
+                if subtree_id is not None:
+                    builder.insert(name, subtree_id, pygit2.GIT_FILEMODE_TREE)
+                elif builder.get(name) is not None:
+                    builder.remove(name)
+            elif change is None:
+                if builder.get(name) is not None:
+                    builder.remove(name)
+            else:
+                builder.insert(name, change, pygit2.GIT_FILEMODE_BLOB)
+
+        if len(builder) == 0:
+            return None
+        return builder.write()
 
     def get(self):
         return self.commit
@@ -477,7 +792,9 @@ class ProcessData(object):
         self.process_name = process_name
         self.ref = git.Reference(repo, env.config["sync"]["ref"])
         self.path = self.get_path(process_name)
-        self._data = self._load()
+        # The data is only read and decoded when it's first accessed
+        self._raw_data = None
+        self._loaded_data = None
         self._lock = None
         self._updated = set()
         self._deleted = set()
@@ -489,6 +806,13 @@ class ProcessData(object):
     def as_mut(self, lock):
         return MutGuard(lock, self)
 
+    def enter_mut(self):
+        # Data read before the lock was taken may have been changed by the process
+        # that last held the lock, so read it again on next access
+        if not (self._updated or self._deleted or self._delete):
+            self._raw_data = None
+            self._loaded_data = None
+
     def exit_mut(self):
         message = "Update %s\n\n" % self.path
         with CommitBuilder(self.repo, message=message, ref=self.ref.path) as commit:
@@ -519,11 +843,12 @@ class ProcessData(object):
         assert process_name.obj_type == cls.obj_type
         path = cls.get_path(process_name)
         ref = git.Reference(repo, env.config["sync"]["ref"])
-        try:
-            ref.commit.tree[path]
-        except KeyError:
-            pass
+        transaction = CommitBuilder.get_transaction(repo, ref)
+        if transaction is not None:
+            exists = transaction.read(path) is not None
         else:
+            exists = DataSnapshot.get(pygit2_get(repo)).entry(path) is not None
+        if exists:
             raise ValueError("%s already exists at path %s" % (cls.__name__, path))
         with CommitBuilder(repo, message, ref=ref) as commit:
             commit.add_tree({path: json.dumps(data)})
@@ -575,12 +900,53 @@ class ProcessData(object):
         with commit_builder as commit:
             commit.delete([self.path])
 
+    @classmethod
+    def load_many(cls, repo, process_names):
+        """Get the objects for several process names, reading all their data in a
+        single pass over the sync data tree rather than one lookup per object.
+
+        :param repo: The repository containing the sync data
+        :param process_names: Iterable of ProcessNames to load
+        :returns: List of objects in the same order as process_names"""
+        rv = [cls(repo, process_name) for process_name in process_names]
+        if CommitBuilder.get_transaction(repo, env.config["sync"]["ref"]) is not None:
+            # Reads have to see the staged transaction data, so load each item on demand
+            return rv
+
+        snapshot = DataSnapshot.get(pygit2_get(repo))
+        by_parent = defaultdict(list)
+        for item in rv:
+            if item._loaded_data is None and item._raw_data is None:
+                parent, _, name = item.path.rpartition("/")
+                by_parent[parent].append((name, item))
+
+        for parent in sorted(by_parent.iterkeys()):
+            tree = snapshot.tree(parent)
+            for name, item in by_parent[parent]:
+                if tree is not None and name in tree:
+                    item._raw_data = snapshot.pygit2_repo[tree[name].id].data
+                else:
+                    item._loaded_data = {}
+        return rv
+
+    @property
+    def _data(self):
+        if self._loaded_data is None:
+            if self._raw_data is not None:
+                self._loaded_data = json.loads(self._raw_data)
+                self._raw_data = None
+            else:
+                self._loaded_data = self._load()
+        return self._loaded_data
+
     def _load(self):
-        ref = self.pygit2_repo.references[self.ref.path]
-        repo = self.pygit2_repo
-        try:
-            data = repo[repo[ref.peel().tree.id][self.path].id].data
-        except KeyError:
+        transaction = CommitBuilder.get_transaction(self.repo, self.ref.path)
+        if transaction is not None:
+            data = transaction.read(self.path)
+            return json.loads(data) if data is not None else {}
+
+        data = DataSnapshot.get(self.pygit2_repo).read(self.path)
+        if data is None:
             return {}
         return json.loads(data)
 
@@ -618,6 +984,20 @@ class ProcessData(object):
         self._delete = True
 
 
+def _refresh_sync_data(lock):
+    """Discard cached sync data after a SyncLock is acquired, so that changes
+    made by the previous holder of the lock are visible"""
+    sync_commit.NotesSession.refresh_open()
+    if CommitBuilder._transactions:
+        # Any open transaction holds the RepoLock, so there can't be other changes
+        return
+    DataSnapshot.refresh_open()
+    ProcessNameIndex.reset_all()
+
+
+SyncLock.acquire_hooks.append(_refresh_sync_data)
+
+
 class entry_point(object):
     def __init__(self, task):
         self.task = task
@@ -14,8 +14,10 @@ import log
 from tasks import setup
 from env import Environment
 from gitutils import update_repositories
+from base import CommitBuilder, DataSnapshot
 from load import get_syncs
 from lock import RepoLock, SyncLock
+from repos import pygit2_get
 
 logger = log.get_logger(__name__)
 env = Environment()
@@ -227,6 +229,35 @@ def sync_from_path(git_gecko, git_wpt):
     return cls(git_gecko, git_wpt, process_name)
 
 
+def read_snapshot(git_gecko):
+    """Get a DataSnapshot for reading the state of syncs.
+
+    Sync data is only changed by commits, so reads from a snapshot are
+    consistent without taking any SyncLock, and don't wait for syncs that
+    are being updated"""
+    return DataSnapshot(pygit2_get(git_gecko))
+
+
+def print_sync(sync):
+    extra = []
+    if sync.sync_type == "downstream":
+        try_push = sync.latest_try_push
+        if try_push:
+            extra.append("https://treeherder.mozilla.org/#/jobs?repo=try&revision=%s" %
+                         sync.latest_try_push.try_rev)
+            if try_push.taskgroup_id:
+                extra.append(try_push.taskgroup_id)
+    error = sync.error
+    print("%s %s %s bug:%s PR:%s %s%s" % ("*"if sync.error else " ",
+                                          sync.sync_type,
+                                          sync.status,
+                                          sync.bug,
+                                          sync.pr,
+                                          " ".join(extra),
+                                          "ERROR: %s" %
+                                          error["message"].split("\n", 1)[0] if error else ""))
+
+
 def do_list(git_gecko, git_wpt, sync_type, *args, **kwargs):
     import downstream
     import landing
@@ -238,35 +269,21 @@ def do_list(git_gecko, git_wpt, sync_type, *args, **kwargs):
             return sync.error is not None and sync.status == "open"
         return True
 
-    for cls in [upstream.UpstreamSync, downstream.DownstreamSync, landing.LandingSync]:
-        if not sync_type or cls.sync_type in sync_type:
-            syncs.extend(item for item in cls.load_by_status(git_gecko, git_wpt, "open")
-                         if filter(item))
+    with read_snapshot(git_gecko):
+        for cls in [upstream.UpstreamSync, downstream.DownstreamSync, landing.LandingSync]:
+            if not sync_type or cls.sync_type in sync_type:
+                syncs.extend(item for item in cls.load_by_status(git_gecko, git_wpt, "open")
+                             if filter(item))
 
-    for sync in syncs:
-        extra = []
-        if sync.sync_type == "downstream":
-            try_push = sync.latest_try_push
-            if try_push:
-                extra.append("https://treeherder.mozilla.org/#/jobs?repo=try&revision=%s" %
-                             sync.latest_try_push.try_rev)
-                if try_push.taskgroup_id:
-                    extra.append(try_push.taskgroup_id)
-        error = sync.error
-        print("%s %s %s bug:%s PR:%s %s%s" % ("*"if sync.error else " ",
-                                              sync.sync_type,
-                                              sync.status,
-                                              sync.bug,
-                                              sync.pr,
-                                              " ".join(extra),
-                                              "ERROR: %s" %
-                                              error["message"].split("\n", 1)[0] if error else ""))
+        for sync in syncs:
+            print_sync(sync)
 
 
 def do_detail(git_gecko, git_wpt, sync_type, obj_id, *args, **kwargs):
-    syncs = get_syncs(git_gecko, git_wpt, sync_type, obj_id)
-    for sync in syncs:
-        print(sync.output())
+    with read_snapshot(git_gecko):
+        syncs = get_syncs(git_gecko, git_wpt, sync_type, obj_id)
+        for sync in syncs:
+            print(sync.output())
 
 
 def do_landing(git_gecko, git_wpt, *args, **kwargs):
@@ -496,9 +513,14 @@ def do_notify(git_gecko, git_wpt, pr_ids, *args, **kwargs):
         if sync is None:
             logger.error("No active sync for PR %s" % pr_id)
         else:
+            # Fetching the results is slow, so do it before taking the lock
+            with read_snapshot(git_gecko):
+                results = sync.notify_results(force=kwargs["force"])
+            if not results:
+                continue
             with SyncLock.for_process(sync.process_name) as lock:
                 with sync.as_mut(lock):
-                    sync.try_notify(force=kwargs["force"])
+                    sync.try_notify(force=kwargs["force"], results=results)
 
 
 def do_landable(git_gecko, git_wpt, *args, **kwargs):
@@ -507,17 +529,19 @@ def do_landable(git_gecko, git_wpt, *args, **kwargs):
     from downstream import DownstreamAction, DownstreamSync
     from landing import current, load_sync_point, landable_commits, unlanded_with_type
 
-    current_landing = current(git_gecko, git_wpt)
+    with read_snapshot(git_gecko):
+        current_landing = current(git_gecko, git_wpt)
 
-    if kwargs["prev_wpt_head"] is not None:
-        prev_wpt_head = kwargs["prev_wpt_head"]
-    elif current_landing:
-        print("Current landing will update head to %s" % current_landing.wpt_commits.head.sha1)
-        prev_wpt_head = current_landing.wpt_commits.head.sha1
-    else:
-        sync_point = load_sync_point(git_gecko, git_wpt)
-        print("Last sync was to commit %s" % sync_point["upstream"])
-        prev_wpt_head = sync_point["upstream"]
+        if kwargs["prev_wpt_head"] is not None:
+            prev_wpt_head = kwargs["prev_wpt_head"]
+        elif current_landing:
+            print("Current landing will update head to %s" %
+                  current_landing.wpt_commits.head.sha1)
+            prev_wpt_head = current_landing.wpt_commits.head.sha1
+        else:
+            sync_point = load_sync_point(git_gecko, git_wpt)
+            print("Last sync was to commit %s" % sync_point["upstream"])
+            prev_wpt_head = sync_point["upstream"]
 
     landable = landable_commits(git_gecko, git_wpt, prev_wpt_head,
                                 include_incomplete=kwargs["include_incomplete"])
@@ -667,12 +691,14 @@ def do_build_index(git_gecko, git_wpt, index_name, **kwargs):
         index_names = None
     else:
         index_names = set(index_name)
-    for idx_cls in index.indicies:
-        if index_names and idx_cls.name not in index_names:
-            continue
-        print "Building %s index" % idx_cls.name
-        idx = idx_cls(git_gecko)
-        idx.build(git_gecko, git_wpt)
+    with CommitBuilder(git_gecko, "Build indexes\n\n",
+                       ref=env.config["sync"]["ref"], transaction=True):
+        for idx_cls in index.indicies:
+            if index_names and idx_cls.name not in index_names:
+                continue
+            print "Building %s index" % idx_cls.name
+            idx = idx_cls(git_gecko)
+            idx.build(git_gecko, git_wpt)
 
 
 def do_migrate(git_gecko, git_wpt, **kwargs):
@@ -860,6 +886,12 @@ def do_migrate(git_gecko, git_wpt, **kwargs):
     for ref_name in delete:
         git2_repo.references.delete(ref_name)
 
+    print "Converting index storage"
+    import index
+    for idx_cls in index.indicies:
+        if idx_cls(git_gecko).convert_storage():
+            print "  Converted index %s to %s storage" % (idx_cls.name, idx_cls.storage)
+
 
 def set_config(opts):
     for opt in opts:
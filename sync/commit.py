@@ -1,19 +1,26 @@
 import os
 import re
 import subprocess
+from collections import defaultdict
 
 import git
+import pygit2
 from mozautomation import commitparser
 
 import log
 from env import Environment
 from errors import AbortError
-from repos import pygit2_get
+from gitutils import pr_for_commit
+from lock import RepoLock
+from repos import common_dir, pygit2_get
 
 
 env = Environment()
 logger = log.get_logger(__name__)
 
+# Treat checkout paths as literal paths rather than patterns; not exposed by pygit2
+GIT_CHECKOUT_DISABLE_PATHSPEC_MATCH = 1 << 13
+
 METADATA_RE = re.compile(r"\s*([^:]*): (.*)")
 
 
@@ -44,6 +51,163 @@ def first_non_merge(commits):
             return item
 
 
+def format_notes(data):
+    return "\n".join("%s: %s" % item for item in data.iteritems())
+
+
+def _note_path(pygit2_repo, tree, sha1):
+    """Path of the note for a commit in a notes tree.
+
+    Notes may be stored in a fanout layout where the first characters of the
+    sha1 form subdirectories. If there's an existing note for the commit its
+    path is returned, otherwise the path follows any existing fanout."""
+    path = []
+    rest = sha1
+    while tree is not None:
+        if rest in tree:
+            break
+        if len(rest) > 2 and rest[:2] in tree and tree[rest[:2]].type == "tree":
+            path.append(rest[:2])
+            tree = pygit2_repo[tree[rest[:2]].id]
+            rest = rest[2:]
+        else:
+            break
+    return "/".join(path + [rest])
+
+
+def write_notes(repo, notes, ref="refs/notes/commits"):
+    """Write notes for multiple commits in a single commit to the notes ref.
+
+    The data is merged into any existing note for each commit, as read under
+    the RepoLock, so keys set by other processes in the meantime are kept.
+
+    :param repo: GitPython repo holding the commits
+    :param notes: Dict of {commit sha1: dict of note keys to set}"""
+    if not notes:
+        return
+    pygit2_repo = pygit2_get(repo)
+    with RepoLock(repo):
+        try:
+            parent = pygit2_repo[pygit2_repo.lookup_reference(ref).target]
+        except KeyError:
+            parent = None
+        tree = parent.tree if parent is not None else None
+
+        changes = {}
+        for sha1, data in notes.iteritems():
+            path = _note_path(pygit2_repo, tree, str(sha1))
+            try:
+                entry = tree[path] if tree is not None else None
+            except KeyError:
+                entry = None
+            note = get_metadata(pygit2_repo[entry.id].data) if entry is not None else {}
+            note.update(data)
+            blob_id = pygit2_repo.create_blob(format_notes(note))
+            add_tree_change(changes, path, (blob_id, pygit2.GIT_FILEMODE_BLOB))
+        tree_id = build_tree(pygit2_repo, tree, changes)
+
+        signature = pygit2_repo.default_signature
+        commit_id = pygit2_repo.create_commit(None,
+                                              signature,
+                                              signature,
+                                              "Notes added by wptsync for %i commits" %
+                                              len(notes),
+                                              tree_id,
+                                              [parent.id] if parent is not None else [])
+        pygit2_repo.create_reference(ref, commit_id, force=True)
+
+
+class NotesSession(object):
+    """Batched reads and writes of the git notes for a repository.
+
+    Whilst a session is open for a repository, GitNotes reads each commit's
+    note once and keeps it in memory, and note updates are accumulated
+    rather than each being written as its own commit to the notes ref. When
+    the outermost session for the repository exits, whether or not there was
+    an exception, all the updated keys are written in a single commit.
+
+    with NotesSession(git_wpt):
+        for commit in commits:
+            # Neither of these reads or writes the notes ref more than once
+            if "wpt_pr" not in commit.notes:
+                commit.notes["wpt_pr"] = pr
+    """
+
+    # Map of repository git directory to the open session for that repository
+    _open = {}
+
+    def __init__(self, repo, ref="refs/notes/commits"):
+        self.repo = repo
+        self.pygit2_repo = pygit2_get(repo)
+        self.ref = ref
+        self.key = common_dir(repo)
+        # Map of sha1 to note data for notes that have been read
+        self._notes = {}
+        # Map of sha1 to the note keys that have been updated
+        self.pending = {}
+        self._count = 0
+
+    @classmethod
+    def get(cls, repo):
+        """Get the open session for a repository, or None"""
+        return cls._open.get(common_dir(repo))
+
+    def __enter__(self):
+        session = self._open.get(self.key)
+        if session is None:
+            session = self
+            self._open[self.key] = self
+        session._count += 1
+        return session
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        session = self._open[self.key]
+        session._count -= 1
+        if session._count == 0:
+            del self._open[self.key]
+            if exc_type is None:
+                session.flush()
+                return
+            # The notes describe commits that have already been made, so still write
+            # them, without replacing the original exception
+            try:
+                session.flush()
+            except Exception:
+                logger.error("Failed to write notes for %i commits" % len(session.pending))
+
+    @classmethod
+    def refresh_open(cls):
+        """Discard the notes read by all open sessions, so they are read again"""
+        for session in cls._open.itervalues():
+            session._notes = {}
+
+    def read(self, sha1):
+        if sha1 not in self._notes:
+            try:
+                text = self.pygit2_repo.lookup_note(sha1, self.ref).message
+            except KeyError:
+                self._notes[sha1] = {}
+            else:
+                self._notes[sha1] = get_metadata(text)
+        data = self._notes[sha1].copy()
+        data.update(self.pending.get(sha1, {}))
+        return data
+
+    def write(self, sha1, key, value):
+        self.pending.setdefault(sha1, {})[key] = value
+
+    def flush(self):
+        """Write all the pending note keys to the notes ref"""
+        if not self.pending:
+            return
+        logger.info("Writing notes for %i commits" % len(self.pending))
+        write_notes(self.repo, self.pending, self.ref)
+        for sha1 in self.pending:
+            # The written note may include keys set by other processes
+            self._notes.pop(sha1, None)
+        self.pending = {}
+
+
 class GitNotes(object):
     def __init__(self, commit):
         self.commit = commit
@@ -51,6 +215,9 @@ class GitNotes(object):
         self._data = self._read()
 
     def _read(self):
+        session = NotesSession.get(self.commit.repo)
+        if session is not None:
+            return session.read(self.commit.sha1)
         try:
             text = self.pygit2_repo.lookup_note(self.commit.sha1).message
         except KeyError:
@@ -67,13 +234,11 @@ class GitNotes(object):
 
     def __setitem__(self, key, value):
         self._data[key] = value
-        data = "\n".join("%s: %s" % item for item in self._data.iteritems())
-        self.pygit2_repo.create_note(data,
-                                     self.pygit2_repo.default_signature,
-                                     self.pygit2_repo.default_signature,
-                                     self.commit.sha1,
-                                     "refs/notes/commits",
-                                     True)
+        session = NotesSession.get(self.commit.repo)
+        if session is not None:
+            session.write(self.commit.sha1, key, value)
+            return
+        write_notes(self.commit.repo, {self.commit.sha1: {key: value}})
 
 
 class Commit(object):
@@ -82,7 +247,12 @@ class Commit(object):
         self.pygit2_repo = pygit2_get(repo)
         _commit = None
         _pygit2_commit = None
-        if hasattr(commit, "hexsha"):
+        if isinstance(commit, pygit2.Commit):
+            # The commit was read from the repository, so doesn't need to be
+            # checked for existence
+            sha1 = str(commit.id)
+            _pygit2_commit = commit
+        elif hasattr(commit, "hexsha"):
             # gitpython commit object
             sha1 = commit.hexsha
             _commit = commit
@@ -101,7 +271,7 @@ class Commit(object):
             _pygit2_commit = commit
         else:
             raise ValueError("Unrecognised commit %r" % commit)
-        if sha1 not in self.pygit2_repo:
+        if _pygit2_commit is None and sha1 not in self.pygit2_repo:
             raise ValueError("Commit with SHA1 %s not found" % sha1)
         self.sha1 = sha1
         self._commit = _commit
@@ -209,6 +379,30 @@ class Commit(object):
                          format="",
                          patch=True).strip() == ""
 
+    def files_changed(self):
+        """Get the set of paths changed by this commit.
+
+        For renames both the old and the new path are included. For merge
+        commits only paths that differ from every parent are included, which
+        matches the files listed in git's combined diff."""
+        pygit2_commit = self.pygit2_commit
+        if not pygit2_commit.parents:
+            # Diff against the empty tree
+            diffs = [pygit2_commit.tree.diff_to_tree(swap=True)]
+        else:
+            diffs = [parent.tree.diff_to_tree(pygit2_commit.tree)
+                     for parent in pygit2_commit.parents]
+
+        files = None
+        for diff in diffs:
+            diff.find_similar(flags=pygit2.GIT_DIFF_FIND_RENAMES)
+            parent_files = set()
+            for delta in diff.deltas:
+                parent_files.add(delta.old_file.path)
+                parent_files.add(delta.new_file.path)
+            files = parent_files if files is None else files & parent_files
+        return files
+
     def tags(self):
         return [item for item in self.repo.git.tag(points_at=self.sha1).split("\n")
                 if item.strip()]
@@ -216,6 +410,18 @@ class Commit(object):
     def move(self, dest_repo, skip_empty=True, msg_filter=None, metadata=None, src_prefix=None,
              dest_prefix=None, amend=False, three_way=True, exclude=None, patch_fallback=False):
 
+        if not amend and len(self.pygit2_commit.parents) == 1:
+            try:
+                return _apply_tree_changes(self.repo,
+                                           self.pygit2_commit.parents[0].tree,
+                                           self.pygit2_commit.tree,
+                                           self.msg, dest_repo, skip_empty, msg_filter, metadata,
+                                           src_prefix, dest_prefix, author=self.author,
+                                           exclude=exclude)
+            except TreeApplyError as e:
+                logger.info("Can't apply %s in-process, falling back to git apply: %s" %
+                            (self.sha1, e))
+
         return _apply_patch(self.show(src_prefix), self.msg, self.canonical_rev, dest_repo,
                             skip_empty, msg_filter, metadata, src_prefix, dest_prefix, amend,
                             three_way, author=self.author, exclude=exclude,
@@ -239,6 +445,25 @@ def move_commits(repo, revish, message, dest_repo, skip_empty=True, msg_filter=N
                  author=None, exclude=None, patch_fallback=False):
     if rev_name is None:
         rev_name = revish
+
+    revs = revish.split("..")
+    if not amend and len(revs) == 2 and all(revs):
+        src_pygit2_repo = pygit2_get(repo)
+        try:
+            old_tree, new_tree = [src_pygit2_repo.revparse_single(rev).peel(pygit2.Commit).tree
+                                  for rev in revs]
+        except (KeyError, ValueError):
+            # Let git report the error
+            pass
+        else:
+            try:
+                return _apply_tree_changes(repo, old_tree, new_tree, message, dest_repo,
+                                           skip_empty, msg_filter, metadata, src_prefix,
+                                           dest_prefix, author=author, exclude=exclude)
+            except TreeApplyError as e:
+                logger.info("Can't apply %s in-process, falling back to git apply: %s" %
+                            (revish, e))
+
     diff_args = ()
     if src_prefix:
         diff_args = ("--", src_prefix)
@@ -254,15 +479,13 @@ def move_commits(repo, revish, message, dest_repo, skip_empty=True, msg_filter=N
                         patch_fallback=patch_fallback)
 
 
-def _apply_patch(patch, message, rev_name, dest_repo, skip_empty=True, msg_filter=None,
-                 metadata=None, src_prefix=None, dest_prefix=None, amend=False, three_way=True,
-                 author=None, exclude=None, patch_fallback=False):
-    assert type(patch) == str
+class TreeApplyError(Exception):
+    """The changes can't be applied directly to the destination tree, so they
+    have to go through git apply instead"""
+    pass
 
-    if skip_empty and (not patch or patch.isspace() or
-                       not any(line.startswith("diff ") for line in patch.splitlines())):
-        return None
 
+def _filter_msg(message, msg_filter, metadata):
     if metadata is None:
         metadata = {}
 
@@ -274,7 +497,395 @@ def _apply_patch(patch, message, rev_name, dest_repo, skip_empty=True, msg_filte
     if metadata_extra:
         metadata.update(metadata_extra)
 
-    msg = Commit.make_commit_msg(msg, metadata)
+    return Commit.make_commit_msg(msg, metadata)
+
+
+def _cleanup_msg(msg):
+    """Clean up whitespace in a commit message in the same way as git commit"""
+    lines = []
+    for line in msg.splitlines():
+        line = line.rstrip()
+        if not line and (not lines or not lines[-1]):
+            continue
+        lines.append(line)
+    while lines and not lines[-1]:
+        lines.pop()
+    return "\n".join(lines) + "\n"
+
+
+def add_tree_change(changes, path, change):
+    """Add a change to a path to a dict of changes in the format used by build_tree
+
+    The result doesn't depend on the order in which changes are added, so a
+    file may replace a directory in which paths are deleted, or files may be
+    added in a directory that replaces a deleted file."""
+    parts = path.split("/")
+    node = changes
+    for part in parts[:-1]:
+        child = node.get(part)
+        if not isinstance(child, dict):
+            if child is not None:
+                # A file written at this path replaces everything below it
+                if change is None:
+                    return
+                raise ValueError("Can't add %s inside the file %s" % (path, part))
+            child = node[part] = {}
+        node = child
+    if change is None and isinstance(node.get(parts[-1]), dict):
+        # Files are added below this path, which replaces the deleted file
+        return
+    node[parts[-1]] = change
+
+
+def build_tree(pygit2_repo, tree, changes):
+    """Write a new tree object consisting of the base tree with changes applied
+
+    :param tree: Base pygit2 Tree, or None for an empty tree.
+    :param changes: Dict of {name: change} where change is either a dict of changes
+                    to the subtree of that name, a (blob id, filemode) tuple, or None
+                    to remove the entry.
+    :returns: The id of the written tree, or None if it is empty"""
+    builder = pygit2_repo.TreeBuilder(tree) if tree is not None else pygit2_repo.TreeBuilder()
+
+    for name, change in changes.iteritems():
+        if isinstance(change, dict):
+            subtree = None
+            if tree is not None and name in tree and tree[name].type == "tree":
+                subtree = pygit2_repo[tree[name].id]
+            subtree_id = build_tree(pygit2_repo, subtree, change)
+            if subtree_id is not None:
+                builder.insert(name, subtree_id, pygit2.GIT_FILEMODE_TREE)
+            elif builder.get(name) is not None:
+                builder.remove(name)
+        elif change is None:
+            if builder.get(name) is not None:
+                builder.remove(name)
+        else:
+            builder.insert(name, *change)
+
+    if len(builder) == 0:
+        return None
+    return builder.write()
+
+
+def copy_tree_objects(src_pygit2_repo, dest_pygit2_repo, tree_id):
+    """Copy a tree, and all the objects it references, from one repository to another.
+
+    Subtrees that already exist in the destination aren't traversed, so copying
+    a tree that mostly matches one already in the destination is cheap.
+
+    :raises TreeApplyError: If the tree contains submodules"""
+    if tree_id in dest_pygit2_repo:
+        return
+    tree = src_pygit2_repo[tree_id]
+    for entry in tree:
+        if entry.id in dest_pygit2_repo:
+            continue
+        if entry.type == "tree":
+            copy_tree_objects(src_pygit2_repo, dest_pygit2_repo, entry.id)
+        elif entry.type == "blob":
+            dest_pygit2_repo.write(pygit2.GIT_OBJ_BLOB, src_pygit2_repo[entry.id].read_raw())
+        else:
+            raise TreeApplyError("Can't copy %s entry %s" % (entry.type, entry.name))
+    # Write the tree after its contents so the destination is never missing objects
+    dest_pygit2_repo.write(pygit2.GIT_OBJ_TREE, tree.read_raw())
+
+
+def tree_entry(tree, path):
+    """Get the TreeEntry for a path in a tree, or None if it doesn't exist"""
+    try:
+        return tree[path]
+    except KeyError:
+        return None
+
+
+def _gitignore_regex(pattern):
+    """Convert a gitignore glob pattern to a regular expression"""
+    rv = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            rv.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("/**", i) and i + 3 == len(pattern):
+            rv.append("/.*")
+            i += 3
+        elif pattern.startswith("**", i):
+            rv.append(".*")
+            i += 2
+        else:
+            char = pattern[i]
+            i += 1
+            if char == "*":
+                rv.append("[^/]*")
+            elif char == "?":
+                rv.append("[^/]")
+            elif char == "\\" and i < len(pattern):
+                rv.append(re.escape(pattern[i]))
+                i += 1
+            elif char == "[" and "]" in pattern[i + 1:]:
+                end = pattern.index("]", i + 1)
+                chars = pattern[i:end]
+                if chars.startswith("!"):
+                    chars = "^" + chars[1:]
+                rv.append("[%s]" % chars.replace("\\", "\\\\"))
+                i = end + 1
+            else:
+                rv.append(re.escape(char))
+    return re.compile("^%s$" % "".join(rv))
+
+
+def parse_gitignore(data):
+    """Parse the contents of a .gitignore file.
+
+    :returns: List of (negate, dir_only, anchored, regexp) tuples, one per pattern"""
+    rules = []
+    for line in data.splitlines():
+        if line.endswith("\\ "):
+            line = line.rstrip(" ") + " "
+        else:
+            line = line.rstrip(" ")
+        if not line or line.startswith("#"):
+            continue
+        negate = line.startswith("!")
+        if negate:
+            line = line[1:]
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        anchored = "/" in line
+        line = line.lstrip("/")
+        if line:
+            rules.append((negate, dir_only, anchored, _gitignore_regex(line)))
+    return rules
+
+
+class GitIgnore(object):
+    """Check paths against the rules in the .gitignore files of a git tree.
+
+    This is for working with trees that aren't checked out; pygit2's
+    path_is_ignored reads the .gitignore files in the working directory."""
+
+    def __init__(self, pygit2_repo, tree):
+        self.pygit2_repo = pygit2_repo
+        self.tree = tree
+        self._rules = {}
+        self._dirs = {}
+
+    def _get_rules(self, dir_path):
+        if dir_path not in self._rules:
+            entry = tree_entry(self.tree, "%s/.gitignore" % dir_path if dir_path else ".gitignore")
+            if entry is not None and entry.type == "blob":
+                self._rules[dir_path] = parse_gitignore(self.pygit2_repo[entry.id].data)
+            else:
+                self._rules[dir_path] = []
+        return self._rules[dir_path]
+
+    def _match(self, path, is_dir):
+        parts = path.split("/")
+        ignored = False
+        # Rules in deeper .gitignore files take precedence, as do later rules in a file
+        for i in xrange(len(parts)):
+            rel_path = "/".join(parts[i:])
+            for negate, dir_only, anchored, regexp in self._get_rules("/".join(parts[:i])):
+                if dir_only and not is_dir:
+                    continue
+                if regexp.match(rel_path if anchored else parts[-1]):
+                    ignored = not negate
+        return ignored
+
+    def _dir_ignored(self, path):
+        if path not in self._dirs:
+            parent = path.rsplit("/", 1)[0] if "/" in path else None
+            self._dirs[path] = ((parent is not None and self._dir_ignored(parent)) or
+                                self._match(path, True))
+        return self._dirs[path]
+
+    def is_ignored(self, path):
+        """Check if a file at path would be ignored by git add"""
+        path = path.strip("/")
+        if "/" in path and self._dir_ignored(path.rsplit("/", 1)[0]):
+            # Files can't be re-included once their directory is ignored
+            return True
+        return self._match(path, False)
+
+
+def changes_paths(pygit2_repo, commit, paths):
+    """Check if a commit changes anything under a set of paths.
+
+    This compares the ids of the tree entries for the paths rather than
+    diffing the trees, so it only reads the trees along each path. As with
+    git rev-list, a merge is only considered to change a path if it differs
+    from every parent.
+
+    :param commit: pygit2 Commit
+    :param paths: List of paths to files or directories"""
+    entries = [tree_entry(commit.tree, path.rstrip("/")) for path in paths]
+    ids = [entry.id if entry is not None else None for entry in entries]
+    if not commit.parent_ids:
+        return any(item is not None for item in ids)
+    for parent_id in commit.parent_ids:
+        parent_tree = pygit2_repo[parent_id].tree
+        parent_entries = [tree_entry(parent_tree, path.rstrip("/")) for path in paths]
+        if ids == [entry.id if entry is not None else None for entry in parent_entries]:
+            return False
+    return True
+
+
+def _apply_tree_changes(repo, old_tree, new_tree, message, dest_repo, skip_empty=True,
+                        msg_filter=None, metadata=None, src_prefix=None, dest_prefix=None,
+                        author=None, exclude=None):
+    """Apply the changes between two trees in repo as a new commit on the HEAD
+    of dest_repo, without running git.
+
+    This only handles changes that apply exactly i.e. where each modified or
+    deleted file in the destination matches the old version in the source, and
+    added files don't exist in the destination. Otherwise TreeApplyError is raised
+    and the caller is expected to fall back to _apply_patch, which is able to
+    do a three-way merge.
+
+    dest_repo must be a worktree with HEAD checked out; see commit_tree."""
+    src_pygit2_repo = pygit2_get(repo)
+    dest_pygit2_repo = pygit2_get(dest_repo)
+
+    if src_prefix:
+        src_prefix = src_prefix.rstrip("/") + "/"
+
+    exclude_paths = set()
+    if exclude:
+        exclude_paths = {os.path.join(dest_prefix, exclude_path) if dest_prefix else exclude_path
+                         for exclude_path in exclude}
+
+    def dest_path(path):
+        if src_prefix:
+            path = path[len(src_prefix):]
+        return os.path.join(dest_prefix, path) if dest_prefix else path
+
+    deltas = [delta for delta in old_tree.diff_to_tree(new_tree).deltas
+              if (not src_prefix or
+                  delta.old_file.path.startswith(src_prefix) or
+                  delta.new_file.path.startswith(src_prefix))]
+
+    if not deltas:
+        if skip_empty:
+            return None
+        raise TreeApplyError("No changes to apply")
+
+    if dest_pygit2_repo.is_bare:
+        raise TreeApplyError("Destination repository has no worktree")
+    base_commit = dest_pygit2_repo.head.peel(pygit2.Commit)
+    base_tree = base_commit.tree
+    index = dest_pygit2_repo.index
+
+    changes = {}
+    for delta in deltas:
+        for file_info in [delta.old_file, delta.new_file]:
+            if file_info.mode == pygit2.GIT_FILEMODE_COMMIT:
+                raise TreeApplyError("Can't apply change to submodule %s" % file_info.path)
+
+        if delta.status == pygit2.GIT_DELTA_ADDED:
+            old_id, path = None, dest_path(delta.new_file.path)
+        elif delta.status in (pygit2.GIT_DELTA_DELETED, pygit2.GIT_DELTA_MODIFIED):
+            old_id, path = delta.old_file.id, dest_path(delta.old_file.path)
+        else:
+            raise TreeApplyError("Unexpected change to %s" % delta.old_file.path)
+
+        if path in exclude_paths:
+            continue
+
+        dest_entry = tree_entry(base_tree, path)
+        dest_id = dest_entry.id if dest_entry is not None else None
+        if dest_id != old_id:
+            raise TreeApplyError("%s doesn't match the original version" % path)
+        try:
+            index_id = index[path].id
+        except KeyError:
+            index_id = None
+        if index_id != dest_id:
+            raise TreeApplyError("Index entry for %s doesn't match HEAD" % path)
+
+        if delta.status == pygit2.GIT_DELTA_DELETED:
+            change = None
+        else:
+            blob_id = delta.new_file.id
+            if blob_id not in dest_pygit2_repo:
+                blob_id = dest_pygit2_repo.create_blob(src_pygit2_repo[blob_id].data)
+            change = (blob_id, delta.new_file.mode)
+
+        add_tree_change(changes, path, change)
+
+    tree_id = build_tree(dest_pygit2_repo, base_tree, changes)
+    if tree_id is None:
+        tree_id = dest_pygit2_repo.TreeBuilder().write()
+    if tree_id == base_tree.id:
+        logger.warning("Commit added no changes to destination repo")
+        return None
+
+    msg = _cleanup_msg(_filter_msg(message, msg_filter, metadata))
+    return commit_tree(dest_repo, tree_id, msg, author=author)
+
+
+def commit_tree(dest_repo, tree_id, msg, author=None):
+    """Create a commit with a given tree on top of HEAD in a worktree, and update
+    the worktree to match.
+
+    Only the paths that differ between HEAD and the new tree are checked out, so
+    this is cheap even for large trees with few changes.
+
+    :param dest_repo: GitPython Repo for a worktree
+    :param tree_id: Id of the tree for the new commit
+    :param msg: Commit message
+    :param author: Author string in the form "Name <email>", or None to use the
+                   configured identity
+    :returns: Commit object for the new commit
+    :raises TreeApplyError: If there is no configured committer identity"""
+    dest_pygit2_repo = pygit2_get(dest_repo)
+    base_commit = dest_pygit2_repo.head.peel(pygit2.Commit)
+    tree = dest_pygit2_repo[tree_id]
+
+    try:
+        committer = dest_pygit2_repo.default_signature
+    except (KeyError, pygit2.GitError) as e:
+        raise TreeApplyError("No committer identity configured: %s" % e)
+    author_sig = committer
+    if author is not None:
+        m = re.match(r"^(.*) <(.*)>$", author)
+        if m:
+            author_sig = pygit2.Signature(m.group(1), m.group(2))
+
+    changed_paths = set()
+    for delta in base_commit.tree.diff_to_tree(tree).deltas:
+        changed_paths.add(delta.old_file.path)
+        changed_paths.add(delta.new_file.path)
+
+    logger.info("Creating commit")
+    commit_id = dest_pygit2_repo.create_commit(None, author_sig, committer, msg, tree_id,
+                                               [base_commit.id])
+
+    # Update the worktree and index for the changed paths, then move HEAD to the new commit
+    if changed_paths:
+        dest_pygit2_repo.checkout_tree(tree,
+                                       paths=list(changed_paths),
+                                       strategy=(pygit2.GIT_CHECKOUT_FORCE |
+                                                 GIT_CHECKOUT_DISABLE_PATHSPEC_MATCH))
+    reflog_msg = "commit: %s" % msg.split("\n", 1)[0]
+    if dest_pygit2_repo.head_is_detached:
+        dest_pygit2_repo.set_head(commit_id)
+    else:
+        head_ref = dest_pygit2_repo.lookup_reference(dest_pygit2_repo.head.name)
+        head_ref.set_target(commit_id, reflog_msg)
+    return Commit(dest_repo, commit_id)
+
+
+def _apply_patch(patch, message, rev_name, dest_repo, skip_empty=True, msg_filter=None,
+                 metadata=None, src_prefix=None, dest_prefix=None, amend=False, three_way=True,
+                 author=None, exclude=None, patch_fallback=False):
+    assert type(patch) == str
+
+    if skip_empty and (not patch or patch.isspace() or
+                       not any(line.startswith("diff ") for line in patch.splitlines())):
+        return None
+
+    msg = _filter_msg(message, msg_filter, metadata)
 
     with Store(dest_repo, rev_name + ".message", msg) as message_path:
         strip_dirs = len(src_prefix.split("/")) + 1 if src_prefix else 1
@@ -393,9 +1004,9 @@ class GeckoCommit(Commit):
 
             nodes, bugs = nodes_bugs
             # Assuming that all commits are listed.
+            git_shas = self.repo.cinnabar.hg2git_many(nodes)
             for node in nodes:
-                git_sha = self.repo.cinnabar.hg2git(node)
-                commits.append(GeckoCommit(self.repo, git_sha))
+                commits.append(GeckoCommit(self.repo, git_shas[node]))
 
         return commits, set(bugs)
 
@@ -450,13 +1061,7 @@ class WptCommit(Commit):
         if "wpt_pr" not in self.notes:
             tags = [item.rsplit("_", 1)[1] for item in self.tags()
                     if item.startswith("merge_pr_")]
-            if tags and len(tags) == 1:
-                logger.info("Using tagged PR for commit %s" % self.sha1)
-                pr = tags[0]
-            else:
-                pr = env.gh_wpt.pr_for_commit(self.sha1)
-            if not pr:
-                pr == ""
+            pr = self._find_pr(tags)
             logger.info("Setting PR to %s" % pr)
             self.notes["wpt_pr"] = pr
         pr = self.notes["wpt_pr"]
@@ -466,6 +1071,54 @@ class WptCommit(Commit):
         except (TypeError, ValueError):
             return None
 
+    def _find_pr(self, tags):
+        """Get the PR for the commit as it's stored in the notes; a str of the
+        PR id or "" if there isn't one."""
+        if tags and len(tags) == 1:
+            logger.info("Using tagged PR for commit %s" % self.sha1)
+            return str(tags[0])
+        pr = pr_for_commit(self.repo, self.sha1)
+        if pr is None:
+            pr = env.gh_wpt.pr_for_commit(self.sha1)
+        return str(pr) if pr else ""
+
+
+def merge_pr_tags(repo):
+    """Get the PRs named by merge_pr_* tags.
+
+    :returns: Dict of {commit sha1: list of PR ids from tags pointing at the commit}"""
+    pygit2_repo = pygit2_get(repo)
+    prefix = "refs/tags/merge_pr_"
+    rv = defaultdict(list)
+    for name in pygit2_repo.listall_references():
+        if not name.startswith(prefix):
+            continue
+        commit = pygit2_repo.lookup_reference(name).peel(pygit2.Commit)
+        rv[str(commit.id)].append(name[len(prefix):])
+    return rv
+
+
+def resolve_prs(repo, commits):
+    """Ensure that the PR is recorded for each of a list of WptCommits.
+
+    This is equivalent to calling pr() on each commit, but the merge_pr_*
+    tags are only read once, the GitHub API is only used for commits that
+    have no note, tag or local PR ref, and the new notes are written in a
+    single commit.
+
+    :param repo: wpt repository
+    :param commits: Iterable of WptCommits
+    :returns: Dict of {commit sha1: pr or None}"""
+    commits = list(commits)
+    missing = [commit for commit in commits if "wpt_pr" not in commit.notes]
+    if missing:
+        tags = merge_pr_tags(repo)
+        logger.info("Setting PRs for %i commits" % len(missing))
+        with NotesSession(repo):
+            for commit in missing:
+                commit.notes["wpt_pr"] = commit._find_pr(tags.get(commit.sha1))
+    return {commit.sha1: commit.pr() for commit in commits}
+
 
 class Store(object):
     """Create a named file that is deleted if no exception is raised"""
@@ -816,8 +816,38 @@ class DownstreamSync(SyncProcess):
 
         return disabled
 
+    def _get_notify_results(self):
+        logger.info("Trying to generate results notification for PR %s" % self.pr)
+
+        results = notify.results.for_sync(self)
+
+        if not results:
+            # TODO handle errors here better, perhaps
+            logger.error("Failed to get results notification for PR %s" % self.pr)
+        return results
+
+    def notify_results(self, force=False):
+        """Get the results for a notification about this sync, or None if no
+        notification is required.
+
+        This only reads the sync state, so it doesn't need the SyncLock;
+        the results can be passed to try_notify once the lock is held."""
+        if self.results_notified and not force:
+            return None
+
+        if not self.bug:
+            logger.error("Sync for PR %s has no associated bug" % self.pr)
+            return None
+
+        if not self.has_affected_tests_readonly:
+            logger.debug("PR %s doesn't have affected tests so skipping results notification" %
+                         self.pr)
+            return None
+
+        return self._get_notify_results()
+
     @mut()
-    def try_notify(self, force=False):
+    def try_notify(self, force=False, results=None):
         if self.results_notified and not force:
             return
 
@@ -830,14 +860,10 @@ class DownstreamSync(SyncProcess):
                          self.pr)
             return
 
-        logger.info("Trying to generate results notification for PR %s" % self.pr)
-
-        results = notify.results.for_sync(self)
-
-        if not results:
-            # TODO handle errors here better, perhaps
-            logger.error("Failed to get results notification for PR %s" % self.pr)
-            return
+        if results is None:
+            results = self._get_notify_results()
+            if not results:
+                return
 
         message, truncated = notify.msg.for_results(results)
 
@@ -905,14 +931,17 @@ def new_wpt_pr(git_gecko, git_wpt, pr_data, raise_on_error=True, repo_update=Tru
     if pr_data["user"]["login"] == env.config["web-platform-tests"]["github"]["user"]:
         raise ValueError("Tried to create a downstream sync for a PR created "
                          "by the wpt bot")
-    if repo_update:
-        update_repositories(git_gecko, git_wpt)
     pr_id = pr_data["number"]
+    if repo_update:
+        update_repositories(git_gecko, git_wpt, wpt_prs=[pr_id])
     if DownstreamSync.for_pr(git_gecko, git_wpt, pr_id):
         return
     wpt_base = "origin/%s" % pr_data["base"]["ref"]
 
     with SyncLock("downstream", str(pr_id)) as lock:
+        # Another task may have created the sync while we were waiting for the lock
+        if DownstreamSync.for_pr(git_gecko, git_wpt, pr_id):
+            return
         sync = DownstreamSync.new(lock,
                                   git_gecko,
                                   git_wpt,
@@ -938,7 +967,7 @@ def new_wpt_pr(git_gecko, git_wpt, pr_data, raise_on_error=True, repo_update=Tru
 def commit_status_changed(git_gecko, git_wpt, sync, context, status, url, head_sha,
                           raise_on_error=False, repo_update=True):
     if repo_update:
-        update_repositories(git_gecko, git_wpt)
+        update_repositories(git_gecko, git_wpt, wpt_prs=[sync.pr], wpt_commit=head_sha)
     if sync.skip:
         return
     try:
@@ -1,11 +1,19 @@
+import os
+import sys
 import time
+import traceback
 
 import git
+import newrelic.agent
+import pygit2
 
+import lockstats
 import log
 from env import Environment
 from errors import RetryableError
 from lock import RepoLock
+from repos import cache_path, common_dir, pygit2_get, read_cache, write_cache
+from threadexecutor import ThreadExecutor
 
 env = Environment()
 
@@ -21,19 +29,85 @@ def have_gecko_hg_commit(git_gecko, hg_rev):
     return True
 
 
-def update_repositories(git_gecko, git_wpt, include_autoland=False, wait_gecko_commit=None):
+def have_commit(repo, sha1):
+    try:
+        return sha1 in pygit2_get(repo)
+    except ValueError:
+        return False
+
+
+def update_repositories(git_gecko, git_wpt, include_autoland=False, wait_gecko_commit=None,
+                        wpt_prs=None, wpt_commit=None, force=False):
+    """Fetch the upstream remotes for the gecko and wpt repositories.
+
+    The repositories are fetched concurrently, each under its own RepoLock. A
+    remote that was fetched less than fetch.freshness seconds ago isn't fetched
+    again, unless force is set or a commit that we need isn't yet present. The
+    freshness window is for periodic fetches; code handling an event that refers
+    to new upstream state must pass force or the commit it needs.
+
+    :param git_gecko: gecko repository, or None to skip fetching gecko
+    :param git_wpt: wpt repository, or None to skip fetching wpt
+    :param include_autoland: Also fetch the autoland remote for gecko
+    :param wait_gecko_commit: hg revision that must be present in gecko after
+                              the fetch. The fetch is retried until it is, and
+                              a RetryableError is raised if that fails.
+    :param wpt_prs: If not None, only fetch wpt master and the head refs of
+                    the PRs with these ids rather than every branch and PR.
+    :param wpt_commit: sha1 of a commit that must be fetched into wpt. wpt is
+                       fetched regardless of the freshness window if it's missing.
+    :param force: Fetch even if the remotes were fetched recently"""
+    fetches = []
     if git_gecko is not None:
         if wait_gecko_commit is not None:
-            success = until(lambda: _update_gecko(git_gecko, include_autoland),
-                            lambda: have_gecko_hg_commit(git_gecko, wait_gecko_commit))
-            if not success:
-                raise RetryableError(
-                    ValueError("Failed to fetch gecko commit %s" % wait_gecko_commit))
+            fetches.append(((_wait_gecko, git_gecko, include_autoland, wait_gecko_commit),
+                            {"force": force}))
         else:
-            _update_gecko(git_gecko, include_autoland)
+            fetches.append(((_update_gecko, git_gecko, include_autoland), {"force": force}))
 
     if git_wpt is not None:
-        _update_wpt(git_wpt)
+        wpt_force = force or (wpt_commit is not None and not have_commit(git_wpt, wpt_commit))
+        if wpt_prs is not None:
+            fetches.append(((update_wpt_prs, git_wpt, wpt_prs), {"force": wpt_force}))
+        else:
+            fetches.append(((_update_wpt, git_wpt), {"force": wpt_force}))
+
+    if len(fetches) == 1:
+        args, kwargs = fetches[0]
+        args[0](*args[1:], **kwargs)
+        return
+
+    # Keep the full exc_info for each failure, so the error is re-raised with
+    # the traceback from the fetch thread
+    errors = []
+
+    def run_fetch(fn, *args, **kwargs):
+        try:
+            fn(*args, **kwargs)
+        except Exception:
+            errors.append(sys.exc_info())
+
+    executor = ThreadExecutor(len(fetches), run_fetch)
+    executor.run(fetches)
+    if errors:
+        for exc_info in errors[1:]:
+            logger.error("Fetch failed:\n%s" % "".join(traceback.format_exception(*exc_info)))
+        exc_type, exc_value, tb = errors[0]
+        raise exc_type, exc_value, tb
+
+
+def _wait_gecko(git_gecko, include_autoland, hg_rev, force=False):
+    attempts = []
+
+    def update():
+        # Only the first attempt may reuse a recent fetch
+        _update_gecko(git_gecko, include_autoland, force=force or bool(attempts))
+        attempts.append(True)
+
+    success = until(update, lambda: have_gecko_hg_commit(git_gecko, hg_rev))
+    if not success:
+        raise RetryableError(
+            ValueError("Failed to fetch gecko commit %s" % hg_rev))
 
 
 def until(func, cond, max_tries=5):
@@ -47,22 +121,92 @@ def until(func, cond, max_tries=5):
     return True
 
 
-def _update_gecko(git_gecko, include_autoland):
+def _update_gecko(git_gecko, include_autoland, force=False):
     with RepoLock(git_gecko):
-        logger.info("Fetching mozilla-unified")
         # Not using the built in fetch() function since that tries to parse the output
         # and sometimes fails
-        git_gecko.git.fetch("mozilla")
+        fetch(git_gecko, "mozilla", force=force)
 
         if include_autoland and "autoland" in [item.name for item in git_gecko.remotes]:
-            logger.info("Fetching autoland")
-            git_gecko.git.fetch("autoland")
+            fetch(git_gecko, "autoland", force=force)
 
 
-def _update_wpt(git_wpt):
+def _update_wpt(git_wpt, force=False):
     with RepoLock(git_wpt):
-        logger.info("Fetching web-platform-tests")
-        git_wpt.git.fetch("origin")
+        fetch(git_wpt, "origin", force=force)
+
+
+def update_wpt_prs(git_wpt, prs, force=False):
+    """Fetch wpt master and the head refs of specific PRs.
+
+    This is much cheaper than fetching the whole remote, which includes the
+    head of every PR.
+
+    :param git_wpt: wpt repository
+    :param prs: Iterable of PR ids
+    :param force: Fetch even if the refs were fetched recently"""
+    refspecs = ["+refs/heads/master:refs/remotes/origin/master"]
+    refspecs.extend("+refs/pull/%i/head:refs/remotes/origin/pr/%i" % (int(pr), int(pr))
+                    for pr in prs)
+    with RepoLock(git_wpt):
+        pr_map = PrRefMap.for_repo(git_wpt)
+        pr_map.load()
+        if fetch(git_wpt, "origin", refspecs=refspecs, force=force):
+            pr_map.update(prs)
+
+
+def fetch(repo, remote, refspecs=None, force=False):
+    """Fetch a remote, unless it was already fetched within the freshness window.
+
+    The caller must hold the RepoLock for the repository.
+
+    :param repo: GitPython Repo to fetch into
+    :param remote: Name of the remote to fetch
+    :param refspecs: Optional list of refspecs to fetch rather than the configured
+                     refspecs for the remote. Each refspec has its own freshness
+                     window, and all of them are fresh after a full fetch.
+    :param force: Fetch even if the last fetch was recent
+    :returns: True if anything was fetched"""
+    repo_name = os.path.basename(repo.working_dir.rstrip(os.path.sep))
+    times_path = cache_path(repo, "fetch-times.json")
+    fetch_times = read_cache(times_path) or {}
+    freshness = env.config["fetch"].get("freshness", 0)
+
+    now = time.time()
+    if refspecs is None:
+        keys = [remote]
+    else:
+        keys = ["%s %s" % (remote, refspec) for refspec in refspecs]
+    if not force and freshness:
+        keys = [key for key in keys
+                if now - max(fetch_times.get(remote, 0), fetch_times.get(key, 0)) >= freshness]
+        if not keys:
+            logger.info("Skipping fetch of %s %s; fetched within the last %ss" %
+                        (repo_name, remote, freshness))
+            return False
+
+    args = [remote]
+    if refspecs is not None:
+        args.append("--no-tags")
+        args.extend(key.split(" ", 1)[1] for key in keys)
+    # Name used when reporting the timings
+    fetch_name = remote if refspecs is None else "%s-refs" % remote
+
+    logger.info("Fetching %s %s" % (repo_name, " ".join(args)))
+    repo.git.fetch(*args)
+    duration = time.time() - now
+    logger.info("Fetched %s %s in %.1fs" % (repo_name, fetch_name, duration))
+    newrelic.agent.record_custom_metric("Custom/Fetch/%s/%s" % (repo_name, fetch_name), duration)
+    lockstats.stats.send_statsd("wptsync.fetch.%s.%s:%d|ms" %
+                                (repo_name.replace(".", "_"), fetch_name, duration * 1000))
+
+    # Drop entries that are too old to matter so the file doesn't grow with every PR
+    fetch_times = {key: value for key, value in fetch_times.iteritems()
+                   if now - value < freshness}
+    for key in keys:
+        fetch_times[key] = now
+    write_cache(times_path, fetch_times)
+    return True
 
 
 def refs(git, prefix=None):
@@ -77,10 +221,185 @@ def refs(git, prefix=None):
 
 
 def pr_for_commit(git_wpt, rev):
+    """Get the id of the PR that has a given commit as its head, or None"""
+    return PrRefMap.for_repo(git_wpt).get(rev)
+
+
+class PrRefMap(object):
+    """Map from commit sha to the PR with that commit as its head.
+
+    The map is built from the refs/remotes/origin/pr/* refs with pygit2 and
+    stored in a cache file alongside a token made from the modification times
+    of packed-refs and the directory holding the loose PR refs. Whilst the token
+    is unchanged the map is valid, so lookups don't have to list the refs. After
+    a targeted fetch, update() changes only the entries for the fetched PRs."""
+
     prefix = "refs/remotes/origin/pr/"
-    pr_refs = refs(git_wpt, prefix)
-    if rev in pr_refs:
-        return int(pr_refs[rev][len(prefix):])
+    cache_name = "pr-refs.json"
+
+    _cache = {}
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.pygit2_repo = pygit2_get(repo)
+        self.git_dir = common_dir(repo)
+        self.path = cache_path(repo, self.cache_name)
+        self.token = None
+        # Map of PR id to head sha
+        self.heads = {}
+        # Map of head sha to PR id
+        self.prs = {}
+
+    @classmethod
+    def for_repo(cls, repo):
+        git_dir = common_dir(repo)
+        if git_dir not in cls._cache:
+            cls._cache[git_dir] = cls(repo)
+        return cls._cache[git_dir]
+
+    def _token(self):
+        rv = []
+        for path in [os.path.join(self.git_dir, "packed-refs"),
+                     os.path.join(self.git_dir, self.prefix)]:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                rv.append(None)
+            else:
+                rv.append([stat.st_mtime, stat.st_size])
+        return rv
+
+    def _set_heads(self, heads):
+        self.heads = heads
+        self.prs = {}
+        # If several PRs have the same head, prefer the most recent
+        for pr, sha in sorted(heads.iteritems()):
+            self.prs[sha] = pr
+
+    def _build(self):
+        heads = {}
+        for name in self.pygit2_repo.listall_references():
+            if not name.startswith(self.prefix):
+                continue
+            try:
+                pr = int(name[len(self.prefix):])
+            except ValueError:
+                continue
+            heads[pr] = self.pygit2_repo.lookup_reference(name).resolve().target.hex
+        return heads
+
+    def _write(self):
+        write_cache(self.path, {"token": self.token,
+                                "heads": {str(pr): sha for pr, sha in self.heads.iteritems()}})
+
+    def load(self):
+        token = self._token()
+        if token == self.token:
+            return
+        cached = read_cache(self.path)
+        if cached is not None and cached.get("token") == token:
+            self._set_heads({int(pr): str(sha) for pr, sha in cached["heads"].iteritems()})
+        else:
+            logger.info("Building map of PR heads")
+            self._set_heads(self._build())
+            self.token = token
+            self._write()
+        self.token = token
+
+    def update(self, prs):
+        """Update the entries for specific PRs after their refs changed.
+
+        The map must have been loaded before the refs changed, and the caller
+        must hold the RepoLock for the repository so nothing else changed them."""
+        if self.token is None:
+            self.load()
+            return
+        heads = self.heads.copy()
+        for pr in prs:
+            pr = int(pr)
+            try:
+                ref = self.pygit2_repo.lookup_reference("%s%i" % (self.prefix, pr))
+            except KeyError:
+                heads.pop(pr, None)
+            else:
+                heads[pr] = ref.resolve().target.hex
+        self._set_heads(heads)
+        self.token = self._token()
+        self._write()
+
+    def get(self, sha):
+        self.load()
+        return self.prs.get(sha)
+
+
+class ReachableSet(object):
+    """Set of the commits reachable from a given head commit.
+
+    This answers repeated is_ancestor queries against the same head without
+    running git for each one. Commits are added to the set by walking back from
+    the head as far as the merge-base with the commit being queried, so after
+    the first query for a commit in a given region of history, queries for
+    commits above it are a set lookup.
+
+    Since history is immutable, sets are cached for each (repository, head commit)
+    pair; use ReachableSet.for_rev to get the set for a revision."""
+
+    _cache = {}
+    max_cached = 32
+
+    def __init__(self, repo, head_id):
+        self.pygit2_repo = pygit2_get(repo)
+        self.head_id = head_id
+        self.reachable = {head_id}
+        self.unreachable = set()
+        # Commits at which the last walk stopped. Every commit reachable from the head
+        # is either in self.reachable or reachable from one of these commits
+        self.boundaries = [head_id]
+
+    @classmethod
+    def for_rev(cls, repo, rev):
+        """Get the ReachableSet for the commits reachable from a revision
+
+        :param repo: GitPython Repo object
+        :param rev: Revision, branch or ref name for the head commit"""
+        head_id = cls._resolve(pygit2_get(repo), rev)
+        key = (repo.git_dir, head_id)
+        if key not in cls._cache:
+            if len(cls._cache) >= cls.max_cached:
+                cls._cache.clear()
+            cls._cache[key] = cls(repo, head_id)
+        return cls._cache[key]
+
+    @staticmethod
+    def _resolve(pygit2_repo, rev):
+        return pygit2_repo.revparse_single(rev).peel(pygit2.Commit).id
+
+    def __contains__(self, rev):
+        commit_id = self._resolve(self.pygit2_repo, rev)
+        if commit_id in self.reachable:
+            return True
+        if commit_id in self.unreachable:
+            return False
+
+        base = self.pygit2_repo.merge_base(commit_id, self.head_id)
+        if base != commit_id:
+            self.unreachable.add(commit_id)
+            return False
+
+        # Add everything between the previous boundary and the new one
+        walker = self.pygit2_repo.walk(None, pygit2.GIT_SORT_NONE)
+        for boundary in self.boundaries:
+            walker.push(boundary)
+        walker.hide(commit_id)
+        self.reachable.update(commit.id for commit in walker)
+        self.reachable.add(commit_id)
+        self.boundaries = [commit_id]
+        return True
+
+
+def is_ancestor(repo, rev, head):
+    """Check if rev is an ancestor of head, using a cached ReachableSet for head"""
+    return rev in ReachableSet.for_rev(repo, head)
 
 
 def gecko_repo(git_gecko, head):
@@ -89,7 +408,7 @@ def gecko_repo(git_gecko, head):
               if name != "central"])
 
     for name, ref in repos:
-        if git_gecko.is_ancestor(head, ref):
+        if is_ancestor(git_gecko, head, ref):
             return name
 
 
@@ -8,17 +8,30 @@ import trypush
 import update
 import upstream
 import worktree
+from base import DataSnapshot
 from env import Environment
 from errors import RetryableError
-from gitutils import pr_for_commit, update_repositories, gecko_repo
+from gitutils import have_commit, pr_for_commit, update_repositories, gecko_repo
 from load import get_pr_sync
 from lock import SyncLock
+from repos import pygit2_get
 
 env = Environment()
 
 logger = log.get_logger(__name__)
 
 
+def with_snapshot(f):
+    """Decorator for Handler.__call__ that reads all sync data from a single
+    DataSnapshot for the duration of the call"""
+    def inner(self, git_gecko, git_wpt, *args, **kwargs):
+        with DataSnapshot(pygit2_get(git_gecko)):
+            return f(self, git_gecko, git_wpt, *args, **kwargs)
+    inner.__name__ = f.__name__
+    inner.__doc__ = f.__doc__
+    return inner
+
+
 class Handler(object):
     def __init__(self, config):
         self.config = config
@@ -74,12 +87,23 @@ def handle_status(git_gecko, git_wpt, event):
         return
 
     repo_update = event.get("_wptsync", {}).get("repo_update", True)
-    if repo_update:
-        update_repositories(None, git_wpt, False)
-
     rev = event["sha"]
+
     # First check if the PR is head of any pull request
     pr_id = pr_for_commit(git_wpt, rev)
+    if repo_update:
+        prs = []
+        if pr_id is None and not (have_commit(git_wpt, rev) and
+                                  git_wpt.is_ancestor(rev, "origin/master")):
+            # The commit is usually the new head of a PR that we haven't fetched,
+            # so find the PR and fetch just that, rather than every PR head
+            gh_pr_id = env.gh_wpt.pr_for_commit(rev)
+            if gh_pr_id:
+                prs.append(gh_pr_id)
+        update_repositories(None, git_wpt, wpt_prs=prs, force=True)
+        # The fetch may have moved PR heads, so the commit may no longer be the
+        # head of the same PR
+        pr_id = pr_for_commit(git_wpt, rev)
 
     newrelic.agent.add_custom_parameter("rev", rev)
     newrelic.agent.add_custom_parameter("context", event["context"])
@@ -123,7 +147,7 @@ def handle_status(git_gecko, git_wpt, event):
 
 def handle_push(git_gecko, git_wpt, event):
     newrelic.agent.set_transaction_name("handle_push")
-    update_repositories(None, git_wpt, False)
+    update_repositories(None, git_wpt, wpt_prs=[], force=True)
     landing.wpt_push(git_gecko, git_wpt, [item["id"] for item in event["commits"]])
 
 
@@ -134,6 +158,7 @@ class GitHubHandler(Handler):
         "push": handle_push,
     }
 
+    @with_snapshot
     def __call__(self, git_gecko, git_wpt, body):
         newrelic.agent.set_transaction_name("GitHubHandler")
         handler = self.dispatch_event[body["event"]]
@@ -145,6 +170,7 @@ class GitHubHandler(Handler):
 
 
 class PushHandler(Handler):
+    @with_snapshot
     def __call__(self, git_gecko, git_wpt, body):
         newrelic.agent.set_transaction_name("PushHandler")
         repo = body["_meta"]["routing_key"]
@@ -188,6 +214,7 @@ class TaskHandler(Handler):
     rather than the TaskCluster event type, as this allows us to filter only
     Gecko Decision Tasks."""
 
+    @with_snapshot
     def __call__(self, git_gecko, git_wpt, body):
         newrelic.agent.set_transaction_name("TaskHandler")
         task_id = body["status"]["taskId"]
@@ -264,6 +291,7 @@ class TaskHandler(Handler):
 
 
 class TaskGroupHandler(Handler):
+    @with_snapshot
     def __call__(self, git_gecko, git_wpt, body):
         newrelic.agent.set_transaction_name("TaskGroupHandler")
         taskgroup_id = tc.normalize_task_id(body["taskGroupId"])
@@ -308,12 +336,22 @@ class TaskGroupHandler(Handler):
 
 
 class LandingHandler(Handler):
+    @with_snapshot
     def __call__(self, git_gecko, git_wpt):
         newrelic.agent.set_transaction_name("LandingHandler")
         return landing.update_landing(git_gecko, git_wpt)
 
 
+class FetchHandler(Handler):
+    @with_snapshot
+    def __call__(self, git_gecko, git_wpt):
+        newrelic.agent.set_transaction_name("FetchHandler")
+        logger.info("Running full fetch")
+        update_repositories(git_gecko, git_wpt, include_autoland=True)
+
+
 class CleanupHandler(Handler):
+    @with_snapshot
     def __call__(self, git_gecko, git_wpt):
         newrelic.agent.set_transaction_name("CleanupHandler")
         logger.info("Running cleanup")
@@ -322,6 +360,7 @@ class CleanupHandler(Handler):
 
 
 class RetriggerHandler(Handler):
+    @with_snapshot
     def __call__(self, git_gecko, git_wpt):
         newrelic.agent.set_transaction_name("RetriggerHandler")
         logger.info("Running retrigger")
@@ -333,6 +372,7 @@ class RetriggerHandler(Handler):
 
 
 class PhabricatorHandler(Handler):
+    @with_snapshot
     def __call__(self, git_gecko, git_wpt, body):
         newrelic.agent.set_transaction_name("PhabricatorHandler")
         logger.info('Got phab event, doing nothing: %s' % body)
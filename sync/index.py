@@ -1,23 +1,239 @@
 import json
 from collections import defaultdict
 
-import git
+import pygit2
 
 import env
 import log
-from base import ProcessName, CommitBuilder, iter_tree, iter_process_names
+from base import ProcessName, CommitBuilder, DataSnapshot, iter_process_names
 from repos import pygit2_get
 
 
 logger = log.get_logger(__name__)
 env = env.Environment()
 
+# Map of (repository path, index name) to the IndexView for that index
+_views = {}
+
+# Map of index metadata blob id to the storage format recorded in that blob
+_storage_formats = {}
+
+
+class PackedIndexData(object):
+    """Index entries encoded as a single sorted, binary-searchable blob.
+
+    The blob consists of a header line, a table of fixed-width record offsets
+    and then the records themselves, sorted by key:
+
+      wptsync-packed-index <version> <count>
+      <offset of record 0>
+      ...
+      <key>\t<JSON list of values>
+      ...
+
+    Keys are the index key parts joined with "/". Offsets are relative to the
+    start of the first record, so a lookup only needs to parse the records
+    it visits during the binary search."""
+
+    magic = "wptsync-packed-index"
+    version = 1
+    offset_width = 10
+
+    def __init__(self, data=None):
+        self.data = data if data is not None else ""
+        self.count = 0
+        self._table_start = 0
+        self._records_start = 0
+        if not self.data:
+            return
+        header_end = self.data.index("\n")
+        magic, version, count = self.data[:header_end].split(" ")
+        if magic != self.magic or int(version) != self.version:
+            raise ValueError("Unrecognised packed index format %s %s" % (magic, version))
+        self.count = int(count)
+        self._table_start = header_end + 1
+        self._records_start = self._table_start + self.count * (self.offset_width + 1)
+
+    @classmethod
+    def dumps(cls, entries):
+        """Encode a mapping of {key: values} into the packed format.
+
+        :param entries: dict of key string to an iterable of values. Keys with
+                        no values are omitted."""
+        offsets = []
+        records = []
+        offset = 0
+        for key in sorted(entries.iterkeys()):
+            values = entries[key]
+            if not values:
+                continue
+            if "\t" in key or "\n" in key:
+                raise ValueError("Invalid key for packed index %r" % key)
+            record = "%s\t%s\n" % (key, json.dumps(sorted(values)))
+            offsets.append("%0*d\n" % (cls.offset_width, offset))
+            records.append(record)
+            offset += len(record)
+        header = "%s %d %d\n" % (cls.magic, cls.version, len(records))
+        return "".join([header] + offsets + records)
+
+    def _record_start(self, i):
+        start = self._table_start + i * (self.offset_width + 1)
+        return self._records_start + int(self.data[start:start + self.offset_width])
+
+    def _key_at(self, i):
+        start = self._record_start(i)
+        return self.data[start:self.data.index("\t", start)]
+
+    def _item_at(self, i):
+        start = self._record_start(i)
+        sep = self.data.index("\t", start)
+        end = self.data.index("\n", sep)
+        return self.data[start:sep], json.loads(self.data[sep + 1:end])
+
+    def _bisect(self, key):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get(self, key):
+        """Get the list of values for an exact key, or None if it isn't present"""
+        i = self._bisect(key)
+        if i < self.count:
+            item_key, values = self._item_at(i)
+            if item_key == key:
+                return values
+        return None
+
+    def iter_prefix(self, prefix):
+        """Iterate over (key, values) for all keys equal to, or under, a key prefix"""
+        if not prefix:
+            for item in self.items():
+                yield item
+            return
+        sub_prefix = prefix + "/"
+        for i in xrange(self._bisect(prefix), self.count):
+            key, values = self._item_at(i)
+            if not key.startswith(prefix):
+                break
+            if key == prefix or key.startswith(sub_prefix):
+                yield key, values
+
+    def items(self):
+        for i in xrange(self.count):
+            yield self._item_at(i)
+
+    def keys(self):
+        for i in xrange(self.count):
+            yield self._key_at(i)
+
+
+class IndexView(object):
+    """In-memory copy of the data for an index at a specific commit of the
+    sync data ref.
+
+    Reading an index from git means walking its subtree and decoding every
+    blob. To avoid doing that on each lookup, the view keeps the decoded
+    data keyed by commit id. When the ref moves, the old and new index
+    trees are diffed and only the blobs that changed are reloaded."""
+
+    def __init__(self, pygit2_repo, root_path, load_obj):
+        self.pygit2_repo = pygit2_repo
+        self.root_path = root_path
+        self.load_obj = load_obj
+        self.commit_id = None
+        self.tree_id = None
+        self._data = {}
+        self._prefixes = defaultdict(set)
+
+    def refresh(self):
+        """Update the view to the current commit of the sync data"""
+        snapshot = DataSnapshot.get(self.pygit2_repo)
+        commit = snapshot.commit
+        if commit.id == self.commit_id:
+            return
+
+        tree = snapshot.tree(self.root_path)
+        tree_id = tree.id if tree is not None else None
+
+        if tree_id != self.tree_id:
+            if (self.tree_id is None or tree_id is None or
+                self.tree_id not in self.pygit2_repo):
+                self._load_all(tree_id)
+            else:
+                self._load_diff(tree_id)
+        self.commit_id = commit.id
+        self.tree_id = tree_id
+
+    def _load_all(self, tree_id):
+        self._data = {}
+        self._prefixes = defaultdict(set)
+        if tree_id is None:
+            return
+        stack = [((), self.pygit2_repo[tree_id])]
+        while stack:
+            path, tree = stack.pop()
+            for item in tree:
+                item_path = path + (item.name,)
+                if item.type == "tree":
+                    stack.append((item_path, self.pygit2_repo[item.id]))
+                else:
+                    self._set(item_path, item.id)
+
+    def _load_diff(self, tree_id):
+        old_tree = self.pygit2_repo[self.tree_id]
+        new_tree = self.pygit2_repo[tree_id]
+        for delta in old_tree.diff_to_tree(new_tree).deltas:
+            if delta.status == pygit2.GIT_DELTA_DELETED:
+                self._remove(tuple(delta.old_file.path.split("/")))
+            else:
+                if delta.old_file.path != delta.new_file.path:
+                    self._remove(tuple(delta.old_file.path.split("/")))
+                self._set(tuple(delta.new_file.path.split("/")), delta.new_file.id)
+
+    def _set(self, key, blob_id):
+        if key == ("_metadata",):
+            return
+        self._data[key] = frozenset(self.load_obj(self.pygit2_repo[blob_id]))
+        for i in xrange(len(key)):
+            self._prefixes[key[:i]].add(key)
+
+    def _remove(self, key):
+        if key not in self._data:
+            return
+        del self._data[key]
+        for i in xrange(len(key)):
+            prefix = key[:i]
+            self._prefixes[prefix].discard(key)
+            if not self._prefixes[prefix]:
+                del self._prefixes[prefix]
+
+    def get(self, key):
+        """Get the set of values stored under a key or key prefix"""
+        key = tuple(key)
+        if key in self._data:
+            return set(self._data[key])
+        rv = set()
+        for full_key in self._prefixes.get(key, ()):
+            rv |= self._data[full_key]
+        return rv
+
+    def keys(self):
+        return self._data.keys()
+
 
 class Index(object):
     name = None
     key_fields = ()
     unique = False
     value_cls = tuple
+    # Storage format for the index data. "tree" stores one blob per key,
+    # "packed" stores one PackedIndexData blob per value of the first key field
+    storage = "tree"
 
     # Overridden in subclasses using the constructor
     # This provides a kind of borg pattern where all instances of
@@ -45,7 +261,8 @@ class Index(object):
         logger.info("Creating index %s" % cls.name)
         data = {"name": cls.name,
                 "fields": list(cls.key_fields),
-                "unique": cls.unique}
+                "unique": cls.unique,
+                "storage": cls.storage}
         meta_path = "index/%s/_metadata" % cls.name
         tree = {meta_path: json.dumps(data, indent=0)}
         with CommitBuilder(repo,
@@ -58,13 +275,13 @@ class Index(object):
     def get_root_path(cls):
         return "index/%s" % cls.name
 
+    @classmethod
+    def get_metadata_path(cls):
+        return "%s/_metadata" % cls.get_root_path()
+
     @classmethod
     def get_or_create(cls, repo):
-        ref_name = env.config["sync"]["ref"]
-        ref = git.Reference(repo, ref_name)
-        try:
-            ref.commit.tree["index/%s" % cls.name]
-        except KeyError:
+        if DataSnapshot.get(pygit2_get(repo)).tree(cls.get_root_path()) is None:
             return cls.create(repo)
         return cls(repo)
 
@@ -83,11 +300,58 @@ class Index(object):
             return rv.pop() if rv else None
         return rv
 
-    def _read(self, key, include_local=True):
-        path = "%s/%s" % (self.get_root_path(), "/".join(key))
+    def view(self):
+        """Get the IndexView for this index, updated to the current sync data"""
+        view_key = (self.pygit2_repo.path, self.name)
+        view = _views.get(view_key)
+        if view is None:
+            view = IndexView(self.pygit2_repo, self.get_root_path(), self._load_obj)
+            _views[view_key] = view
+        view.refresh()
+        return view
+
+    def _root_tree(self):
+        return DataSnapshot.get(self.pygit2_repo).tree(self.get_root_path())
+
+    def storage_format(self):
+        """Get the storage format currently used for this index in the sync data"""
+        entry = DataSnapshot.get(self.pygit2_repo).entry(self.get_metadata_path())
+        if entry is None:
+            return self.storage
+        if entry.id not in _storage_formats:
+            metadata = json.loads(self.pygit2_repo[entry.id].data)
+            _storage_formats[entry.id] = metadata.get("storage", "tree")
+        return _storage_formats[entry.id]
+
+    def _read_shard(self, shard, root=None):
+        if root is None:
+            root = self._root_tree()
+        if root is None or shard not in root:
+            return PackedIndexData()
+        return PackedIndexData(self.pygit2_repo[root[shard].id].data)
+
+    def _shards(self, root=None):
+        if root is None:
+            root = self._root_tree()
+        if root is None:
+            return []
+        return [item.name for item in root if item.name != "_metadata"]
+
+    def _read_packed(self, key):
+        root = self._root_tree()
         data = set()
-        for obj in iter_blobs(self.pygit2_repo, path):
-            data |= self._load_obj(obj)
+        shards = [key[0]] if key else self._shards(root)
+        for shard in shards:
+            packed = self._read_shard(shard, root)
+            for _, values in packed.iter_prefix("/".join(key[1:])):
+                data |= set(values)
+        return data
+
+    def _read(self, key, include_local=True):
+        if self.storage_format() == "packed":
+            data = self._read_packed(key)
+        else:
+            data = self.view().get(key)
         if include_local:
             self._update_changes(key, data)
         return data
@@ -122,7 +386,10 @@ class Index(object):
                     data.add(new_value)
 
     def _load_obj(self, obj):
-        rv = json.loads(obj.data)
+        return self._load_data(obj.data)
+
+    def _load_data(self, data):
+        rv = json.loads(data)
         if isinstance(rv, list):
             return set(rv)
         return set([rv])
@@ -134,21 +401,38 @@ class Index(object):
 
         if commit_builder is None:
             commit_builder = CommitBuilder(self.repo,
-                                           message,
+                                           None,
                                            ref=env.config["sync"]["ref"],
                                            initial_empty=overwrite)
         else:
             assert commit_builder.initial_empty == overwrite
 
+        with commit_builder as commit:
+            transaction = commit.transaction
+            if transaction is not None and not transaction.committing:
+                # Keep the changes pending, so they are visible to reads, and write
+                # them all once when the transaction commits
+                transaction.add_pre_commit(("index", self.name),
+                                           lambda commit: self._write_changes(commit, message))
+                return
+            self._write_changes(commit, message)
+
+    def _write_changes(self, commit, message=None):
+        changes = self._read_changes(None)
+        if not changes:
+            return
+
         if message is None:
             message = "Update index %s\n" % self.name
 
             for key_changes in changes.itervalues():
                 for _, _, msg in key_changes:
                     message += "  %s\n" % msg
-            commit_builder.message += message
+        commit.message += message
 
-        with commit_builder as commit:
+        if self.storage_format() == "packed":
+            self._update_packed(commit, changes)
+        else:
             for key, key_changes in changes.iteritems():
                 self._update_key(commit, key, key_changes)
         self.reset()
@@ -186,8 +470,7 @@ class Index(object):
             self.insert(new_key, value)
         return self
 
-    def _update_key(self, commit, key, key_changes):
-        existing = self._read(key, False)
+    def _apply_changes(self, existing, key_changes):
         new = existing.copy()
 
         for old_value, new_value, _ in key_changes:
@@ -197,11 +480,19 @@ class Index(object):
                 new.remove(old_value)
             elif old_value is None:
                 new.add(new_value)
+        return new
 
+    def _update_key(self, commit, key, key_changes):
         path_suffix = "/".join(key)
 
         path = "%s/%s" % (self.get_root_path(), path_suffix)
 
+        # Read the existing value from the commit, not the snapshot, since the
+        # snapshot may predate commits made by other processes
+        data = commit.read(path)
+        existing = self._load_data(data) if data is not None else set()
+        new = self._apply_changes(existing, key_changes)
+
         if new == existing:
             return
 
@@ -216,6 +507,78 @@ class Index(object):
 
         commit.add_tree({path: json.dumps(index_value, indent=0)})
 
+    def _update_packed(self, commit, changes):
+        changes_by_shard = defaultdict(dict)
+        for key, key_changes in changes.iteritems():
+            changes_by_shard[key[0]]["/".join(key[1:])] = (key, key_changes)
+
+        for shard, shard_changes in changes_by_shard.iteritems():
+            path = "%s/%s" % (self.get_root_path(), shard)
+            # As in _update_key, the shard is read from the commit so that entries
+            # written since the snapshot was taken aren't lost
+            entries = dict(PackedIndexData(commit.read(path)).items())
+
+            updated = False
+            for packed_key, (key, key_changes) in shard_changes.iteritems():
+                existing = set(entries.get(packed_key, []))
+                new = self._apply_changes(existing, key_changes)
+                if new == existing:
+                    continue
+                if self.unique and len(new) > 1:
+                    raise ValueError("Tried to insert duplicate entry for unique index %s" %
+                                     (key,))
+                if new:
+                    entries[packed_key] = new
+                else:
+                    entries.pop(packed_key, None)
+                updated = True
+
+            if not updated:
+                continue
+
+            if entries:
+                commit.add_tree({path: PackedIndexData.dumps(entries)})
+            else:
+                commit.delete([path])
+
+    def convert_storage(self):
+        """Rewrite the stored index data using the storage format set on the class.
+
+        :returns: Boolean indicating whether the data was converted."""
+        current = self.storage_format()
+        if current == self.storage:
+            return False
+
+        logger.info("Converting index %s from %s to %s storage" %
+                    (self.name, current, self.storage))
+        root = self._root_tree()
+        entries = {key: self._read(key, False) for key in self.keys()}
+        if current == "packed":
+            old_paths = ["%s/%s" % (self.get_root_path(), shard) for shard in self._shards(root)]
+        else:
+            old_paths = ["%s/%s" % (self.get_root_path(), "/".join(key)) for key in entries]
+
+        metadata = json.loads(DataSnapshot.get(self.pygit2_repo).read(self.get_metadata_path()))
+        metadata["storage"] = self.storage
+
+        with CommitBuilder(self.repo,
+                           message="Convert index %s to %s storage" % (self.name, self.storage),
+                           ref=env.config["sync"]["ref"]) as commit:
+            commit.delete(old_paths)
+            if self.storage == "packed":
+                shards = defaultdict(dict)
+                for key, values in entries.iteritems():
+                    shards[key[0]]["/".join(key[1:])] = values
+                for shard, shard_entries in shards.iteritems():
+                    commit.add_tree({"%s/%s" % (self.get_root_path(), shard):
+                                     PackedIndexData.dumps(shard_entries)})
+            else:
+                for key, values in entries.iteritems():
+                    commit.add_tree({"%s/%s" % (self.get_root_path(), "/".join(key)):
+                                     json.dumps(list(sorted(values)), indent=0)})
+            commit.add_tree({self.get_metadata_path(): json.dumps(metadata, indent=0)})
+        return True
+
     def dump_value(self, value):
         return str(value)
 
@@ -245,9 +608,14 @@ class Index(object):
         return (value,)
 
     def keys(self):
-        return set(key for key, _ in
-                   iter_tree(self.pygit2_repo, root_path=self.get_root_path())
-                   if not key[-1] == "_metadata")
+        if self.storage_format() == "packed":
+            rv = set()
+            root = self._root_tree()
+            for shard in self._shards(root):
+                for key in self._read_shard(shard, root).keys():
+                    rv.add((shard,) + (tuple(key.split("/")) if key else ()))
+            return rv
+        return set(self.view().keys())
 
 
 class TaskGroupIndex(Index):
@@ -255,6 +623,7 @@ class TaskGroupIndex(Index):
     key_fields = ("taskgroup-id-0", "taskgroup-id-1", "taskgroup-id-2")
     unique = True
     value_cls = ProcessName
+    storage = "packed"
 
     @classmethod
     def make_key(cls, value):
@@ -275,6 +644,7 @@ class TryCommitIndex(Index):
     key_fields = ("commit-0", "commit-1", "commit-2", "commit-3")
     unique = True
     value_cls = ProcessName
+    storage = "packed"
 
     @classmethod
     def make_key(cls, value):
@@ -409,12 +779,13 @@ def iter_blobs(repo, path):
     :param repo: pygit2 repo
     :param path: path to use as the root, or None for the root path
     """
-    ref = repo.references[env.config["sync"]["ref"]]
-    root = repo[ref.peel().tree.id]
-    if path is not None:
-        if path not in root:
+    snapshot = DataSnapshot.get(repo)
+    if path is None:
+        root = snapshot.tree()
+    else:
+        root_entry = snapshot.entry(path)
+        if root_entry is None:
             return
-        root_entry = root[path]
         root = repo[root_entry.id]
         if root_entry.type == "blob":
             yield root
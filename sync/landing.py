@@ -1,10 +1,11 @@
 import re
 import os
 import shutil
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 
 import enum
 import git
+import pygit2
 from celery.exceptions import OperationalError
 
 import bug
@@ -23,7 +24,7 @@ from base import entry_point
 from commit import first_non_merge
 from env import Environment
 from gitutils import update_repositories
-from lock import SyncLock, constructor, mut
+from lock import RepoLock, SyncLock, constructor, mut
 from errors import AbortError, RetryableError
 from projectutil import Mach
 from repos import pygit2_get
@@ -84,6 +85,9 @@ class LandingSync(SyncProcess):
     statuses = ("open", "complete")
     status_transitions = [("open", "complete")]
 
+    # Paths in wpt where gecko keeps its own version of the file
+    keep_paths = {"LICENSE", "resources/testdriver_vendor.js"}
+
     def __init__(self, git_gecko, git_wpt, process_name):
         super(LandingSync, self).__init__(git_gecko, git_wpt, process_name)
         self._unlanded_gecko_commits = None
@@ -137,12 +141,11 @@ class LandingSync(SyncProcess):
         if self._unlanded_gecko_commits is None:
             commits = []
 
+            integration_commits = gitutils.ReachableSet.for_rev(self.git_gecko,
+                                                                self.gecko_integration_branch())
+
             def on_integration_branch(commit):
-                # Calling this continually is O(N*M) where N is the number of unlanded commits
-                # and M is the average depth of the commit in the gecko tree
-                # If we need a faster implementation one approach would be to store all the
-                # commits not on the integration branch and check if this commit is in that set
-                return self.git_gecko.is_ancestor(commit.sha1, self.gecko_integration_branch())
+                return commit.sha1 in integration_commits
 
             # All the commits from unlanded upstream syncs that are reachable from the
             # integration branch
@@ -165,20 +168,24 @@ class LandingSync(SyncProcess):
             # as we reach them so that we can get the right diffs for the other PRs
             unlanded_commits = self.git_wpt.iter_commits("%s..origin/master" %
                                                          self.wpt_commits.base.sha1)
-            seen_bugs = set()
+            hg_revs = []
             for commit in unlanded_commits:
                 wpt_commit = sync_commit.WptCommit(self.git_wpt, commit)
                 gecko_commit = wpt_commit.metadata.get("gecko-commit")
                 if gecko_commit:
-                    git_sha = self.git_gecko.cinnabar.hg2git(gecko_commit)
-                    commit = sync_commit.GeckoCommit(self.git_gecko, git_sha)
-                    bug_number = bug.bug_number_from_url(commit.metadata.get("bugzilla-url"))
-                    if on_integration_branch(commit):
-                        if bug_number and bug_number not in seen_bugs:
-                            logger.info("Commits from landed sync for bug %s will be reapplied" %
-                                        bug_number)
-                            seen_bugs.add(bug_number)
-                        commits.append(commit.sha1)
+                    hg_revs.append(gecko_commit)
+            git_shas = self.git_gecko.cinnabar.hg2git_many(hg_revs)
+
+            seen_bugs = set()
+            for hg_rev in hg_revs:
+                commit = sync_commit.GeckoCommit(self.git_gecko, git_shas[hg_rev])
+                bug_number = bug.bug_number_from_url(commit.metadata.get("bugzilla-url"))
+                if on_integration_branch(commit):
+                    if bug_number and bug_number not in seen_bugs:
+                        logger.info("Commits from landed sync for bug %s will be reapplied" %
+                                    bug_number)
+                        seen_bugs.add(bug_number)
+                    commits.append(commit.sha1)
 
             commits = set(commits)
 
@@ -218,7 +225,6 @@ class LandingSync(SyncProcess):
         # Assume we can always use the author of the first commit
         author = first_non_merge(wpt_commits).author
 
-        git_work_wpt = self.wpt_worktree.get()
         git_work_gecko = self.gecko_worktree.get()
 
         pr = env.gh_wpt.get_pull(int(pr_id))
@@ -266,11 +272,10 @@ Automatic update from web-platform-tests\n%s
                 return
 
         if copy:
-            commit = self.copy_pr(git_work_gecko, git_work_wpt, pr, wpt_commits,
-                                  message, author, metadata)
+            commit = self.copy_pr(git_work_gecko, pr, wpt_commits, message, author, metadata)
         else:
-            commit = self.move_pr(git_work_gecko, git_work_wpt, pr, wpt_commits,
-                                  message, author, prev_wpt_head, metadata)
+            commit = self.move_pr(git_work_gecko, pr, wpt_commits, message, author,
+                                  prev_wpt_head, metadata)
 
         if commit is not None:
             self.gecko_commits.head = commit
@@ -278,7 +283,65 @@ Automatic update from web-platform-tests\n%s
         return commit
 
     @mut()
-    def copy_pr(self, git_work_gecko, git_work_wpt, pr, wpt_commits, message, author, metadata):
+    def copy_pr(self, git_work_gecko, pr, wpt_commits, message, author, metadata):
+        try:
+            return self.copy_pr_tree(git_work_gecko, pr, wpt_commits, message, author, metadata)
+        except sync_commit.TreeApplyError as e:
+            logger.info("Can't build the commit for PR %s from the wpt tree, copying files: %s" %
+                        (pr.number, e))
+        return self.copy_pr_files(git_work_gecko, pr, wpt_commits, message, author, metadata)
+
+    @mut()
+    def copy_pr_tree(self, git_work_gecko, pr, wpt_commits, message, author, metadata):
+        """Create a commit for a PR with the gecko tree from HEAD but with the wpt
+        directory replaced by the tree of the last wpt commit.
+
+        This works directly with git objects, so apart from checking out the
+        changed files in the gecko worktree, it doesn't touch the filesystem, and
+        doesn't need a wpt worktree."""
+        wpt_path = env.config["gecko"]["path"]["wpt"]
+        wpt_pygit2_repo = pygit2_get(self.git_wpt)
+        gecko_pygit2_repo = pygit2_get(git_work_gecko)
+
+        wpt_tree = wpt_commits[-1].pygit2_commit.tree
+        if ".gitmodules" in wpt_tree:
+            raise sync_commit.TreeApplyError("wpt has submodules")
+        sync_commit.copy_tree_objects(wpt_pygit2_repo, gecko_pygit2_repo, wpt_tree.id)
+
+        head_tree = gecko_pygit2_repo.head.peel(pygit2.Commit).tree
+        changes = {}
+        sync_commit.add_tree_change(changes, wpt_path, (wpt_tree.id, pygit2.GIT_FILEMODE_TREE))
+        grafted_tree = gecko_pygit2_repo[sync_commit.build_tree(gecko_pygit2_repo, head_tree,
+                                                                changes)]
+
+        # Put back the gecko version of the paths we don't update, and leave out added
+        # files that are ignored in the new tree, as git add would
+        ignore = sync_commit.GitIgnore(gecko_pygit2_repo, grafted_tree)
+        changes = {}
+        for path in self.keep_paths:
+            path = "%s/%s" % (wpt_path, path)
+            entry = sync_commit.tree_entry(head_tree, path)
+            sync_commit.add_tree_change(changes, path,
+                                        (entry.id, entry.filemode) if entry is not None else None)
+        for delta in head_tree.diff_to_tree(grafted_tree).deltas:
+            if (delta.status == pygit2.GIT_DELTA_ADDED and
+                ignore.is_ignored(delta.new_file.path)):
+                sync_commit.add_tree_change(changes, delta.new_file.path, None)
+        tree_id = sync_commit.build_tree(gecko_pygit2_repo, grafted_tree, changes)
+
+        if tree_id == head_tree.id:
+            logger.info("PR %s didn't add any changes" % pr.number)
+            return None
+
+        message = sync_commit.Commit.make_commit_msg(message, metadata)
+        commit = sync_commit.commit_tree(git_work_gecko, tree_id, message, author=author)
+        logger.debug("Gecko files changed: \n%s" % "\n".join(sorted(commit.files_changed())))
+        return sync_commit.GeckoCommit(self.git_gecko, commit.sha1)
+
+    @mut()
+    def copy_pr_files(self, git_work_gecko, pr, wpt_commits, message, author, metadata):
+        git_work_wpt = self.wpt_worktree.get()
+
         # Ensure we have anything in a wpt submodule
         git_work_wpt.git.submodule("update", "--init", "--recursive")
 
@@ -287,7 +350,7 @@ Automatic update from web-platform-tests\n%s
         src_path = git_work_wpt.working_dir
 
         # Specific paths that should be re-checked out
-        keep_paths = {"LICENSE", "resources/testdriver_vendor.js"}
+        keep_paths = self.keep_paths
         # file names that are ignored in any part of the tree
         ignore_files = {".git"}
 
@@ -338,8 +401,8 @@ Automatic update from web-platform-tests\n%s
         return gecko_commit
 
     @mut()
-    def move_pr(self, git_work_gecko, git_work_wpt, pr, wpt_commits, message, author,
-                prev_wpt_head, metadata):
+    def move_pr(self, git_work_gecko, pr, wpt_commits, message, author, prev_wpt_head,
+                metadata):
         if prev_wpt_head is None:
             if wpt_commits[-1].is_merge:
                 base = wpt_commits[-1].sha1 + "^"
@@ -364,7 +427,7 @@ Automatic update from web-platform-tests\n%s
                                         metadata=metadata,
                                         rev_name="pr-%s" % pr.number,
                                         author=first_non_merge(wpt_commits).author,
-                                        exclude={"LICENSE", "resources/testdriver_vendor.js"})
+                                        exclude=self.keep_paths)
 
     @mut()
     def reapply_local_commits(self, gecko_commits_landed):
@@ -737,11 +800,13 @@ def push(landing):
 
         try:
             logger.info("Pushing landing")
-            landing.git_gecko.remotes.mozilla.push(
-                "%s:%s" % (landing.branch_name,
-                           landing.gecko_integration_branch().split("/", 1)[1]))
+            with RepoLock(landing.git_gecko):
+                landing.git_gecko.remotes.mozilla.push(
+                    "%s:%s" % (landing.branch_name,
+                               landing.gecko_integration_branch().split("/", 1)[1]))
         except git.GitCommandError as e:
-            changes = landing.git_gecko.remotes.mozilla.fetch()
+            with RepoLock(landing.git_gecko):
+                changes = landing.git_gecko.remotes.mozilla.fetch()
             err = "Pushing update to remote failed:\n%s" % e
             if not changes:
                 logger.error(err)
@@ -784,43 +849,55 @@ def load_sync_point(git_gecko, git_wpt):
 
 
 def unlanded_wpt_commits_by_pr(git_gecko, git_wpt, prev_wpt_head, wpt_head="origin/master"):
-    revish = "%s..%s" % (prev_wpt_head, wpt_head)
+    """Get the wpt commits between prev_wpt_head and wpt_head grouped by PR.
 
-    commits_by_pr = []
-    index_by_pr = {}
+    :returns: List of (pr, [WptCommit]) in the order that the PRs were last
+              merged. For a merge commit, the commits it merged that belong
+              to the same PR come before the merge commit itself."""
+    pygit2_repo = pygit2_get(git_wpt)
     legacy_sync_re = re.compile(r"Merge pull request \#\d+ from w3c/sync_[0-9a-fA-F]+")
+    sort = pygit2.GIT_SORT_TOPOLOGICAL | pygit2.GIT_SORT_TIME | pygit2.GIT_SORT_REVERSE
 
-    for commit in git_wpt.iter_commits(revish,
-                                       reverse=True,
-                                       first_parent=True):
-        commit = sync_commit.WptCommit(git_wpt, commit.hexsha)
+    walker = pygit2_repo.walk(pygit2_repo.revparse_single(wpt_head).peel(pygit2.Commit).id,
+                              sort)
+    walker.hide(pygit2_repo.revparse_single(prev_wpt_head).peel(pygit2.Commit).id)
+    walker.simplify_first_parent()
+
+    commits = []
+    merged_commits = {}
+    for pygit2_commit in walker:
+        commit = sync_commit.WptCommit(git_wpt, pygit2_commit)
         if legacy_sync_re.match(commit.msg):
             continue
+        commits.append(commit)
+        # If we have a merge commit, also get the commits merged in i.e. those
+        # reachable from the merge but not from its first parent
+        if len(pygit2_commit.parent_ids) > 1:
+            merged_walker = pygit2_repo.walk(pygit2_commit.id, sort)
+            merged_walker.hide(pygit2_commit.parent_ids[0])
+            merged_commits[commit.sha1] = [sync_commit.WptCommit(git_wpt, item)
+                                           for item in merged_walker
+                                           if item.id != pygit2_commit.id]
+
+    # Look up the PRs for all the commits at once
+    sync_commit.resolve_prs(git_wpt,
+                            commits + [item for merged in merged_commits.itervalues()
+                                       for item in merged])
+
+    # Map of pr to commits, ordered by the last time the PR was merged
+    commits_by_pr = OrderedDict()
+    for commit in commits:
         pr = commit.pr()
-        extra_commits = []
-        if pr not in index_by_pr:
-            pr_data = (pr, [])
-            # If we have a merge commit, also get the commits merged in
-            if len(commit.commit.parents) > 1:
-                merged_revish = "%s..%s" % (commit.commit.parents[0].hexsha, commit.sha1)
-                for merged_commit in git_wpt.iter_commits(merged_revish,
-                                                          reverse=True):
-                    if merged_commit.hexsha != commit.sha1:
-                        wpt_commit = sync_commit.WptCommit(git_wpt, merged_commit.hexsha)
-                        if wpt_commit.pr() == pr:
-                            extra_commits.append(wpt_commit)
+        if pr in commits_by_pr:
+            # Move the PR to the end
+            pr_commits = commits_by_pr.pop(pr)
         else:
-            idx = index_by_pr[pr]
-            pr_data = commits_by_pr.pop(idx)
-            assert pr_data[0] == pr
-            index_by_pr = {key: (value if value < idx else value - 1)
-                           for key, value in index_by_pr.iteritems()}
-        for c in extra_commits + [commit]:
-            pr_data[1].append(c)
-        commits_by_pr.append(pr_data)
-        index_by_pr[pr] = len(commits_by_pr) - 1
+            pr_commits = [item for item in merged_commits.get(commit.sha1, [])
+                          if item.pr() == pr]
+        pr_commits.append(commit)
+        commits_by_pr[pr] = pr_commits
 
-    return commits_by_pr
+    return commits_by_pr.items()
 
 
 def landable_commits(git_gecko, git_wpt, prev_wpt_head, wpt_head=None, include_incomplete=False):
@@ -908,9 +985,10 @@ def current(git_gecko, git_wpt):
 @entry_point("landing")
 def wpt_push(git_gecko, git_wpt, commits, create_missing=True):
     prs = set()
+    commits = [sync_commit.WptCommit(git_wpt, commit) for commit in commits]
+    # This causes the PRs to be recorded as notes
+    sync_commit.resolve_prs(git_wpt, commits)
     for commit in commits:
-        # This causes the PR to be recorded as a note
-        commit = sync_commit.WptCommit(git_wpt, commit)
         pr = commit.pr()
         pr = int(pr) if pr else None
         if pr is not None and not upstream.UpstreamSync.has_metadata(commit.msg):
@@ -1,9 +1,13 @@
+import errno
+import fcntl
 import inspect
 import os
+import time
 
 import filelock
 
 import log
+import lockstats
 from env import Environment
 
 env = Environment()
@@ -112,6 +116,7 @@ class Lock(object):
     def __init__(self, *args):
         self.path = self.lock_path(*args)
         self.lock = filelock.FileLock(self.path)
+        self.acquired_at = None
 
     def __enter__(self):
         if self.path in self.locks:
@@ -119,25 +124,46 @@ class Lock(object):
             # then locking again is a no-op
             return self.locks[self.path]
         self.locks[self.path] = self
-        self.lock.acquire()
+        self._acquire()
         return self
 
+    def _acquire(self, **kwargs):
+        start = time.time()
+        try:
+            self.lock.acquire(**kwargs)
+        finally:
+            lockstats.stats.record("wait", self, time.time() - start)
+        self.acquired_at = time.time()
+
     def __exit__(self, *args, **kwargs):
         if self.locks[self.path] != self:
             return
         del self.locks[self.path]
         self.lock.release()
+        if self.acquired_at is not None:
+            lockstats.stats.record("hold", self, time.time() - self.acquired_at)
+            self.acquired_at = None
 
     @staticmethod
     def lock_path(*args):
         """Return a path to the file representing the current lock"""
         raise NotImplementedError
 
+    @property
+    def stats_name(self):
+        """Name used to group timings for this lock in lock statistics"""
+        raise NotImplementedError
+
 
 class RepoLock(Lock):
     def __init__(self, repo):
+        self.repo_name = os.path.basename(repo.working_dir.rstrip(os.path.sep))
         super(RepoLock, self).__init__(repo)
 
+    @property
+    def stats_name(self):
+        return "repo/%s" % self.repo_name
+
     @staticmethod
     def lock_path(repo):
         return os.path.join(
@@ -146,13 +172,62 @@ class RepoLock(Lock):
             "%s.lock" % (repo.working_dir.replace(os.path.sep, "_"),))
 
 
+class FcntlLock(object):
+    """Exclusive file lock using flock(2).
+
+    This provides the subset of the filelock.FileLock interface that's used
+    by Lock, with an additional blocking argument to acquire."""
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    @property
+    def is_locked(self):
+        return self.fd is not None
+
+    def acquire(self, blocking=True):
+        assert self.fd is None
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, flags)
+                except IOError as e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        raise LockError("Lock %s is held by another process" % self.path)
+                    if e.errno != errno.EINTR:
+                        raise
+                else:
+                    break
+        except Exception:
+            os.close(fd)
+            raise
+        self.fd = fd
+
+    def release(self):
+        if self.fd is None:
+            return
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+
 class SyncLock(Lock):
     lock_per_type = {"landing", "upstream"}
     lock_per_obj = {"downstream"}
 
     locks = {}
 
-    def __init__(self, sync_type, obj_id):
+    # Functions called after a SyncLock is newly acquired by this process. These
+    # are used to discard cached state that could have been changed by the process
+    # that previously held the lock
+    acquire_hooks = []
+
+    def __init__(self, sync_type, obj_id, blocking=True):
         assert sync_type in self.lock_per_obj | self.lock_per_type
 
         if sync_type in self.lock_per_type:
@@ -162,17 +237,40 @@ class SyncLock(Lock):
             raise ValueError("%s must be locked over each object" % sync_type)
         self.sync_type = sync_type
         self.obj_id = obj_id
-        super(SyncLock, self).__init__(sync_type, obj_id)
+        self.blocking = blocking
+        self.path = self.lock_path(sync_type, obj_id)
+        self.lock = FcntlLock(self.path)
+        self.acquired_at = None
+
+    def __enter__(self):
+        if self.path in self.locks:
+            # If this is already locked by the current process
+            # then locking again is a no-op
+            return self.locks[self.path]
+        self.locks[self.path] = self
+        try:
+            self._acquire(blocking=self.blocking)
+        except Exception:
+            del self.locks[self.path]
+            raise
+        for hook in self.acquire_hooks:
+            hook(self)
+        return self
+
+    @property
+    def stats_name(self):
+        return "sync/%s" % self.sync_type
 
     @classmethod
-    def for_process(cls, process_name):
+    def for_process(cls, process_name, blocking=True):
         """Get the SyncLock for the provided ProcessName."""
         sync_type = process_name.subtype
         obj_id = process_name.obj_id if sync_type in cls.lock_per_obj else None
-        return cls(sync_type, obj_id)
+        return cls(sync_type, obj_id, blocking=blocking)
 
     def check(self, sync_type, obj_id):
-        """Check that the current lock is valid for the provided sync_type and obj_id"""
+        """Check that the current lock is valid for mutating objects with the
+        provided sync_type and obj_id"""
         if sync_type in self.lock_per_type:
             obj_id = None
         if not (sync_type == self.sync_type and
@@ -223,6 +321,8 @@ class MutGuard(object):
 
         self.took_lock = True
         self.instance._lock = self.lock
+        if hasattr(self.instance, "enter_mut"):
+            self.instance.enter_mut()
 
         for prop in self.props:
             if prop._lock is None:
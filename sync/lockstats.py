@@ -0,0 +1,144 @@
+"""Timing statistics for lock contention.
+
+Each time a RepoLock or SyncLock is acquired, the time spent waiting for
+it is recorded and, when it's released, the time it was held. Measurements
+are attributed to the lock and to the currently running task.
+
+Each measurement is reported as a New Relic custom metric and, if
+lock_stats.statsd is set to a host:port in the config, as a statsd timer.
+Aggregated statistics per (lock path, task) are periodically appended as
+a line of JSON to lock-stats.json in the logs directory; the interval in
+seconds is set by lock_stats.interval.
+"""
+
+import json
+import os
+import socket
+import time
+from collections import defaultdict
+
+import newrelic.agent
+
+import log
+from env import Environment
+
+env = Environment()
+
+logger = log.get_logger(__name__)
+
+
+class TimingStats(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def to_json(self):
+        return {"count": self.count,
+                "total": self.total,
+                "max": self.max,
+                "mean": self.total / self.count if self.count else 0.0}
+
+
+class LockStats(object):
+    default_interval = 300
+
+    def __init__(self):
+        self.task = None
+        self.task_totals = None
+        self.last_flush = time.time()
+        self._statsd = None
+        self.reset()
+
+    def reset(self):
+        # Map of (lock path, lock name, task name) to {"wait": TimingStats, "hold": TimingStats}
+        self.stats = defaultdict(lambda: {"wait": TimingStats(), "hold": TimingStats()})
+
+    def start_task(self, name):
+        """Start attributing lock timings to the task with the given name"""
+        self.task = name
+        self.task_totals = {"wait": 0.0, "hold": 0.0}
+
+    def set_task(self, name):
+        """Change the name that lock timings for the current task are attributed to"""
+        self.task = name
+
+    def end_task(self):
+        """Stop attributing lock timings to the current task.
+
+        :returns: Dict of the total {"wait": seconds, "hold": seconds} for the task"""
+        totals = self.task_totals
+        self.task = None
+        self.task_totals = None
+        self.maybe_flush()
+        return totals
+
+    def record(self, kind, lock, duration):
+        """Record a timing for a lock
+
+        :param kind: "wait" for the time taken to acquire the lock or "hold" for the
+                     time it was held.
+        :param lock: The Lock object.
+        :param duration: Time in seconds."""
+        task = self.task or "none"
+        self.stats[(lock.path, lock.stats_name, task)][kind].add(duration)
+        if self.task_totals is not None:
+            self.task_totals[kind] += duration
+
+        newrelic.agent.record_custom_metric("Custom/Lock/%s/%s" % (lock.stats_name, kind),
+                                            duration)
+        self.send_statsd("wptsync.lock.%s.%s.%s:%d|ms" %
+                         (lock.stats_name.replace("/", "."),
+                          task.replace(".", "_"),
+                          kind,
+                          duration * 1000))
+        self.maybe_flush()
+
+    def send_statsd(self, line):
+        address = env.config["lock_stats"].get("statsd")
+        if not address:
+            return
+        try:
+            if self._statsd is None:
+                self._statsd = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            host, port = address.rsplit(":", 1)
+            self._statsd.sendto(line, (host, int(port)))
+        except (socket.error, ValueError) as e:
+            logger.debug("Failed to send lock stats to statsd: %s" % e)
+
+    def maybe_flush(self):
+        interval = env.config["lock_stats"].get("interval", self.default_interval)
+        if time.time() - self.last_flush >= interval:
+            self.flush()
+
+    def flush(self):
+        """Append a JSON summary of the stats since the last flush to the stats file"""
+        now = time.time()
+        if self.stats:
+            summary = {"start": self.last_flush,
+                       "end": now,
+                       "pid": os.getpid(),
+                       "locks": [{"path": path,
+                                  "name": name,
+                                  "task": task,
+                                  "wait": timings["wait"].to_json(),
+                                  "hold": timings["hold"].to_json()}
+                                 for (path, name, task), timings in sorted(self.stats.items())]}
+            path = os.path.join(env.config["root"],
+                                env.config["paths"]["logs"],
+                                "lock-stats.json")
+            try:
+                with open(path, "a") as f:
+                    f.write(json.dumps(summary) + "\n")
+            except IOError as e:
+                logger.warning("Failed to write lock stats to %s: %s" % (path, e))
+        self.reset()
+        self.last_flush = now
+
+
+stats = LockStats()
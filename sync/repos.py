@@ -1,6 +1,8 @@
 import json
 import os
+import re
 import shutil
+import sqlite3
 import git
 import pygit2
 
@@ -83,28 +85,171 @@ class WptMetadata(GitSettings):
     fetch_args = ["origin", "master", "--no-tags"]
 
 
+class RevMap(object):
+    """Persistent bidirectional map between hg and git revisions.
+
+    The map is stored in a sqlite database in the repository's cache directory,
+    so it's shared between processes and survives across tasks. Since cinnabar
+    assigns each hg changeset a fixed git commit, entries never need to be
+    invalidated."""
+
+    # Maximum number of parameters in a single sqlite query
+    chunk_size = 500
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self):
+        # sqlite connections can't be shared with forked child processes
+        if self._conn is None or self._pid != os.getpid():
+            dir_name = os.path.dirname(self.path)
+            if not os.path.exists(dir_name):
+                try:
+                    os.makedirs(dir_name)
+                except OSError:
+                    if not os.path.isdir(dir_name):
+                        raise
+            conn = sqlite3.connect(self.path, timeout=60)
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS revs "
+                             "(hg TEXT PRIMARY KEY, git TEXT NOT NULL)")
+                conn.execute("CREATE INDEX IF NOT EXISTS revs_git ON revs (git)")
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def get_many(self, kind, revs):
+        """Look up a set of revisions in the map.
+
+        :param kind: Either "hg" or "git", the type of the revisions to look up.
+        :param revs: Iterable of full-length revisions.
+        :returns: Dict mapping each known revision in revs to the corresponding
+                  revision of the other kind."""
+        assert kind in ("hg", "git")
+        other = "git" if kind == "hg" else "hg"
+        revs = list(revs)
+        rv = {}
+        for i in xrange(0, len(revs), self.chunk_size):
+            chunk = revs[i:i + self.chunk_size]
+            query = "SELECT %s, %s FROM revs WHERE %s IN (%s)" % (kind, other, kind,
+                                                                  ",".join("?" * len(chunk)))
+            rv.update(self.conn.execute(query, chunk))
+        return rv
+
+    def add_many(self, pairs):
+        """Add entries to the map.
+
+        :param pairs: Iterable of (hg revision, git revision) pairs."""
+        pairs = list(pairs)
+        if not pairs:
+            return
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO revs (hg, git) VALUES (?, ?)", pairs)
+
+
 class Cinnabar(object):
     hg2git_cache = {}
     git2hg_cache = {}
 
+    cache_name = "cinnabar-revs.sqlite"
+    full_rev = re.compile("^[0-9a-f]{40}$")
+
     def __init__(self, repo):
         self.git = repo.git
+        self.rev_map = RevMap(cache_path(repo, self.cache_name))
 
     def hg2git(self, rev):
-        if rev not in self.hg2git_cache:
-            value = self.git.cinnabar("hg2git", rev)
-            if all(c == "0" for c in value):
-                raise ValueError("No git rev corresponding to hg rev %s" % rev)
-            self.hg2git_cache[rev] = value
-        return self.hg2git_cache[rev]
+        value = self._translate("hg", [rev])[rev]
+        if value is None:
+            raise ValueError("No git rev corresponding to hg rev %s" % rev)
+        return value
 
     def git2hg(self, rev):
-        if rev not in self.git2hg_cache:
-            value = self.git.cinnabar("git2hg", rev)
+        value = self._translate("git", [rev])[rev]
+        if value is None:
+            raise ValueError("No hg rev corresponding to git rev %s" % rev)
+        return value
+
+    def hg2git_many(self, revs):
+        """Translate a set of hg revisions to git, using at most one invocation
+        of git cinnabar.
+
+        :param revs: Iterable of hg revisions.
+        :returns: Dict mapping each hg revision to the corresponding git revision.
+        :raises ValueError: If any revision has no corresponding git revision."""
+        rv = self._translate("hg", revs)
+        missing = [rev for rev, value in rv.iteritems() if value is None]
+        if missing:
+            raise ValueError("No git rev corresponding to hg revs %s" % ", ".join(missing))
+        return rv
+
+    def git2hg_many(self, revs):
+        """Translate a set of git revisions to hg, using at most one invocation
+        of git cinnabar.
+
+        :param revs: Iterable of git revisions.
+        :returns: Dict mapping each git revision to the corresponding hg revision.
+        :raises ValueError: If any revision has no corresponding hg revision."""
+        rv = self._translate("git", revs)
+        missing = [rev for rev, value in rv.iteritems() if value is None]
+        if missing:
+            raise ValueError("No hg rev corresponding to git revs %s" % ", ".join(missing))
+        return rv
+
+    def _translate(self, kind, revs):
+        """Translate a set of revisions between hg and git.
+
+        Revisions are looked up in the in-process cache, then in the persistent
+        revision map, and any that remain are translated with a single
+        invocation of git cinnabar.
+
+        :param kind: Either "hg" or "git", the type of the input revisions.
+        :param revs: Iterable of revisions to translate.
+        :returns: Dict mapping each input revision to the corresponding revision
+                  of the other kind, or to None if there is no such revision."""
+        cache = self.hg2git_cache if kind == "hg" else self.git2hg_cache
+        rv = {}
+        missing = []
+        for rev in revs:
+            if rev in cache:
+                rv[rev] = cache[rev]
+            elif rev not in rv:
+                rv[rev] = None
+                missing.append(rev)
+
+        if not missing:
+            return rv
+
+        # Only full-length revisions are stored in the persistent map; anything else
+        # could be ambiguous or a symbolic name
+        full_revs = [rev for rev in missing if self.full_rev.match(rev)]
+        if full_revs:
+            stored = self.rev_map.get_many(kind, full_revs)
+            cache.update(stored)
+            rv.update(stored)
+            missing = [rev for rev in missing if rev not in stored]
+
+        if not missing:
+            return rv
+
+        command = "hg2git" if kind == "hg" else "git2hg"
+        values = self.git.cinnabar(command, *missing).split()
+        if len(values) != len(missing):
+            raise ValueError("Expected %d revisions from git cinnabar %s, got %d" %
+                             (len(missing), command, len(values)))
+        new_pairs = []
+        for rev, value in zip(missing, values):
             if all(c == "0" for c in value):
-                raise ValueError("No hg rev corresponding to git rev %s" % rev)
-            self.git2hg_cache[rev] = value
-        return self.git2hg_cache[rev]
+                continue
+            cache[rev] = value
+            rv[rev] = value
+            if self.full_rev.match(rev):
+                new_pairs.append((rev, value) if kind == "hg" else (value, rev))
+        self.rev_map.add_many(new_pairs)
+        return rv
 
 
 wrappers = {
@@ -122,3 +267,46 @@ def pygit2_get(repo):
 
 def wrapper_get(repo):
     return wrapper_map.get(repo)
+
+
+def common_dir(repo):
+    """Path to the git directory shared by a repository and all its worktrees"""
+    try:
+        with open(os.path.join(repo.git_dir, "commondir")) as f:
+            rel_path = f.read().strip()
+    except IOError:
+        return repo.git_dir
+    return os.path.normpath(os.path.join(repo.git_dir, rel_path))
+
+
+def cache_path(repo, name):
+    """Path to a file for locally cached data derived from a repository.
+
+    Cache files live in the repository's git directory so that they are
+    shared between processes and worktrees using the same repository, but
+    never pushed."""
+    return os.path.join(common_dir(repo), "wptsync-cache", name)
+
+
+def write_cache(path, data):
+    """Atomically replace the contents of a cache file with JSON-serialized data"""
+    dir_name = os.path.dirname(path)
+    if not os.path.exists(dir_name):
+        try:
+            os.makedirs(dir_name)
+        except OSError:
+            if not os.path.isdir(dir_name):
+                raise
+    tmp_path = "%s.%s.tmp" % (path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.rename(tmp_path, path)
+
+
+def read_cache(path):
+    """Read JSON data from a cache file, or None if it is missing or unreadable"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
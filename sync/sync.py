@@ -3,12 +3,15 @@ import itertools
 import traceback
 from collections import defaultdict
 
+import pygit2
+
 import bug
 import commit as sync_commit
 import log
 from base import BranchRefObject, IdentityMap, ProcessData, ProcessName, ProcessNameIndex
 from env import Environment
 from lock import MutGuard, mut, constructor
+from repos import pygit2_get
 from worktree import Worktree
 
 env = Environment()
@@ -48,6 +51,21 @@ class CommitFilter(object):
         :returns: List of commits to return"""
         return commits
 
+    def cache_key(self):
+        """Key identifying the filter's behaviour, used to cache the commits
+        it selects from a range, or None if the result can't be cached.
+
+        Subclasses must opt in to caching by overriding this, since their
+        result may depend on more than the commits in the range."""
+        return None
+
+
+class AllCommitsFilter(CommitFilter):
+    """Filter that selects every commit in a range"""
+
+    def cache_key(self):
+        return (self.__class__.__name__,)
+
 
 class CommitRange(object):
     """Range of commits in a specific repository.
@@ -57,6 +75,11 @@ class CommitRange(object):
     TODO:  Maybe just store the base branch name in the tag rather than making it
            an actual pointer since that works better with rebases.
     """
+    # Map of (git dir, base sha1, head sha1, commit class, filter key) to the
+    # sha1s of the filtered commits in that range
+    _cache = {}
+    max_cached = 64
+
     def __init__(self, repo, base, head_ref, commit_cls, commit_filter=None):
         self.repo = repo
 
@@ -74,6 +97,10 @@ class CommitRange(object):
         self._head_sha = None
         self._base_sha = None
 
+        # Cache for the files changed in this range, and the (base, head) it applies to
+        self._files_changed = None
+        self._files_changed_key = None
+
         self._lock = None
 
     def as_mut(self, lock):
@@ -116,32 +143,60 @@ class CommitRange(object):
             if (self.head.sha1 == self._head_sha and
                 self.base.sha1 == self._base_sha):
                 return self._commits
-        revish = "%s..%s" % (self.base.sha1, self.head.sha1)
-        commits = []
-        for git_commit in self.repo.iter_commits(revish,
-                                                 reverse=True,
-                                                 paths=self.commit_filter.path_filter()):
-            commit = self.commit_cls(self.repo, git_commit)
-            if not self.commit_filter.filter_commit(commit):
-                continue
-            commits.append(commit)
-        commits = self.commit_filter.filter_commits(commits)
+        head_sha = self.head.sha1
+        base_sha = self.base.sha1
+        filter_key = self.commit_filter.cache_key()
+        cache_key = ((self.repo.git_dir, base_sha, head_sha, self.commit_cls, filter_key)
+                     if filter_key is not None else None)
+        if cache_key is not None and cache_key in self._cache:
+            # Make new Commit objects so that we don't share cached data like notes
+            pygit2_repo = pygit2_get(self.repo)
+            commits = [self.commit_cls(self.repo, pygit2_repo[sha1])
+                       for sha1 in self._cache[cache_key]]
+        else:
+            commits = self.commit_filter.filter_commits(list(self.iter_commits()))
+            if cache_key is not None:
+                if len(self._cache) >= self.max_cached:
+                    self._cache.clear()
+                self._cache[cache_key] = [commit.sha1 for commit in commits]
         self._commits = commits
-        self._head_sha = self.head.sha1
-        self._base_sha = self.base.sha1
+        self._head_sha = head_sha
+        self._base_sha = base_sha
         return self._commits
 
+    def iter_commits(self):
+        """Iterate over the commits in the range, oldest first.
+
+        Commits are read with a pygit2 revwalk as they are needed, so callers
+        can stop early without reading the whole range. Commits that don't touch
+        the commit filter's path filter are skipped without being wrapped, and
+        the per-commit filter is applied, but not the filter on the full list
+        of commits."""
+        pygit2_repo = pygit2_get(self.repo)
+        paths = self.commit_filter.path_filter()
+        walker = pygit2_repo.walk(pygit2_repo[self.head.sha1].id,
+                                  pygit2.GIT_SORT_TOPOLOGICAL | pygit2.GIT_SORT_REVERSE)
+        walker.hide(pygit2_repo[self.base.sha1].id)
+        for pygit2_commit in walker:
+            if paths and not sync_commit.changes_paths(pygit2_repo, pygit2_commit, paths):
+                continue
+            commit = self.commit_cls(self.repo, pygit2_commit)
+            if not self.commit_filter.filter_commit(commit):
+                continue
+            yield commit
+
     @property
     def files_changed(self):
-        # We avoid using diffs because that's harder to get right in the face of merges
-        files = set()
-        for commit in self.commits:
-            commit_files = self.repo.git.show(commit.sha1, name_status=True, format="")
-            for item in commit_files.splitlines():
-                parts = item.split("\t")
-                for part in parts[1:]:
-                    files.add(part.strip())
-        return files
+        # We avoid diffing the whole range because that's harder to get right in the
+        # face of merges, and instead take the union of the files changed per commit
+        key = (self.base.sha1, self.head.sha1)
+        if self._files_changed is None or self._files_changed_key != key:
+            files = set()
+            for commit in self.commits:
+                files |= commit.files_changed()
+            self._files_changed = files
+            self._files_changed_key = key
+        return set(self._files_changed)
 
     @base.setter
     @mut()
@@ -242,29 +297,77 @@ class SyncProcess(object):
 
         self.process_name = process_name
 
-        self.data = SyncData(git_gecko, process_name)
+        # The data, commit ranges and worktrees are created when they are
+        # first used, so that syncs that are only loaded to read e.g. their status
+        # are cheap
+        self._data = None
+        self._gecko_commits = None
+        self._wpt_commits = None
+        self._gecko_worktree = None
+        self._wpt_worktree = None
 
-        self.gecko_commits = CommitRange(git_gecko,
-                                         self.data["gecko-base"],
-                                         BranchRefObject(git_gecko,
-                                                         self.process_name,
-                                                         commit_cls=sync_commit.GeckoCommit),
-                                         commit_cls=sync_commit.GeckoCommit,
-                                         commit_filter=self.gecko_commit_filter())
-        self.wpt_commits = CommitRange(git_wpt,
-                                       self.data["wpt-base"],
-                                       BranchRefObject(git_wpt,
-                                                       self.process_name,
-                                                       commit_cls=sync_commit.WptCommit),
-                                       commit_cls=sync_commit.WptCommit,
-                                       commit_filter=self.wpt_commit_filter())
+        # Hold onto indexes for the lifetime of the SyncProcess object
+        self._indexes = {ProcessNameIndex(git_gecko)}
 
-        self.gecko_worktree = Worktree(git_gecko, process_name)
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = SyncData(self.git_gecko, self.process_name)
+        return self._data
 
-        self.wpt_worktree = Worktree(git_wpt, process_name)
+    @property
+    def gecko_commits(self):
+        if self._gecko_commits is None:
+            head = BranchRefObject(self.git_gecko,
+                                   self.process_name,
+                                   commit_cls=sync_commit.GeckoCommit)
+            self._gecko_commits = CommitRange(self.git_gecko,
+                                              self.data["gecko-base"],
+                                              head,
+                                              commit_cls=sync_commit.GeckoCommit,
+                                              commit_filter=self.gecko_commit_filter())
+        return self._gecko_commits
 
-        # Hold onto indexes for the lifetime of the SyncProcess object
-        self._indexes = {ProcessNameIndex(git_gecko)}
+    @property
+    def wpt_commits(self):
+        if self._wpt_commits is None:
+            head = BranchRefObject(self.git_wpt,
+                                   self.process_name,
+                                   commit_cls=sync_commit.WptCommit)
+            self._wpt_commits = CommitRange(self.git_wpt,
+                                            self.data["wpt-base"],
+                                            head,
+                                            commit_cls=sync_commit.WptCommit,
+                                            commit_filter=self.wpt_commit_filter())
+        return self._wpt_commits
+
+    @property
+    def gecko_worktree(self):
+        if self._gecko_worktree is None:
+            self._gecko_worktree = Worktree(self.git_gecko, self.process_name)
+        return self._gecko_worktree
+
+    @property
+    def wpt_worktree(self):
+        if self._wpt_worktree is None:
+            self._wpt_worktree = Worktree(self.git_wpt, self.process_name)
+        return self._wpt_worktree
+
+    @classmethod
+    def load_many(cls, git_gecko, git_wpt, process_names):
+        """Get the syncs for several process names, reading the data for all of
+        them in a single pass over the sync data.
+
+        :returns: List of syncs in the same order as process_names"""
+        process_names = list(process_names)
+        data = SyncData.load_many(git_gecko, process_names)
+        rv = []
+        for process_name, sync_data in zip(process_names, data):
+            sync = cls(git_gecko, git_wpt, process_name)
+            if sync._data is None:
+                sync._data = sync_data
+            rv.append(sync)
+        return rv
 
     @classmethod
     def _cache_key(cls, git_gecko, git_wpt, process_name):
@@ -315,12 +418,11 @@ class SyncProcess(object):
             idx_key == (bug, list(statuses)[0])
         idx = index.BugIdIndex(git_gecko)
 
-        process_names = idx.get(idx_key)
-        for process_name in process_names:
-            if process_name.subtype == cls.sync_type:
-                sync = cls(git_gecko, git_wpt, process_name)
-                if sync.status in statuses:
-                    rv[sync.status].add(sync)
+        process_names = [process_name for process_name in idx.get(idx_key)
+                         if process_name.subtype == cls.sync_type]
+        for sync in cls.load_many(git_gecko, git_wpt, process_names):
+            if sync.status in statuses:
+                rv[sync.status].add(sync)
         if flat:
             rv = list(itertools.chain.from_iterable(rv.itervalues()))
         return rv
@@ -333,7 +435,7 @@ class SyncProcess(object):
         if seq_id is not None:
             process_names = {item for item in process_names
                              if item.seq_id == int(seq_id)}
-        return {cls(git_gecko, git_wpt, process_name) for process_name in process_names}
+        return set(cls.load_many(git_gecko, git_wpt, process_names))
 
     @classmethod
     def load_by_status(cls, git_gecko, git_wpt, status):
@@ -341,10 +443,7 @@ class SyncProcess(object):
         idx = index.SyncIndex(git_gecko)
         key = (cls.obj_type, cls.sync_type, status)
         process_names = idx.get(key)
-        rv = set()
-        for process_name in process_names:
-            rv.add(cls(git_gecko, git_wpt, process_name))
-        return rv
+        return set(cls.load_many(git_gecko, git_wpt, process_names))
 
     # End of getter methods
 
@@ -445,10 +544,10 @@ class SyncProcess(object):
         return env.config["gecko"]["refs"]["central"]
 
     def gecko_commit_filter(self):
-        return CommitFilter()
+        return AllCommitsFilter()
 
     def wpt_commit_filter(self):
-        return CommitFilter()
+        return AllCommitsFilter()
 
     @property
     def branch_name(self):
@@ -1,14 +1,13 @@
-import os
 import traceback
 import time
 
-import filelock
 import newrelic.agent
 
 import bug
 import env
 import gh
 import handlers
+import lockstats
 import log
 import repos
 import settings
@@ -20,35 +19,32 @@ logger = log.get_logger(__name__)
 
 handler_map = None
 
-_lock = None
 
+def with_lock_stats(f):
+    """Decorator for tasks that reports the time the task spent waiting for
+    and holding locks, and logs any exception.
 
-@settings.configure
-def setup_lock(config):
-    global _lock
-    if _lock is None:
-        path = os.path.join(config["root"], "sync.lock")
-        logger.info("Using lockfile at path %s" % path)
-        _lock = filelock.FileLock(path)
-
-
-def with_lock(f):
-    global _lock
+    Tasks don't hold any global lock; the handlers take the SyncLock for the
+    syncs they update, and RepoLock is only held around writes to the
+    repositories, so unrelated tasks can run concurrently."""
 
     def inner(*args, **kwargs):
-        if _lock is None:
-            setup_lock()
+        lockstats.stats.start_task(f.__name__)
+        start = time.time()
         try:
-            with _lock:
-                return f(*args, **kwargs)
-            # If some other task is waiting on the lock, give it a chance to
-            # run before this task completes. That means that manual commands
-            # will always  win over celery tasks, which we want
-            time.sleep(0.1)
+            return f(*args, **kwargs)
         except Exception as e:
             logger.error(str(unicode(e).encode("utf8")))
             logger.error("".join(traceback.format_exc(e)))
             raise
+        finally:
+            lock_times = lockstats.stats.end_task()
+            newrelic.agent.add_custom_parameter("lock_wait", lock_times["wait"])
+            newrelic.agent.add_custom_parameter("lock_hold", lock_times["hold"])
+            logger.info("Task %s waited %.2fs for locks and held them for %.2fs "
+                        "out of %.2fs total" %
+                        (f.__name__, lock_times["wait"], lock_times["hold"],
+                         time.time() - start))
     inner.__name__ = f.__name__
     inner.__doc__ = f.__doc__
     return inner
@@ -89,12 +85,13 @@ def setup(config):
 
 
 @worker.task(bind=True, max_retries=6, retry_backoff=60, retry_backoff_max=3840)
-@with_lock
+@with_lock_stats
 def handle(self, task, body):
     handlers = get_handlers()
     if task in handlers:
         logger.info("Running task %s" % task)
         newrelic.agent.add_custom_parameter("task", task)
+        lockstats.stats.set_task("handle.%s" % task)
         git_gecko, git_wpt = setup()
         try:
             handlers[task](git_gecko, git_wpt, body)
@@ -109,7 +106,7 @@ def handle(self, task, body):
 
 
 @worker.task(bind=True, max_retries=6, retry_backoff=60, retry_backoff_max=3840)
-@with_lock
+@with_lock_stats
 @settings.configure
 def land(self, config):
     git_gecko, git_wpt = setup()
@@ -120,7 +117,15 @@ def land(self, config):
 
 
 @worker.task
-@with_lock
+@with_lock_stats
+@settings.configure
+def fetch(config):
+    git_gecko, git_wpt = setup()
+    handlers.FetchHandler(config)(git_gecko, git_wpt)
+
+
+@worker.task
+@with_lock_stats
 @settings.configure
 def cleanup(config):
     git_gecko, git_wpt = setup()
@@ -128,7 +133,7 @@ def cleanup(config):
 
 
 @worker.task
-@with_lock
+@with_lock_stats
 @settings.configure
 def retrigger(config):
     git_gecko, git_wpt = setup()
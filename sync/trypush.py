@@ -16,7 +16,7 @@ import tree
 from env import Environment
 from index import TaskGroupIndex, TryCommitIndex
 from load import get_syncs
-from lock import constructor, mut
+from lock import RepoLock, constructor, mut
 from errors import AbortError, RetryableError
 from projectutil import Mach
 
@@ -153,7 +153,10 @@ class TryFuzzyCommit(TryCommit):
             args.extend(paths)
 
         try:
-            output = mach.try_(*args, stderr=subprocess.STDOUT)
+            # mach try pushes through cinnabar, which mustn't run concurrently with
+            # other cinnabar operations on the repository
+            with RepoLock(self.git_gecko):
+                output = mach.try_(*args, stderr=subprocess.STDOUT)
             return 0, output
         except subprocess.CalledProcessError as e:
             return e.returncode, e.output
@@ -186,7 +189,8 @@ class TryPush(base.ProcessData):
         TaskGroupIndex.get_or_create(sync.git_gecko)
         try_idx = TryCommitIndex.get_or_create(sync.git_gecko)
 
-        git_work = sync.gecko_worktree.get()
+        # Pushing to try runs mach try, which can read any part of the tree
+        git_work = sync.gecko_worktree.get(full=True)
 
         if rebuild_count is None:
             rebuild_count = 0 if not stability else env.config['gecko']['try']['stability_count']
@@ -227,8 +231,8 @@ class TryPush(base.ProcessData):
     @classmethod
     def load_all(cls, git_gecko):
         process_names = base.ProcessNameIndex(git_gecko).get("try")
-        for process_name in process_names:
-            yield cls(git_gecko, process_name)
+        for try_push in cls.load_many(git_gecko, process_names):
+            yield try_push
 
     @classmethod
     def for_commit(cls, git_gecko, sha1):
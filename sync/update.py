@@ -235,6 +235,8 @@ def update_from_github(git_gecko, git_wpt, sync_classes, statuses=None):
     if statuses is None:
         statuses = ["*"]
     update_repositories(git_gecko, git_wpt, True)
+    # This makes network requests and try pushes for each sync, so the updates
+    # are committed separately rather than in a transaction that holds the RepoLock
     for cls in sync_classes:
         for status in statuses:
             if status != "*" and status not in cls.statuses:
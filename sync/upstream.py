@@ -13,10 +13,10 @@ from base import entry_point
 from downstream import DownstreamSync
 from errors import AbortError
 from env import Environment
-from gitutils import update_repositories, gecko_repo
+from gitutils import ReachableSet, update_repositories, gecko_repo
 from gh import AttrDict
-from lock import SyncLock, constructor, mut
-from sync import CommitFilter, LandableStatus, SyncProcess, CommitRange
+from lock import RepoLock, SyncLock, constructor, mut
+from sync import AllCommitsFilter, CommitFilter, LandableStatus, SyncProcess, CommitRange
 from repos import pygit2_get
 
 env = Environment()
@@ -47,9 +47,17 @@ class BackoutCommitFilter(CommitFilter):
             return True
         return False
 
+    def path_filter(self):
+        # Only commits that change wpt are synced, and backouts of those commits
+        # must also change wpt
+        return [env.config["gecko"]["path"]["wpt"]]
+
     def filter_commits(self, commits):
         return remove_complete_backouts(commits)
 
+    def cache_key(self):
+        return (self.__class__.__name__, self.bug)
+
 
 class UpstreamSync(SyncProcess):
     sync_type = "upstream"
@@ -82,7 +90,7 @@ class UpstreamSync(SyncProcess):
                                             wpt_head=wpt_head,
                                             bug=bug,
                                             status=status)
-        with self.as_mut(lock):
+        with self.as_mut(lock), sync_commit.NotesSession(git_gecko):
             for commit in self.gecko_commits:
                 commit.set_upstream_sync(self)
         return self
@@ -199,12 +207,13 @@ class UpstreamSync(SyncProcess):
     def upstreamed_gecko_commits(self):
         if (self._upstreamed_gecko_commits is None or
             self._upstreamed_gecko_head != self.wpt_commits.head.sha1):
+            hg_revs = [wpt_commit.metadata["gecko-commit"]
+                       for wpt_commit in self.wpt_commits
+                       if "gecko-commit" in wpt_commit.metadata]
+            git_shas = self.git_gecko.cinnabar.hg2git_many(hg_revs)
             self._upstreamed_gecko_commits = [
-                sync_commit.GeckoCommit(self.git_gecko,
-                                        self.git_gecko.cinnabar.hg2git(
-                                            wpt_commit.metadata["gecko-commit"]))
-                for wpt_commit in self.wpt_commits
-                if "gecko-commit" in wpt_commit.metadata]
+                sync_commit.GeckoCommit(self.git_gecko, git_shas[hg_rev])
+                for hg_rev in hg_revs]
             self._upstreamed_gecko_head = self.wpt_commits.head.sha1
         return self._upstreamed_gecko_commits
 
@@ -250,8 +259,9 @@ class UpstreamSync(SyncProcess):
     def gecko_landed(self):
         if not len(self.gecko_commits):
             return False
-        landed = [self.git_gecko.is_ancestor(commit.sha1, env.config["gecko"]["refs"]["central"])
-                  for commit in self.gecko_commits]
+        central_commits = ReachableSet.for_rev(self.git_gecko,
+                                               env.config["gecko"]["refs"]["central"])
+        landed = [commit.sha1 in central_commits for commit in self.gecko_commits]
         if not all(item == landed[0] for item in landed):
             logger.warning("Got some commits landed and some not for upstream sync %s" %
                            self.branch_name)
@@ -320,10 +330,11 @@ class UpstreamSync(SyncProcess):
     def push_commits(self):
         remote_branch = self.get_or_create_remote_branch()
         logger.info("Pushing commits from bug %s to branch %s" % (self.bug, remote_branch))
-        push_info = self.git_wpt.remotes.origin.push("refs/heads/%s:%s" %
-                                                     (self.branch_name, remote_branch),
-                                                     force=True,
-                                                     set_upstream=True)
+        with RepoLock(self.git_wpt):
+            push_info = self.git_wpt.remotes.origin.push("refs/heads/%s:%s" %
+                                                         (self.branch_name, remote_branch),
+                                                         force=True,
+                                                         set_upstream=True)
         for item in push_info:
             if item.flags & item.ERROR:
                 raise AbortError(item.summary)
@@ -448,7 +459,8 @@ class UpstreamSync(SyncProcess):
         if status in ("wpt-merged", "complete") and self.remote_branch:
             # Delete the remote branch after a merge
             try:
-                self.git_wpt.remotes.origin.push(self.remote_branch, delete=True)
+                with RepoLock(self.git_wpt):
+                    self.git_wpt.remotes.origin.push(self.remote_branch, delete=True)
             except git.GitCommandError:
                 pass
             else:
@@ -518,7 +530,8 @@ class UpstreamSync(SyncProcess):
         # Create a CommitRange object and return it
         base = sync_commit.WptCommit(self.git_wpt, merge_base)
         head_ref = AttrDict({'commit': pr_head})
-        return CommitRange(self.git_wpt, base, head_ref, sync_commit.WptCommit, CommitFilter())
+        return CommitRange(self.git_wpt, base, head_ref, sync_commit.WptCommit,
+                           AllCommitsFilter())
 
 
 def commit_message_filter(msg):
@@ -750,7 +763,7 @@ def update_sync_heads(lock, syncs_by_bug):
             # TODO: Create a new sync with a non-zero seq-id in this case
             raise ValueError("Tried to modify a closed sync for bug %s with commit %s" %
                              (bug, commit.canonical_rev))
-        with sync.as_mut(lock):
+        with sync.as_mut(lock), sync_commit.NotesSession(sync.git_gecko):
             sync.gecko_commits.head = commit
             for commit in sync.gecko_commits:
                 commit.set_upstream_sync(sync)
@@ -7,6 +7,11 @@ beat_schedule = {
         "task": "sync.tasks.retrigger",
         "schedule": crontab(hour=8, minute=0),
     },
+    # Handlers only fetch the refs they need, so fetch everything periodically
+    'fetch': {
+        "task": "sync.tasks.fetch",
+        "schedule": 600,
+    },
     # Try to cleanup once an hour
     'cleanup': {
         "task": "sync.tasks.cleanup",
@@ -1,5 +1,6 @@
 import os
 import shutil
+import sys
 import traceback
 from datetime import datetime, timedelta
 
@@ -9,7 +10,7 @@ import pygit2
 import log
 from base import ProcessName
 from env import Environment
-from lock import MutGuard, SyncLock, mut
+from lock import LockError, MutGuard, RepoLock, SyncLock, mut
 from repos import pygit2_get, wrapper_get
 
 
@@ -21,10 +22,15 @@ logger = log.get_logger(__name__)
 def cleanup(git_gecko, git_wpt):
     for repo in [git_gecko, git_wpt]:
         pygit2_repo = pygit2_get(repo)
-        cleanup_repo(pygit2_repo, get_max_worktree_count(repo))
+        pool = WorktreePool(repo)
+        cleanup_repo(pygit2_repo, get_max_worktree_count(repo), pool=pool)
+        pool.reap_staging()
+        pool.refresh()
+        if pool.prewarm:
+            pool.fill()
 
 
-def cleanup_repo(pygit2_repo, max_count=None):
+def cleanup_repo(pygit2_repo, max_count=None, pool=None):
     # TODO: Always cleanup repos where the sync is finished
     prune_worktrees(pygit2_repo)
     unprunable = []
@@ -36,13 +42,18 @@ def cleanup_repo(pygit2_repo, max_count=None):
             worktree.prune(True)
             continue
 
-        process_name = ProcessName.from_tuple(worktree.name.split("-"))
+        if WorktreePool.is_pool_path(worktree.path):
+            continue
+
+        # Worktrees are identified by path, since git worktree move doesn't change
+        # the name of a worktree
+        sync_key = sync_for_path(worktree.path)
 
         worktree_data = (datetime.fromtimestamp(os.stat(worktree.path).st_mtime),
-                         process_name,
+                         sync_key,
                          worktree)
 
-        if process_name is None:
+        if sync_key is None:
             logger.warning("Worktree doesn't correspond to a sync %s" % worktree.path)
             unprunable.append(worktree_data)
             continue
@@ -64,7 +75,7 @@ def cleanup_repo(pygit2_repo, max_count=None):
             maybe_prunable.append(worktree_data)
             continue
 
-        if branch_process_name != process_name:
+        if (branch_process_name.subtype, str(branch_process_name.obj_id)) != sync_key:
             logger.warning("Head branch doesn't match worktree %s" % worktree.path)
             maybe_prunable.append(worktree_data)
             continue
@@ -81,23 +92,42 @@ def cleanup_repo(pygit2_repo, max_count=None):
 
     prunable.sort()
     maybe_prunable.sort()
-    for time, process_name, worktree in (prunable + maybe_prunable):
+    for time, (sync_type, obj_id), worktree in (prunable + maybe_prunable):
         if time < (now - timedelta(days=2)):
             logger.info("Removing worktree without recent activity %s" % worktree.path)
-            delete_worktree(process_name, worktree)
+            delete_worktree(sync_type, obj_id, worktree, pool=pool)
             delete_count -= 1
         elif delete_count > 0:
             logger.info("Removing LRU worktree %s" % worktree.path)
-            delete_worktree(process_name, worktree)
+            delete_worktree(sync_type, obj_id, worktree, pool=pool)
             delete_count -= 1
         else:
             break
 
 
-def delete_worktree(process_name, worktree):
+def delete_worktree(sync_type, obj_id, worktree, pool=None):
+    """Remove the worktree for a sync, or return it to the pool if pool is provided
+    and has space."""
     assert worktree.path.startswith(os.path.join(env.config["root"],
                                                  env.config["paths"]["worktrees"]))
-    with SyncLock.for_process(process_name):
+    # Don't wait for the lock; if another process holds it the worktree is in use,
+    # and waiting whilst holding a different SyncLock could deadlock
+    lock = SyncLock(sync_type,
+                    obj_id if sync_type in SyncLock.lock_per_obj else None,
+                    blocking=False)
+    try:
+        lock.__enter__()
+    except LockError:
+        logger.info("Not removing worktree %s as it is in use" % worktree.path)
+        return
+    try:
+        if pool is not None:
+            try:
+                if pool.recycle(worktree):
+                    return
+            except Exception:
+                logger.warning("Failed to return worktree %s to the pool:%s" %
+                               (worktree.path, traceback.format_exc()))
         try:
             logger.info("Deleting path %s" % worktree.path)
             shutil.rmtree(worktree.path)
@@ -107,6 +137,8 @@ def delete_worktree(process_name, worktree):
         else:
             logger.info("Removed worktree %s" % (worktree.path,))
         worktree.prune(True)
+    finally:
+        lock.__exit__(None, None, None)
 
 
 def worktrees(pygit2_repo):
@@ -114,6 +146,25 @@ def worktrees(pygit2_repo):
         yield pygit2_repo.lookup_worktree(name)
 
 
+def worktree_for_path(pygit2_repo, path):
+    """Get the pygit2 Worktree checked out at path, or None if there isn't one"""
+    path = os.path.abspath(path)
+    for worktree in worktrees(pygit2_repo):
+        if os.path.abspath(worktree.path) == path:
+            return worktree
+    return None
+
+
+def sync_for_path(path):
+    """Get the (sync_type, obj_id) of the sync whose worktree is at path, or None
+    if the path isn't a sync worktree path"""
+    root = os.path.abspath(os.path.join(env.config["root"], env.config["paths"]["worktrees"]))
+    parts = os.path.relpath(os.path.abspath(path), root).split(os.path.sep)
+    if len(parts) != 3 or parts[1] not in SyncLock.lock_per_obj | SyncLock.lock_per_type:
+        return None
+    return parts[1], parts[2]
+
+
 def prune_worktrees(pygit2_repo):
     for worktree in worktrees(pygit2_repo):
         # For some reason libgit2 thinks worktrees are not prunable when their
@@ -137,6 +188,250 @@ def get_max_worktree_count(repo):
     return max_count
 
 
+def get_sparse_paths(repo):
+    """Get the list of sparse checkout patterns configured for worktrees of a repo,
+    or None if worktrees should have a full checkout"""
+    repo_wrapper = wrapper_get(repo)
+    if not repo_wrapper:
+        return None
+    value = env.config[repo_wrapper.name]["worktree"].get("sparse")
+    if not value:
+        return None
+    paths = [item.strip() for item in value.split(",")]
+    return [item for item in paths if item] or None
+
+
+def _sparse_checkout_path(pygit2_repo, worktree_name):
+    return os.path.join(pygit2_repo.path, "worktrees", worktree_name, "info", "sparse-checkout")
+
+
+def _write_sparse_paths(pygit2_repo, worktree_name, paths):
+    path = _sparse_checkout_path(pygit2_repo, worktree_name)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "w") as f:
+        f.write("".join("%s\n" % item for item in paths))
+
+
+def _enable_sparse_checkout(repo, path):
+    """Turn on sparse checkout for the worktree at path.
+
+    core.sparseCheckout is set in the worktree's own config file, which needs
+    extensions.worktreeConfig; setting it in the shared config would also affect
+    the main checkout and every other worktree."""
+    repo.git.config("extensions.worktreeConfig", "true")
+    git.Repo(path).git.config("core.sparseCheckout", "true", worktree=True)
+
+
+class WorktreePool(object):
+    """Pool of idle worktrees that are used instead of creating new worktrees.
+
+    Idle worktrees have a detached HEAD at a recent commit of the configured pool
+    ref, so switching one to a sync branch only has to update the files that
+    differ. When a sync worktree is cleaned up it's returned to the pool rather
+    than deleted if the pool isn't full.
+
+    This is configured per repository with the following options:
+    worktree.pool-size - Maximum number of idle worktrees (0 disables the pool)
+    worktree.pool-ref - Ref that idle worktrees are checked out at
+    worktree.pool-prewarm - Create new worktrees to fill the pool during cleanup
+
+    Only changes to the worktree metadata are made under the RepoLock. Idle
+    worktrees are moved out of the pool into a staging directory whilst they
+    are checked out, so that they can't be leased in the meantime.
+
+    Worktrees are moved with git worktree move, which keeps their names, so
+    pooled worktrees are identified by their path.
+
+    A worktree that has been in the staging directory for longer than
+    staging_timeout was left there by a process that didn't finish with it, and
+    is removed during cleanup.
+    """
+
+    prefix = "pool-"
+    dir_name = "pool"
+    staging_dir_name = "pool-staging"
+    staging_timeout = timedelta(hours=6)
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.pygit2_repo = pygit2_get(repo)
+        repo_wrapper = wrapper_get(repo)
+        config = env.config[repo_wrapper.name]["worktree"] if repo_wrapper else {}
+        self.size = int(config.get("pool-size", 0) or 0)
+        self.ref = config.get("pool-ref") or None
+        self.prewarm = bool(config.get("pool-prewarm", False))
+        self.root = os.path.join(env.config["root"],
+                                 env.config["paths"]["worktrees"],
+                                 os.path.basename(repo.working_dir),
+                                 self.dir_name)
+        self.staging = os.path.join(env.config["root"],
+                                    env.config["paths"]["worktrees"],
+                                    os.path.basename(repo.working_dir),
+                                    self.staging_dir_name)
+
+    @property
+    def enabled(self):
+        return self.size > 0 and self.ref is not None
+
+    @classmethod
+    def is_pool_path(cls, path):
+        """Check if path is the path of a worktree belonging to a pool"""
+        return (os.path.basename(os.path.dirname(os.path.abspath(path))) in
+                (cls.dir_name, cls.staging_dir_name))
+
+    def idle(self):
+        """List of idle pygit2 Worktrees in the pool"""
+        return [worktree for worktree in worktrees(self.pygit2_repo)
+                if (os.path.dirname(os.path.abspath(worktree.path)) ==
+                    os.path.abspath(self.root) and
+                    os.path.exists(worktree.path))]
+
+    def _head_commit(self):
+        return self.pygit2_repo.revparse_single(self.ref).peel(pygit2.Commit).hex
+
+    def _next_name(self):
+        existing = set()
+        for path in [self.root, self.staging]:
+            if os.path.exists(path):
+                existing |= set(os.listdir(path))
+        i = 0
+        while "%s%i" % (self.prefix, i) in existing:
+            i += 1
+        return "%s%i" % (self.prefix, i)
+
+    def _move(self, worktree, path):
+        """Move a worktree to a new path, updating the worktree metadata"""
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.repo.git.worktree("move", worktree.path, path)
+        # Moving doesn't update the mtime, which is used to find abandoned staging worktrees
+        os.utime(path, None)
+        return worktree_for_path(self.pygit2_repo, path)
+
+    def lease(self, path, branch):
+        """Take an idle worktree from the pool and switch it to a sync branch.
+
+        :param path: Path for the leased worktree
+        :param branch: Name of the branch to check out
+        :returns: The pygit2 Worktree, or None if the pool is empty"""
+        if not self.enabled:
+            return None
+        with RepoLock(self.repo):
+            idle = self.idle()
+            if not idle:
+                return None
+            worktree = self._move(idle[0], path)
+        # The checkout happens under the sync's SyncLock, which the caller holds
+        logger.info("Using pooled worktree for %s" % path)
+        work_git = git.Repo(path).git
+        work_git.symbolic_ref("HEAD", "refs/heads/%s" % branch)
+        work_git.reset(hard=True)
+        return worktree
+
+    def _reset_to_ref(self, path, commit):
+        work_git = git.Repo(path).git
+        work_git.reset(hard=True)
+        work_git.clean(f=True, d=True, x=True)
+        work_git.checkout(commit, detach=True)
+
+    def _remove(self, worktree):
+        logger.info("Removing pooled worktree %s" % worktree.path)
+        shutil.rmtree(worktree.path, ignore_errors=True)
+        worktree.prune(True)
+
+    def reap_staging(self):
+        """Remove worktrees that were left in the staging directory by a process
+        that failed before moving them back into the pool"""
+        if not os.path.exists(self.staging):
+            return
+        cutoff = datetime.now() - self.staging_timeout
+        with RepoLock(self.repo):
+            for name in os.listdir(self.staging):
+                path = os.path.join(self.staging, name)
+                if datetime.fromtimestamp(os.stat(path).st_mtime) >= cutoff:
+                    continue
+                logger.warning("Removing abandoned pool worktree %s" % path)
+                worktree = worktree_for_path(self.pygit2_repo, path)
+                if worktree is not None:
+                    self._remove(worktree)
+                else:
+                    shutil.rmtree(path, ignore_errors=True)
+
+    def recycle(self, worktree):
+        """Return a sync's worktree to the pool if there's space.
+
+        The caller must hold the SyncLock for the sync that owns the worktree.
+
+        :returns: True if the worktree was added to the pool"""
+        if not self.enabled:
+            return False
+        if len(self.idle()) >= self.size:
+            return False
+        logger.info("Returning worktree %s to the pool" % worktree.path)
+        self._reset_to_ref(worktree.path, self._head_commit())
+        with RepoLock(self.repo):
+            if len(self.idle()) >= self.size:
+                return False
+            self._move(worktree, os.path.join(self.root, self._next_name()))
+        return True
+
+    def refresh(self):
+        """Update idle worktrees in the pool to the current pool ref"""
+        if not self.enabled:
+            return
+        commit = self._head_commit()
+        for name in [os.path.basename(item.path) for item in self.idle()]:
+            path = os.path.join(self.root, name)
+            with RepoLock(self.repo):
+                worktree = worktree_for_path(self.pygit2_repo, path)
+                if (worktree is None or not os.path.exists(path) or
+                    pygit2.Repository(path).head.target.hex == commit):
+                    continue
+                worktree = self._move(worktree, os.path.join(self.staging, name))
+            logger.info("Updating pooled worktree %s to %s" % (name, commit))
+            try:
+                self._reset_to_ref(worktree.path, commit)
+            except Exception:
+                logger.warning("Failed to update pooled worktree %s:%s" %
+                               (name, traceback.format_exc()))
+                self._remove(worktree)
+                continue
+            with RepoLock(self.repo):
+                self._move(worktree, path)
+
+    def fill(self):
+        """Create new worktrees until the pool is full"""
+        if not self.enabled:
+            return
+        commit = self._head_commit()
+        sparse_paths = get_sparse_paths(self.repo)
+        for _ in xrange(self.size - len(self.idle())):
+            with RepoLock(self.repo):
+                name = self._next_name()
+                path = os.path.join(self.staging, name)
+                if os.path.exists(path):
+                    shutil.rmtree(path)
+                if not os.path.exists(self.staging):
+                    os.makedirs(self.staging)
+                logger.info("Creating pooled worktree %s" % name)
+                self.repo.git.worktree("add", "--detach", "--no-checkout", path, commit)
+                worktree = worktree_for_path(self.pygit2_repo, path)
+                if sparse_paths:
+                    _enable_sparse_checkout(self.repo, path)
+                    _write_sparse_paths(self.pygit2_repo, worktree.name, sparse_paths)
+            try:
+                git.Repo(path).git.read_tree("HEAD", m=True, u=True)
+            except Exception:
+                self._remove(worktree)
+                raise
+            with RepoLock(self.repo):
+                if len(self.idle()) >= self.size:
+                    self._remove(worktree)
+                    break
+                self._move(worktree, os.path.join(self.root, name))
+
+
 class Worktree(object):
     """Wrapper for accessing a git worktree for a specific process.
 
@@ -164,33 +459,38 @@ class Worktree(object):
         return (self.process_name.subtype, self.process_name.obj_id)
 
     @mut()
-    def get(self):
+    def get(self, full=False):
         """Return the worktree.
 
         On first access, the worktree is reset to the current HEAD. Subsequent
         access doesn't perform the same check, so it's possible to retain state
-        within a specific process."""
-        # TODO: We can get the worktree to only checkout the paths we actually
-        # need.
-        # To do this we have to
-        # * Enable sparse checkouts by setting core.sparseCheckouts
-        # * Add the worktree with --no-checkout
-        # * Add the list of paths to check out under $REPO/worktrees/info/sparse-checkout
-        # * Go to the worktree and check it out
+        within a specific process.
+
+        If the repository has worktree.sparse set in the config, new worktrees
+        only have the listed paths checked out.
+
+        :param full: Ensure that the worktree has all paths checked out, converting
+                     an existing sparse worktree if required. This is needed for
+                     operations that may touch any part of the tree."""
         if self._worktree is None:
-            all_worktrees = {item.name: item for item in worktrees(self.pygit2_repo)}
-            count = len(all_worktrees)
+            pool = WorktreePool(self.repo)
+            # Worktrees are identified by path, since git worktree move doesn't
+            # change the name of a worktree
+            all_worktrees = {os.path.abspath(item.path): item
+                             for item in worktrees(self.pygit2_repo)}
+            count = len([path for path in all_worktrees if not pool.is_pool_path(path)])
             max_count = get_max_worktree_count(self.repo)
             if max_count and count >= max_count:
-                cleanup_repo(self.pygit2_repo, max_count - 1)
+                cleanup_repo(self.pygit2_repo, max_count - 1, pool=pool)
 
-            path_exists = os.path.exists(self.path)
+            path = os.path.abspath(self.path)
+            path_exists = os.path.exists(path)
 
-            if self.worktree_name in all_worktrees and not path_exists:
+            if path in all_worktrees and not path_exists:
                 prune_worktrees(self.pygit2_repo)
-                del all_worktrees[self.worktree_name]
+                del all_worktrees[path]
 
-            if self.worktree_name not in all_worktrees:
+            if path not in all_worktrees:
                 if path_exists:
                     logger.warning("Found existing content in worktree path %s, removing" %
                                    self.path)
@@ -198,35 +498,140 @@ class Worktree(object):
                 logger.info("Creating worktree %s at %s" % (self.worktree_name, self.path))
                 if not os.path.exists(os.path.dirname(self.path)):
                     os.makedirs(os.path.dirname(self.path))
-                worktree = self.pygit2_repo.add_worktree(self.worktree_name,
-                                                         os.path.abspath(self.path),
-                                                         self.pygit2_repo.lookup_reference(
-                                                             "refs/heads/%s" % self.process_name))
+                sparse_paths = get_sparse_paths(self.repo) if not full else None
+                worktree = pool.lease(self.path, self.process_name)
+                if worktree is None:
+                    worktree = self._add_worktree(sparse_paths)
             else:
-                worktree = self.pygit2_repo.lookup_worktree(self.worktree_name)
+                worktree = all_worktrees[path]
 
             assert os.path.exists(self.path)
-            assert worktree.path == self.path
+            assert os.path.abspath(worktree.path) == path
             self._worktree = git.Repo(self.path)
         # TODO: In general the worktree should be on the right branch, but it would
         # be good to check. In the specific case of landing, we move the wpt worktree
         # around various commits, so it isn't necessarily on the correct branch
+        if full:
+            self.expand()
         return self._worktree
 
+    @property
+    def sparse_checkout_path(self):
+        worktree = worktree_for_path(self.pygit2_repo, self.path)
+        if worktree is None:
+            return None
+        return _sparse_checkout_path(self.pygit2_repo, worktree.name)
+
+    @property
+    def sparse_paths(self):
+        """List of sparse checkout patterns for the worktree, or None if it's a
+        full checkout"""
+        if self.sparse_checkout_path is None or not os.path.exists(self.sparse_checkout_path):
+            return None
+        with open(self.sparse_checkout_path) as f:
+            paths = [item.strip() for item in f]
+        paths = [item for item in paths if item]
+        if "/*" in paths:
+            return None
+        return paths
+
+    def _add_worktree(self, sparse_paths=None):
+        """Create the worktree, with only the paths matching sparse_paths checked out
+        if that's set.
+
+        Only adding the worktree metadata is done under the RepoLock; the checkout
+        happens under the SyncLock held by the caller. libgit2 checks out the files
+        when it adds a worktree, and doesn't support sparse checkouts, so the
+        worktree is created on a temporary branch pointing at an empty commit,
+        which doesn't check out anything. HEAD is then pointed at the sync branch
+        and git read-tree fills in the index and working tree, according to the
+        sparse-checkout file if there is one.
+
+        If the checkout fails the worktree is removed, so that a later call
+        doesn't reuse a partially checked out worktree."""
+        temp_ref = None
+        worktree = None
+        try:
+            with RepoLock(self.repo):
+                # A worktree moved out of the pool may already have this name
+                existing = set(self.pygit2_repo.list_worktrees())
+                name = self.worktree_name
+                i = 1
+                while name in existing:
+                    name = "%s-%i" % (self.worktree_name, i)
+                    i += 1
+
+                signature = self.pygit2_repo.default_signature
+                empty_tree = self.pygit2_repo.TreeBuilder().write()
+                empty_commit = self.pygit2_repo.create_commit(None, signature, signature,
+                                                              "Empty commit for worktree "
+                                                              "creation",
+                                                              empty_tree, [])
+                temp_ref = self.pygit2_repo.references.create("refs/heads/wptsync-init/%s" %
+                                                              self.worktree_name,
+                                                              empty_commit, force=True)
+                worktree = self.pygit2_repo.add_worktree(name,
+                                                         os.path.abspath(self.path),
+                                                         temp_ref)
+                if sparse_paths:
+                    _enable_sparse_checkout(self.repo, self.path)
+                    _write_sparse_paths(self.pygit2_repo, name, sparse_paths)
+            work_git = git.Repo(self.path).git
+            work_git.symbolic_ref("HEAD", "refs/heads/%s" % self.process_name)
+            work_git.read_tree("HEAD", m=True, u=True)
+        except Exception:
+            exc_info = sys.exc_info()
+            if worktree is not None:
+                self._remove_failed_worktree()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        finally:
+            if temp_ref is not None:
+                temp_ref.delete()
+        return worktree
+
+    def _remove_failed_worktree(self):
+        logger.warning("Removing partially created worktree %s" % self.path)
+        try:
+            with RepoLock(self.repo):
+                try:
+                    self.repo.git.worktree("remove", "--force", os.path.abspath(self.path))
+                except git.GitCommandError:
+                    shutil.rmtree(self.path, ignore_errors=True)
+                self.repo.git.worktree("prune")
+        except Exception:
+            logger.error("Failed to remove worktree %s:%s" % (self.path, traceback.format_exc()))
+
+    @mut()
+    def expand(self, paths=None):
+        """Check out additional paths in a sparse worktree.
+
+        Any uncommitted changes in the worktree's index are discarded.
+
+        :param paths: List of sparse checkout patterns to add, or None to convert the
+                      worktree to a full checkout."""
+        current_paths = self.sparse_paths
+        if current_paths is None:
+            return
+        if paths is None:
+            new_paths = ["/*"]
+        else:
+            new_paths = current_paths + [item for item in paths if item not in current_paths]
+            if new_paths == current_paths:
+                return
+        logger.info("Expanding sparse worktree %s to include %s" %
+                    (self.path, ", ".join(paths) if paths is not None else "all paths"))
+        _write_sparse_paths(self.pygit2_repo,
+                            worktree_for_path(self.pygit2_repo, self.path).name,
+                            new_paths)
+        git.Repo(self.path).git.read_tree("HEAD", m=True, u=True)
+
     @mut()
     def delete(self):
         if not os.path.exists(self.path):
             return
-        try:
-            worktree = self.pygit2_repo.lookup_worktree(self.worktree_name)
-        except Exception:
-            worktree = None
+        worktree = worktree_for_path(self.pygit2_repo, self.path)
         if worktree is None:
-            for worktree in worktrees(self.pygit2_repo):
-                if worktree.path == self.path:
-                    break
-            else:
-                # No worktree found
-                return
-        assert worktree.path == self.path
-        delete_worktree(self.process_name, worktree)
+            # No worktree found
+            return
+        delete_worktree(self.process_name.subtype, self.process_name.obj_id, worktree,
+                        pool=WorktreePool(self.repo))
@@ -1,21 +1,26 @@
 import copy
 import glob
 import io
+import itertools
 import json
 import os
 import random
 import shutil
 import subprocess
 import types
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from cStringIO import StringIO
 from mock import Mock, patch
 
 import git
+import pygit2
 import pytest
 import requests_mock
 
-from sync import repos, settings, bugcomponents, base, downstream, landing, trypush, tree, tc
+from sync import (repos, settings, bugcomponents, base, downstream, gitutils, landing, trypush,
+                  tree, tc)
+from sync import commit as sync_commit
+from sync.sync import CommitRange
 from sync.env import Environment, set_env, clear_env
 from sync.gh import AttrDict
 from sync.lock import SyncLock
@@ -108,6 +113,8 @@ def env(request, mock_mach, mock_wpt):
 
     def empty_caches():
         base.IdentityMap._cache.clear()
+        gitutils.PrRefMap._cache.clear()
+        CommitRange._cache.clear()
 
     request.addfinalizer(empty_caches)
 
@@ -489,6 +496,62 @@ def mock_try_push(git_gecko):
     return log
 
 
+@pytest.fixture
+def synthetic_wpt_history(env, git_wpt):
+    """Create a synthetic wpt history on top of origin/master.
+
+    The history contains a mixture of squash merged PRs, merge commits for
+    PRs with multiple commits, and follow-up commits for earlier PRs. The
+    commits are written directly with pygit2 so that large histories are
+    quick to create.
+
+    :returns: Function taking the number of PRs and returning (base sha1,
+              head sha1, expected result of unlanded_wpt_commits_by_pr as a
+              list of (pr, [sha1]))"""
+    def inner(pr_count, first_pr=1000):
+        git_wpt.remotes.origin.fetch()
+        pygit2_repo = repos.pygit2_get(git_wpt)
+        base = pygit2_repo.revparse_single("origin/master")
+        tree_id = base.tree.id
+        timestamps = itertools.count(base.commit_time + 1)
+        notes = {}
+
+        def commit(message, parents):
+            sig = pygit2.Signature("Test", "test@example.org", next(timestamps), 0)
+            return str(pygit2_repo.create_commit(None, sig, sig, message, tree_id, parents))
+
+        expected = OrderedDict()
+        head = str(base.id)
+        for i in xrange(pr_count):
+            pr = str(first_pr + i)
+            if i % 10 == 9:
+                # Follow-up change for an earlier PR, which moves that PR to the end
+                pr = str(first_pr + i - 5)
+                head = commit("Follow-up for PR %s" % pr, [head])
+                notes[head] = {"wpt_pr": pr}
+                pr_commits = expected.pop(pr)
+            elif i % 3 == 0:
+                head = commit("Squashed PR %s" % pr, [head])
+                pygit2_repo.create_reference("refs/tags/merge_pr_%s" % pr, head)
+                pr_commits = []
+            else:
+                pr_head = head
+                pr_commits = []
+                for j in xrange(2):
+                    pr_head = commit("PR %s commit %i" % (pr, j), [pr_head])
+                    notes[pr_head] = {"wpt_pr": pr}
+                    pr_commits.append(pr_head)
+                head = commit("Merge pull request #%s" % pr, [head, pr_head])
+                pygit2_repo.create_reference("refs/tags/merge_pr_%s" % pr, head)
+            pr_commits.append(head)
+            expected[pr] = pr_commits
+
+        sync_commit.write_notes(git_wpt, notes)
+        return str(base.id), head, expected.items()
+
+    return inner
+
+
 @pytest.fixture
 def directory(request, env):
     created = []
@@ -1,8 +1,12 @@
 import gc
+import json
+import os
 
+import git
+import pygit2
 import pytest
 
-from sync import base, sync
+from sync import base, repos, sync
 from sync.lock import SyncLock
 
 
@@ -50,3 +54,124 @@ def test_processname_idx_type(git_gecko, local_gecko_commit):
 
     assert idx.get("sync", "upstream", "1234") == {process_name}
     assert idx.get("sync", "upstream", 1234) == {process_name}
+
+
+def test_processname_idx_cache(env, git_gecko, local_gecko_commit):
+    first = base.ProcessName("sync", "upstream", "1234", "0")
+    with SyncLock("upstream", None) as lock:
+        sync.SyncData.create(lock, git_gecko, first, {"test": 1})
+
+    idx = base.ProcessNameIndex(git_gecko)
+    idx.reset()
+    idx.build()
+    assert idx.get("sync", "upstream", "1234") == {first}
+
+    path = repos.cache_path(git_gecko, base.ProcessNameIndex.cache_name)
+    assert os.path.exists(path)
+    with open(path) as f:
+        cached = json.load(f)
+    ref = git.Reference(git_gecko, env.config["sync"]["ref"])
+    assert cached["commit"] == ref.commit.hexsha
+    assert cached["names"] == [str(first)]
+
+    # Change the data without updating the index, as another process would
+    second = base.ProcessName("sync", "upstream", "5678", "0")
+    with base.CommitBuilder(git_gecko, "Update data",
+                            ref=env.config["sync"]["ref"]) as commit:
+        commit.add_tree({str(second): json.dumps({"test": 2})})
+        commit.delete([str(first)])
+
+    idx.reset()
+    idx.build()
+    assert idx.get("sync", "upstream") == {second}
+    with open(path) as f:
+        assert json.load(f)["names"] == [str(second)]
+
+
+def test_commit_builder_transaction(env, git_gecko, local_gecko_commit):
+    ref = git.Reference(git_gecko, env.config["sync"]["ref"])
+    initial_commit = ref.commit
+
+    with base.CommitBuilder(git_gecko, "Transaction\n", ref=ref.path,
+                            transaction=True) as transaction:
+        assert base.CommitBuilder.get_transaction(git_gecko, ref.path) is transaction
+        for obj_id in ["1", "2"]:
+            process_name = base.ProcessName("sync", "upstream", obj_id, "0")
+            with SyncLock("upstream", None) as lock:
+                data = sync.SyncData.create(lock, git_gecko, process_name, {"test": 1})
+                with data.as_mut(lock):
+                    data["test"] = 2
+
+        # Nothing is committed until the transaction exits, but reads see the changes
+        assert ref.commit == initial_commit
+        assert sync.SyncData(git_gecko, process_name)._load() == {"test": 2}
+
+    assert base.CommitBuilder.get_transaction(git_gecko, ref.path) is None
+    assert ref.commit.parents == (initial_commit,)
+    for obj_id in ["1", "2"]:
+        path = "sync/upstream/%s/0" % obj_id
+        assert json.load(ref.commit.tree[path].data_stream) == {"test": 2}
+
+
+def test_commit_builder_incremental_tree(env, git_gecko):
+    ref = git.Reference(git_gecko, env.config["sync"]["ref"])
+    with base.CommitBuilder(git_gecko, "Initial data", ref=ref.path) as commit:
+        commit.add_tree({"a/b/c": "data1",
+                         "a/d/e": "data2",
+                         "f/g": "data3"})
+    initial_tree = ref.commit.tree
+
+    with base.CommitBuilder(git_gecko, "Update data", ref=ref.path) as commit:
+        commit.add_tree({"a/b/h": "data4"})
+        commit.delete(["a/d/e"])
+        assert commit.read("a/b/h") == "data4"
+        assert commit.read("a/b/c") == "data1"
+        assert commit.read("a/d/e") is None
+    tree = ref.commit.tree
+
+    # Unchanged subtrees are reused and emptied directories are removed
+    assert tree["f"].binsha == initial_tree["f"].binsha
+    assert tree["a/b/c"].binsha == initial_tree["a/b/c"].binsha
+    assert tree["a/b/h"].data_stream.read() == "data4"
+    with pytest.raises(KeyError):
+        tree["a/d"]
+    assert tree["_metadata"].binsha == initial_tree["_metadata"].binsha
+
+
+def test_data_snapshot(env, git_gecko):
+    pygit2_repo = repos.pygit2_get(git_gecko)
+    ref_name = env.config["sync"]["ref"]
+    with base.CommitBuilder(git_gecko, "Initial data", ref=ref_name) as commit:
+        commit.add_tree({"a/b/c": "data1"})
+
+    with base.DataSnapshot(pygit2_repo) as snapshot:
+        assert base.DataSnapshot.get(pygit2_repo) is snapshot
+        with base.DataSnapshot(pygit2_repo) as inner:
+            assert inner is snapshot
+        assert base.DataSnapshot.get(pygit2_repo) is snapshot
+        assert snapshot.read("a/b/c") == "data1"
+        assert snapshot.tree("a/b") is not None
+        assert snapshot.tree("a/b/c") is None
+        assert snapshot.entry("a/d") is None
+
+        # A commit made outside this process isn't visible in the snapshot
+        initial_commit = snapshot.commit
+        ref = pygit2_repo.references[ref_name]
+        tree_builder = pygit2_repo.TreeBuilder(ref.peel().tree)
+        tree_builder.insert("x", pygit2_repo.create_blob("data2"), pygit2.GIT_FILEMODE_BLOB)
+        pygit2_repo.create_commit(ref_name,
+                                  pygit2_repo.default_signature,
+                                  pygit2_repo.default_signature,
+                                  "External commit",
+                                  tree_builder.write(),
+                                  [ref.peel().id])
+        assert snapshot.commit.id == initial_commit.id
+        assert snapshot.read("x") is None
+
+        # But commits made through a CommitBuilder are
+        with base.CommitBuilder(git_gecko, "Update data", ref=ref_name) as commit:
+            commit.add_tree({"a/b/c": "data3"})
+        assert snapshot.read("a/b/c") == "data3"
+        assert snapshot.read("x") == "data2"
+
+    assert pygit2_repo.path not in base.DataSnapshot._open
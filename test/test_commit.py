@@ -1,7 +1,13 @@
+import os
+
+import pygit2
 import pytest
 from mock import patch, PropertyMock
 
 from sync import commit as sync_commit
+from sync import repos
+from sync.gitutils import ReachableSet, gecko_repo
+from sync.lock import SyncLock
 
 
 def test_wpt_empty(git_gecko, local_gecko_commit):
@@ -20,6 +26,75 @@ def test_empty(git_gecko, gecko_worktree):
     assert gecko_commit.is_empty()
 
 
+def test_cinnabar_rev_map(git_gecko, upstream_gecko_commit):
+    rev = upstream_gecko_commit(other_changes={"example": "example change"})
+    git_gecko.remotes.mozilla.fetch()
+
+    repos.Cinnabar.hg2git_cache.clear()
+    repos.Cinnabar.git2hg_cache.clear()
+    git_rev = git_gecko.cinnabar.hg2git(rev)
+    rev_map = git_gecko.cinnabar.rev_map
+    assert rev_map.get_many("hg", [rev]) == {rev: git_rev}
+    assert rev_map.get_many("git", [git_rev]) == {git_rev: rev}
+
+    # With an empty in-process cache, lookups are served from the persistent map
+    repos.Cinnabar.hg2git_cache.clear()
+    repos.Cinnabar.git2hg_cache.clear()
+    with patch.object(git_gecko.git, "cinnabar", create=True) as cinnabar_cmd:
+        cinnabar = repos.Cinnabar(git_gecko)
+        assert cinnabar.git2hg(git_rev) == rev
+        assert cinnabar.hg2git(rev) == git_rev
+    assert not cinnabar_cmd.called
+
+
+def test_cinnabar_many(git_gecko, upstream_gecko_commit):
+    revs = [upstream_gecko_commit(other_changes={"example": "change %i" % i}) for i in range(3)]
+    git_gecko.remotes.mozilla.fetch()
+
+    git_revs = git_gecko.cinnabar.hg2git_many(revs)
+    assert sorted(git_revs.keys()) == sorted(revs)
+    assert git_gecko.cinnabar.git2hg_many(git_revs.values()) == {value: key for key, value
+                                                                 in git_revs.iteritems()}
+
+    with pytest.raises(ValueError):
+        git_gecko.cinnabar.hg2git_many(revs + ["0" * 40])
+
+
+def test_reachable_set(env, git_gecko, upstream_gecko_commit):
+    base = git_gecko.commit(env.config["gecko"]["refs"]["central"]).hexsha
+    revs = [upstream_gecko_commit(other_changes={"example": "change %i" % i},
+                                  bookmarks="mozilla/autoland") for i in range(3)]
+    git_gecko.remotes.mozilla.fetch()
+    git_revs = git_gecko.cinnabar.hg2git_many(revs)
+
+    central = ReachableSet.for_rev(git_gecko, env.config["gecko"]["refs"]["central"])
+    autoland = ReachableSet.for_rev(git_gecko, env.config["gecko"]["refs"]["autoland"])
+    assert ReachableSet.for_rev(git_gecko, env.config["gecko"]["refs"]["autoland"]) is autoland
+
+    assert base in central
+    for rev in revs:
+        assert git_revs[rev] not in central
+    assert git_revs[revs[1]] in autoland
+    # Commits above the queried commit are now known without another walk
+    assert git_revs[revs[2]] in autoland.reachable
+    assert git_revs[revs[0]] in autoland
+    assert base in autoland
+
+    assert gecko_repo(git_gecko, base) == "central"
+    assert gecko_repo(git_gecko, git_revs[revs[0]]) == "autoland"
+
+
+def test_files_changed(git_gecko, gecko_worktree, local_gecko_commit):
+    content = "\n".join("line %i" % i for i in range(20))
+    commit = local_gecko_commit(other_changes={"example": content, "other": "other"})
+    assert sync_commit.GeckoCommit(git_gecko, commit).files_changed() == {"example", "other"}
+
+    gecko_worktree.git.mv("example", "renamed")
+    gecko_worktree.git.commit(message="Rename example")
+    commit = sync_commit.GeckoCommit(git_gecko, gecko_worktree.head.commit)
+    assert commit.files_changed() == {"example", "renamed"}
+
+
 def test_move_utf16(git_gecko, git_wpt_upstream, git_wpt, wpt_worktree, local_gecko_commit):
     commit = local_gecko_commit(other_changes={"test_file": u"\U0001F60A".encode("utf16")})
     gecko_commit = sync_commit.GeckoCommit(git_gecko, commit)
@@ -35,6 +110,99 @@ def test_move_utf16(git_gecko, git_wpt_upstream, git_wpt, wpt_worktree, local_ge
                             stdout_as_string=False).decode("utf16") == u"\U0001F60A"
 
 
+def test_move_in_process(env, git_gecko, git_wpt, wpt_worktree, local_gecko_commit):
+    commit = local_gecko_commit(test_changes={"example/test.html": "Changed test\n",
+                                              "new_dir/new_file.html": "New file\n"},
+                                other_changes={"example": "Not moved\n"})
+    gecko_commit = sync_commit.GeckoCommit(git_gecko, commit)
+
+    git_wpt.remotes.origin.fetch()
+    git_wpt = wpt_worktree()
+    head = git_wpt.head.commit.hexsha
+
+    with patch("sync.commit.GeckoCommit.canonical_rev", PropertyMock()) as m:
+        m.return_value = gecko_commit.sha1
+        with patch("sync.commit._apply_patch") as apply_patch:
+            wpt_commit = gecko_commit.move(git_wpt,
+                                           src_prefix=env.config["gecko"]["path"]["wpt"],
+                                           metadata={"gecko-commit": gecko_commit.sha1})
+    assert not apply_patch.called
+
+    assert git_wpt.head.commit.hexsha == wpt_commit.sha1
+    assert wpt_commit.commit.parents[0].hexsha == head
+    assert wpt_commit.metadata["gecko-commit"] == gecko_commit.sha1
+    assert wpt_commit.files_changed() == {"example/test.html", "new_dir/new_file.html"}
+    assert not git_wpt.is_dirty(untracked_files=True)
+    with open(os.path.join(git_wpt.working_dir, "new_dir", "new_file.html")) as f:
+        assert f.read() == "New file\n"
+
+
+def test_resolve_prs(env, git_wpt, pull_request):
+    pr = pull_request([("First commit", {"README": "Example change 1\n"}),
+                       ("Second commit", {"README": "Example change 2\n"})])
+    git_wpt.remotes.origin.fetch()
+    head = git_wpt.commit("origin/pr/%s" % pr.number)
+    first = head.parents[0]
+    git_wpt.create_tag("merge_pr_1234", first.hexsha)
+    commits = [sync_commit.WptCommit(git_wpt, item.hexsha) for item in [first, head]]
+
+    with patch.object(env.gh_wpt, "pr_for_commit") as gh_pr_for_commit:
+        prs = sync_commit.resolve_prs(git_wpt, commits)
+    assert not gh_pr_for_commit.called
+    assert prs == {first.hexsha: "1234", head.hexsha: str(pr.number)}
+
+    # All the notes are written in a single commit
+    notes_commit = git_wpt.commit("refs/notes/commits")
+    assert len(notes_commit.parents) == 0
+    for sha1, commit_pr in prs.iteritems():
+        assert sync_commit.WptCommit(git_wpt, sha1).notes["wpt_pr"] == commit_pr
+    assert git_wpt.git.notes("show", head.hexsha) == "wpt_pr: %s" % pr.number
+
+
+def test_notes_session(git_gecko, local_gecko_commit):
+    commits = [sync_commit.GeckoCommit(git_gecko,
+                                       local_gecko_commit(other_changes={"example": "%i" % i}))
+               for i in range(3)]
+    commits[0].notes["existing"] = "value"
+    notes_head = git_gecko.commit("refs/notes/commits").hexsha
+
+    with sync_commit.NotesSession(git_gecko):
+        for i, commit in enumerate(commits):
+            commit.notes["index"] = str(i)
+        with sync_commit.NotesSession(git_gecko):
+            # Reads see the pending notes before they are written
+            commit = sync_commit.GeckoCommit(git_gecko, commits[1].sha1)
+            assert commit.notes["index"] == "1"
+        assert git_gecko.commit("refs/notes/commits").hexsha == notes_head
+
+    notes_commit = git_gecko.commit("refs/notes/commits")
+    assert [item.hexsha for item in notes_commit.parents] == [notes_head]
+    for i, commit in enumerate(commits):
+        notes = sync_commit.GeckoCommit(git_gecko, commit.sha1).notes
+        assert notes["index"] == str(i)
+    assert sync_commit.GeckoCommit(git_gecko, commits[0].sha1).notes["existing"] == "value"
+
+    # Notes are still written if the session exits with an exception, and only
+    # the updated keys replace those in the current note
+    with pytest.raises(ValueError):
+        with sync_commit.NotesSession(git_gecko):
+            sync_commit.GeckoCommit(git_gecko, commits[0].sha1).notes["index"] = "changed"
+            sync_commit.write_notes(git_gecko, {commits[0].sha1: {"other": "value"}})
+            raise ValueError
+    notes = sync_commit.GeckoCommit(git_gecko, commits[0].sha1).notes
+    assert notes["index"] == "changed"
+    assert notes["other"] == "value"
+    assert notes["existing"] == "value"
+
+    # Notes that were read are read again after a SyncLock is acquired
+    with sync_commit.NotesSession(git_gecko) as session:
+        assert session.read(commits[2].sha1)["index"] == "2"
+        sync_commit.write_notes(git_gecko, {commits[2].sha1: {"index": "changed"}})
+        assert session.read(commits[2].sha1)["index"] == "2"
+        with SyncLock("upstream", None):
+            assert session.read(commits[2].sha1)["index"] == "changed"
+
+
 @pytest.mark.parametrize("msg,expected",
                          [("Example", {}),
                           ("wpt-pr: 123", {"wpt-pr": "123"}),
@@ -45,3 +213,42 @@ def test_move_utf16(git_gecko, git_wpt_upstream, git_wpt, wpt_worktree, local_ge
                           ("wpt-pr: 123\nwpt-pr: 234", {"wpt-pr": "234"})])
 def test_metadata(msg, expected):
     assert sync_commit.get_metadata(msg) == expected
+
+
+def test_add_tree_change_order():
+    # A file replacing a directory gives the same changes in either order
+    for paths in [["a/b", "a/b/c/d", "a/b/e"], ["a/b/c/d", "a/b/e", "a/b"]]:
+        changes = {}
+        for path in paths:
+            sync_commit.add_tree_change(changes, path, "blob" if path == "a/b" else None)
+        assert changes == {"a": {"b": "blob"}}
+
+    # As does a directory replacing a file
+    for paths in [["a/b", "a/b/c"], ["a/b/c", "a/b"]]:
+        changes = {}
+        for path in paths:
+            sync_commit.add_tree_change(changes, path, None if path == "a/b" else "blob")
+        assert changes == {"a": {"b": {"c": "blob"}}}
+
+
+def test_gitignore(git_gecko):
+    pygit2_repo = repos.pygit2_get(git_gecko)
+    changes = {}
+    for path, data in [(".gitignore", "*.pyc\n/build/\n!keep.pyc\n"),
+                       ("tests/.gitignore", "*.log\n!important.log\nsub/**/gen\n")]:
+        sync_commit.add_tree_change(changes, path, (pygit2_repo.create_blob(data),
+                                                    pygit2.GIT_FILEMODE_BLOB))
+    empty_tree = pygit2_repo[pygit2_repo.TreeBuilder().write()]
+    tree = pygit2_repo[sync_commit.build_tree(pygit2_repo, empty_tree, changes)]
+
+    ignore = sync_commit.GitIgnore(pygit2_repo, tree)
+    for path, expected in [("a.pyc", True),
+                           ("tests/keep.pyc", False),
+                           ("build/a.html", True),
+                           ("tests/build/a.html", False),
+                           ("tests/a.log", True),
+                           ("tests/important.log", False),
+                           ("a.log", False),
+                           ("tests/sub/a/gen", True),
+                           ("tests/a.html", False)]:
+        assert ignore.is_ignored(path) == expected
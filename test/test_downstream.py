@@ -334,3 +334,14 @@ def test_github_label_on_error(env, git_gecko, git_wpt, pull_request):
             sync.update_commits()
 
     assert env.gh_wpt.get_pull(pr["number"])['labels'] == []
+
+
+def test_status_master_commit(env, git_gecko, git_wpt):
+    rev = git_wpt.commit("origin/master").hexsha
+    # A commit that's already on master can't be a PR head, so GitHub isn't asked
+    with patch.object(env.gh_wpt, "pr_for_commit") as pr_for_commit:
+        handlers.handle_status(git_gecko, git_wpt, {"context": "continuous-integration/travis-ci",
+                                                    "sha": rev,
+                                                    "state": "success",
+                                                    "target_url": "http://test/"})
+    assert not pr_for_commit.called
@@ -1,6 +1,10 @@
+import json
+
 import git
 
 from sync import index
+from sync.base import CommitBuilder, DataSnapshot
+from sync.repos import pygit2_get
 
 
 class TestIndex(index.Index):
@@ -108,3 +112,152 @@ def test_build(git_gecko):
     assert idx.get(("key1", "key2")) == set(["some_example_data"])
     assert idx.get(("key1", "key3")) == set()
     assert idx.get(("key1", "key4")) == set(["new_data"])
+
+
+def test_view_refresh(env, git_gecko):
+    idx = TestIndex.create(git_gecko)
+    idx.insert(("key1", "key2"), "some_example_data")
+    idx.save()
+    assert idx.get(("key1",)) == set(["some_example_data"])
+
+    # Change the underlying data without going through the index, as another
+    # process would
+    with CommitBuilder(git_gecko, "Update test index",
+                       ref=env.config["sync"]["ref"]) as commit:
+        commit.add_tree({"index/test/key1/key3": json.dumps(["more_example_data"])})
+        commit.delete(["index/test/key1/key2"])
+
+    assert idx.get(("key1",)) == set(["more_example_data"])
+    assert idx.get(("key1", "key2")) == set()
+    assert idx.keys() == set([("key1", "key3")])
+
+
+class PackedTestIndex(index.Index):
+    name = "test-packed"
+    key_fields = ("test1", "test2", "test3")
+    unique = False
+    storage = "packed"
+
+    def load_value(self, value):
+        return value
+
+    def build_entries(self, entries, errors, *args, **kwargs):
+        return entries, errors
+
+
+def test_packed_data():
+    data = index.PackedIndexData.dumps({"b/c": ["value1"],
+                                        "a": ["value2", "value3"],
+                                        "b": ["value4"],
+                                        "bc": ["value5"],
+                                        "d": []})
+    packed = index.PackedIndexData(data)
+    assert packed.count == 4
+    assert list(packed.keys()) == ["a", "b", "b/c", "bc"]
+    assert packed.get("a") == ["value2", "value3"]
+    assert packed.get("b/c") == ["value1"]
+    assert packed.get("c") is None
+    assert packed.get("d") is None
+    assert list(packed.iter_prefix("b")) == [("b", ["value4"]), ("b/c", ["value1"])]
+    assert len(list(packed.iter_prefix(""))) == 4
+    assert index.PackedIndexData().get("a") is None
+
+
+def test_packed_index(env, git_gecko):
+    idx = PackedTestIndex.create(git_gecko)
+    assert idx.storage_format() == "packed"
+    idx.insert(("key1", "key2", "key3"), "some_example_data")
+    idx.insert(("key1", "key2", "key4"), "more_example_data")
+    idx.insert(("key5", "key2", "key3"), "other_data")
+    idx.save()
+
+    ref = git.Reference(git_gecko, env.config["sync"]["ref"])
+    assert set(item.path for item in ref.commit.tree["index/test-packed"]) == {
+        "index/test-packed/_metadata",
+        "index/test-packed/key1",
+        "index/test-packed/key5"}
+
+    assert idx.get(("key1", "key2", "key3")) == set(["some_example_data"])
+    assert idx.get(("key1",)) == set(["some_example_data", "more_example_data"])
+    assert idx.get(()) == set(["some_example_data", "more_example_data", "other_data"])
+    assert idx.keys() == set([("key1", "key2", "key3"),
+                              ("key1", "key2", "key4"),
+                              ("key5", "key2", "key3")])
+
+    idx.delete(("key5", "key2", "key3"), "other_data")
+    idx.save()
+    assert idx.get(("key5",)) == set()
+    assert "key5" not in ref.commit.tree["index/test-packed"]
+
+
+def test_convert_storage(env, git_gecko):
+    class TreeTestIndex(index.Index):
+        name = "test-packed"
+        key_fields = ("test1", "test2", "test3")
+
+    TreeTestIndex.create(git_gecko)
+    tree_idx = TreeTestIndex(git_gecko)
+    tree_idx.insert(("key1", "key2", "key3"), "some_example_data")
+    tree_idx.insert(("key4", "key5", "key6"), "more_example_data")
+    tree_idx.save()
+    assert tree_idx.storage_format() == "tree"
+
+    idx = PackedTestIndex(git_gecko)
+    assert idx.convert_storage()
+    assert idx.storage_format() == "packed"
+    assert not idx.convert_storage()
+    assert idx.get(("key1", "key2", "key3")) == set(["some_example_data"])
+    assert idx.keys() == set([("key1", "key2", "key3"),
+                              ("key4", "key5", "key6")])
+
+
+def test_convert_storage_taskgroup_keys(env, git_gecko):
+    class TreeTaskGroupIndex(index.TaskGroupIndex):
+        name = "test-taskgroup"
+        storage = "tree"
+
+    class PackedTaskGroupIndex(index.TaskGroupIndex):
+        name = "test-taskgroup"
+
+        def load_value(self, value):
+            return value
+
+    # Taskgroup ids sharing their first characters, so the packed shard for a
+    # prefix replaces a directory containing the tree storage for several keys
+    taskgroup_ids = ["%s%s%02iXyZ-abcdefghij" % (prefix, second, i)
+                     for prefix in ["Ab", "Cd", "eF"]
+                     for second in ["gh", "IJ"]
+                     for i in range(3)]
+
+    TreeTaskGroupIndex.create(git_gecko)
+    tree_idx = TreeTaskGroupIndex(git_gecko)
+    for taskgroup_id in taskgroup_ids:
+        tree_idx.insert(tree_idx.make_key(taskgroup_id), "sync/try/%s" % taskgroup_id)
+    tree_idx.save()
+    assert tree_idx.storage_format() == "tree"
+
+    idx = PackedTaskGroupIndex(git_gecko)
+    assert idx.convert_storage()
+    assert idx.storage_format() == "packed"
+
+    ref = git.Reference(git_gecko, env.config["sync"]["ref"])
+    shards = ref.commit.tree["index/test-taskgroup"]
+    assert {item.name for item in shards} == {"_metadata", "Ab", "Cd", "eF"}
+    assert all(item.type == "blob" for item in shards)
+    for taskgroup_id in taskgroup_ids:
+        assert idx.get(idx.make_key(taskgroup_id)) == {"sync/try/%s" % taskgroup_id}
+
+
+def test_concurrent_writes(env, git_gecko):
+    for idx, key in [(TestIndex.create(git_gecko), ("key1", "key2")),
+                     (PackedTestIndex.create(git_gecko), ("key1", "key2", "key3"))]:
+        # Take a snapshot, then have another writer update the same key before
+        # writing through the now stale snapshot
+        stale = DataSnapshot(pygit2_get(git_gecko))
+        with DataSnapshot(pygit2_get(git_gecko)):
+            idx.insert(key, "other_data")
+            idx.save()
+        with stale:
+            idx.insert(key, "some_data")
+            idx.save()
+        assert idx.get(key) == set(["some_data", "other_data"])
@@ -131,6 +131,41 @@ def test_land_commit(env, git_gecko, git_wpt, git_wpt_upstream, pull_request, se
     assert sync.status == "complete"
 
 
+def test_land_commit_tree(env, git_gecko, git_wpt, git_wpt_upstream, pull_request, set_pr_status,
+                          hg_gecko_try, mock_mach):
+    pr = pull_request([("Test commit", {"README": "example_change",
+                                        "LICENSE": "Changed license"})])
+    head_rev = pr._commits[0]["sha"]
+
+    trypush.Mach = mock_mach
+
+    downstream.new_wpt_pr(git_gecko, git_wpt, pr)
+    set_pr_status(pr, "success")
+
+    git_wpt_upstream.head.commit = head_rev
+    git_wpt.remotes.origin.fetch()
+    landing.wpt_push(git_gecko, git_wpt, [head_rev], create_missing=False)
+
+    tree.is_open = lambda x: True
+    with patch.object(landing.LandingSync, "copy_pr_files",
+                      Mock(side_effect=AssertionError("Fell back to copying files"))):
+        sync = landing.update_landing(git_gecko, git_wpt)
+
+    wpt_path = env.config["gecko"]["path"]["wpt"]
+    gecko_commit = sync.gecko_commits[0]
+    assert gecko_commit.metadata["wpt-pr"] == str(pr.number)
+    assert gecko_commit.files_changed() == {"%s/README" % wpt_path}
+    assert git_gecko.git.show("%s:%s/README" % (gecko_commit.sha1, wpt_path)) == "example_change"
+    assert (git_gecko.git.show("%s:%s/LICENSE" % (gecko_commit.sha1, wpt_path)) ==
+            "Initial license")
+
+    git_work_gecko = sync.gecko_worktree.get()
+    assert git_work_gecko.head.commit.hexsha == sync.gecko_commits.head.sha1
+    assert not git_work_gecko.is_dirty(untracked_files=True)
+    # The wpt worktree is only needed when falling back to copying files
+    assert not os.path.exists(sync.wpt_worktree.path)
+
+
 def test_landable_skipped(env, git_gecko, git_wpt, git_wpt_upstream, pull_request, set_pr_status,
                           mock_mach):
     prev_wpt_head = git_wpt_upstream.head.commit
@@ -530,3 +565,13 @@ def test_accept_failures(landing_with_try_push, mock_tasks):
             with sync.latest_try_push.as_mut(lock):
                 sync.latest_try_push.accept_failures = True
         assert sync.try_result() == landing.TryPushResult.acceptable_failures
+
+
+def test_unlanded_wpt_commits_by_pr_many(git_gecko, git_wpt, synthetic_wpt_history):
+    base, head, expected = synthetic_wpt_history(300)
+
+    # The history is read in-process, without running git
+    with patch("git.cmd.Popen", side_effect=AssertionError("Unexpected git subprocess")):
+        commits_by_pr = landing.unlanded_wpt_commits_by_pr(git_gecko, git_wpt, base, head)
+
+    assert [(pr, [item.sha1 for item in commits]) for pr, commits in commits_by_pr] == expected
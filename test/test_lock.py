@@ -0,0 +1,63 @@
+import json
+import os
+
+import pytest
+
+from sync import lockstats
+from sync.lock import FcntlLock, LockError, RepoLock, SyncLock
+
+
+def test_lock_reentrant(env):
+    with SyncLock("upstream", None) as lock:
+        lock.check("upstream", None)
+        with SyncLock("upstream", None) as inner:
+            assert inner is lock
+        assert lock.lock.is_locked
+    assert not lock.lock.is_locked
+
+
+def test_lock_other_process(env):
+    # A separate open of the lock file behaves like a lock held by another process
+    path = SyncLock.lock_path("downstream", "1")
+    other = FcntlLock(path)
+
+    other.acquire()
+    try:
+        with pytest.raises(LockError):
+            with SyncLock("downstream", "1", blocking=False):
+                pass
+        assert path not in SyncLock.locks
+    finally:
+        other.release()
+
+    with SyncLock("downstream", "1", blocking=False) as lock:
+        assert lock.lock.is_locked
+        with pytest.raises(LockError):
+            other.acquire(blocking=False)
+    assert not other.is_locked
+
+
+def test_lock_stats(env, git_gecko):
+    stats = lockstats.stats
+    stats.reset()
+    stats.start_task("test")
+    with SyncLock("upstream", None):
+        with RepoLock(git_gecko):
+            pass
+    totals = stats.end_task()
+    assert totals["wait"] >= 0
+    assert totals["hold"] > 0
+
+    repo_name = "repo/%s" % os.path.basename(git_gecko.working_dir)
+    keys = {(name, task) for (_, name, task) in stats.stats.iterkeys()}
+    assert keys == {("sync/upstream", "test"), (repo_name, "test")}
+    for timings in stats.stats.itervalues():
+        assert timings["wait"].count == 1
+        assert timings["hold"].count == 1
+
+    stats.flush()
+    assert not stats.stats
+    path = os.path.join(env.config["root"], env.config["paths"]["logs"], "lock-stats.json")
+    with open(path) as f:
+        summary = json.loads(f.readlines()[-1])
+    assert {item["name"] for item in summary["locks"]} == {"sync/upstream", repo_name}
@@ -1,8 +1,14 @@
+import os
+import time
+
 import git
 import pytest
-from sync import index, upstream
+from mock import patch
+from sync import base, gitutils, index, upstream
 from sync.gitutils import update_repositories
-from sync.lock import SyncLock
+from sync.lock import RepoLock, SyncLock
+from sync.repos import pygit2_get
+from sync.worktree import Worktree, WorktreePool, worktree_for_path
 
 
 def test_delete(env, git_gecko, git_wpt, upstream_gecko_commit):
@@ -47,3 +53,221 @@ def test_delete(env, git_gecko, git_wpt, upstream_gecko_commit):
 
     ref = git.Reference(git_wpt, "refs/heads/%s" % sync_path)
     assert not ref.is_valid()
+
+
+def test_load_many(env, git_gecko, git_wpt, upstream_gecko_commit):
+    bug = "1234"
+    test_changes = {"README": "Change README\n"}
+    rev = upstream_gecko_commit(test_changes=test_changes, bug=bug,
+                                message="Change README")
+    update_repositories(git_gecko, git_wpt, wait_gecko_commit=rev)
+    upstream.gecko_push(git_gecko, git_wpt, "autoland", rev, raise_on_error=True)
+
+    process_names = list(base.ProcessNameIndex(git_gecko).get("sync", "upstream"))
+    assert len(process_names) == 1
+
+    # Drop the objects created above so that they are loaded from the data
+    base.IdentityMap._cache.clear()
+
+    syncs = upstream.UpstreamSync.load_many(git_gecko, git_wpt, process_names)
+    assert [sync.process_name for sync in syncs] == process_names
+    sync = syncs[0]
+    # Nothing apart from the raw data blob has been loaded yet
+    assert sync._gecko_commits is None
+    assert sync._gecko_worktree is None
+    assert sync.data._loaded_data is None
+    assert sync.data._raw_data is not None
+    assert sync.bug == bug
+    assert sync.data._raw_data is None
+    assert sync._gecko_commits is None
+
+
+def test_sparse_worktree(env, git_gecko, git_wpt, upstream_gecko_commit):
+    bug = "1234"
+    rev = upstream_gecko_commit(test_changes={"README": "Change README\n"}, bug=bug,
+                                message="Change README")
+    update_repositories(git_gecko, git_wpt, wait_gecko_commit=rev)
+    upstream.gecko_push(git_gecko, git_wpt, "autoland", rev, raise_on_error=True)
+    sync = upstream.UpstreamSync.for_bug(git_gecko, git_wpt, bug, flat=True).pop()
+
+    env.config["gecko"]["worktree"]["sparse"] = "/testing/web-platform/"
+    try:
+        worktree = Worktree(git_gecko, sync.process_name)
+        with SyncLock.for_process(sync.process_name) as lock:
+            with worktree.as_mut(lock):
+                worktree.delete()
+                git_work = worktree.get()
+                assert worktree.sparse_paths == ["/testing/web-platform/"]
+                assert git_work.active_branch.name == str(sync.process_name)
+                assert os.path.exists(os.path.join(git_work.working_dir,
+                                                   env.config["gecko"]["path"]["wpt"],
+                                                   "README"))
+                assert not os.path.exists(os.path.join(git_work.working_dir, "README"))
+                assert not git_work.is_dirty(untracked_files=True)
+                # Sparse checkout is only enabled for the worktree
+                assert git_work.git.config("core.sparseCheckout") == "true"
+                assert not git_gecko.config_reader("repository").has_option("core",
+                                                                            "sparseCheckout")
+
+                worktree.get(full=True)
+                assert worktree.sparse_paths is None
+                assert os.path.exists(os.path.join(git_work.working_dir, "README"))
+                assert not git_work.is_dirty(untracked_files=True)
+    finally:
+        del env.config["gecko"]["worktree"]["sparse"]
+
+
+def test_worktree_checkout_failure(env, git_gecko, git_wpt, upstream_gecko_commit):
+    bug = "1234"
+    rev = upstream_gecko_commit(test_changes={"README": "Change README\n"}, bug=bug,
+                                message="Change README")
+    update_repositories(git_gecko, git_wpt, wait_gecko_commit=rev)
+    upstream.gecko_push(git_gecko, git_wpt, "autoland", rev, raise_on_error=True)
+    sync = upstream.UpstreamSync.for_bug(git_gecko, git_wpt, bug, flat=True).pop()
+
+    worktree = Worktree(git_gecko, sync.process_name)
+    with SyncLock.for_process(sync.process_name) as lock:
+        with worktree.as_mut(lock):
+            worktree.delete()
+            with patch.object(git.cmd.Git, "read_tree", create=True,
+                              side_effect=git.GitCommandError("read-tree", 1)):
+                with pytest.raises(git.GitCommandError):
+                    worktree.get()
+            # The partially created worktree isn't left behind to be reused
+            assert not os.path.exists(worktree.path)
+            assert worktree_for_path(pygit2_get(git_gecko), worktree.path) is None
+
+            git_work = worktree.get()
+            assert git_work.active_branch.name == str(sync.process_name)
+            assert not git_work.is_dirty(untracked_files=True)
+
+
+def test_worktree_pool(env, git_gecko, git_wpt, upstream_gecko_commit):
+    bug = "1234"
+    rev = upstream_gecko_commit(test_changes={"README": "Change README\n"}, bug=bug,
+                                message="Change README")
+    update_repositories(git_gecko, git_wpt, wait_gecko_commit=rev)
+    upstream.gecko_push(git_gecko, git_wpt, "autoland", rev, raise_on_error=True)
+    sync = upstream.UpstreamSync.for_bug(git_gecko, git_wpt, bug, flat=True).pop()
+
+    worktree_config = env.config["gecko"]["worktree"]
+    worktree_config["pool-size"] = 1
+    worktree_config["pool-ref"] = env.config["gecko"]["refs"]["central"]
+    try:
+        pool = WorktreePool(git_gecko)
+        pool.fill()
+        idle = pool.idle()
+        assert len(idle) == 1
+        assert os.path.basename(idle[0].path) == "pool-0"
+        assert os.listdir(pool.staging) == []
+
+        worktree = Worktree(git_gecko, sync.process_name)
+        with SyncLock.for_process(sync.process_name) as lock:
+            with worktree.as_mut(lock):
+                # The pool is already full so this removes the sync's worktree
+                worktree.delete()
+                assert len(pool.idle()) == 1
+
+                git_work = worktree.get()
+                assert len(pool.idle()) == 0
+                assert git_work.active_branch.name == str(sync.process_name)
+                assert git_work.head.commit.hexsha == git_gecko.commit(
+                    str(sync.process_name)).hexsha
+                assert not git_work.is_dirty(untracked_files=True)
+                assert git_gecko.git.worktree("list").count(worktree.path) == 1
+
+                # Deleting the worktree returns it to the pool
+                with open(os.path.join(git_work.working_dir, "untracked"), "w") as f:
+                    f.write("Untracked file\n")
+                worktree.delete()
+                assert not os.path.exists(worktree.path)
+                idle = pool.idle()
+                assert len(idle) == 1
+                pool_work = git.Repo(idle[0].path)
+                assert pool_work.head.commit.hexsha == git_gecko.commit(pool.ref).hexsha
+                assert not pool_work.is_dirty(untracked_files=True)
+
+        # Worktrees left in staging are removed once they're older than the timeout
+        staged = pool._move(pool.idle()[0], os.path.join(pool.staging, "pool-0"))
+        pool.reap_staging()
+        assert os.path.exists(staged.path)
+        old = time.time() - pool.staging_timeout.total_seconds() - 60
+        os.utime(staged.path, (old, old))
+        pool.reap_staging()
+        assert os.listdir(pool.staging) == []
+        assert worktree_for_path(pygit2_get(git_gecko), staged.path) is None
+    finally:
+        del worktree_config["pool-size"]
+        del worktree_config["pool-ref"]
+
+
+def test_fetch_freshness(env, git_gecko, git_wpt):
+    env.config["fetch"]["freshness"] = 3600
+    try:
+        with RepoLock(git_wpt):
+            assert gitutils.fetch(git_wpt, "origin")
+            with patch.object(git_wpt.git, "fetch", create=True) as fetch:
+                assert not gitutils.fetch(git_wpt, "origin")
+                assert not fetch.called
+                assert gitutils.fetch(git_wpt, "origin", force=True)
+                assert fetch.called
+
+        # Fetches for an event ignore the freshness window if the commit isn't present
+        with patch.object(git_wpt.git, "fetch", create=True) as fetch:
+            gitutils.update_repositories(None, git_wpt, wpt_commit=git_wpt.head.commit.hexsha)
+            assert not fetch.called
+            gitutils.update_repositories(None, git_wpt, wpt_commit="0" * 40)
+            assert fetch.called
+    finally:
+        env.config["fetch"]["freshness"] = 0
+
+
+def test_update_repositories_errors(env, git_gecko, git_wpt):
+    def fail_gecko(*args, **kwargs):
+        raise ValueError("gecko")
+
+    def fail_wpt(*args, **kwargs):
+        raise ValueError("wpt")
+
+    with patch.object(gitutils, "_update_gecko", fail_gecko), \
+            patch.object(gitutils, "_update_wpt", fail_wpt), \
+            patch.object(gitutils.logger, "error") as log_error:
+        with pytest.raises(ValueError) as excinfo:
+            update_repositories(git_gecko, git_wpt)
+
+    # The error is raised with the traceback from the fetch, and the other error is logged
+    assert excinfo.traceback[-1].name == "fail_%s" % excinfo.value
+    other = "wpt" if str(excinfo.value) == "gecko" else "gecko"
+    assert log_error.call_count == 1
+    assert "ValueError: %s" % other in log_error.call_args[0][0]
+
+
+def test_update_wpt_prs(env, git_gecko, git_wpt, pull_request):
+    pr_1 = pull_request([("Test commit", {"README": "Example change 1\n"})], "PR 1")
+    pr_2 = pull_request([("Test commit", {"README": "Example change 2\n"})], "PR 2")
+
+    gitutils.update_wpt_prs(git_wpt, [pr_1.number])
+    pr_refs = gitutils.refs(git_wpt, "refs/remotes/origin/pr/").values()
+    assert "refs/remotes/origin/pr/%s" % pr_1.number in pr_refs
+    assert "refs/remotes/origin/pr/%s" % pr_2.number not in pr_refs
+    assert gitutils.pr_for_commit(git_wpt, pr_1.head) == pr_1.number
+
+
+def test_pr_ref_map(env, git_gecko, git_wpt, pull_request, pull_request_commit):
+    pr = pull_request([("Test commit", {"README": "Example change 1\n"})], "PR 1")
+    git_wpt.remotes.origin.fetch()
+    old_head = git_wpt.commit("origin/pr/%s" % pr.number).hexsha
+    assert gitutils.pr_for_commit(git_wpt, old_head) == pr.number
+
+    new_head = pull_request_commit(pr.number, [("Second commit", {"README": "Change 2\n"})])
+    pr_map = gitutils.PrRefMap.for_repo(git_wpt)
+    with patch.object(pr_map, "_build") as build:
+        gitutils.update_wpt_prs(git_wpt, [pr.number])
+        assert gitutils.pr_for_commit(git_wpt, new_head) == pr.number
+        assert gitutils.pr_for_commit(git_wpt, old_head) is None
+    assert not build.called
+
+    # A new instance reads the map from the cache file
+    with patch.object(gitutils.PrRefMap, "_build") as build:
+        assert gitutils.PrRefMap(git_wpt).get(new_head) == pr.number
+    assert not build.called
@@ -1,6 +1,9 @@
+from mock import patch
+
 from sync import commit as sync_commit, upstream
 from sync.gitutils import update_repositories
 from sync.lock import SyncLock
+from sync.sync import CommitFilter, CommitRange
 from conftest import git_commit
 
 
@@ -566,3 +569,43 @@ def test_pr_commits_fast_forward(env, git_wpt, git_gecko, git_wpt_upstream,
 
     for wpt_commit, pr_commit in zip(sync.wpt_commits._commits, pr_commits):
         assert wpt_commit.commit == pr_commit.commit
+
+
+def test_gecko_commits_cached(git_gecko, git_wpt, upstream_gecko_commit):
+    bug = "1234"
+    revs = [upstream_gecko_commit(test_changes={"README": "Change README %i\n" % i}, bug=bug,
+                                  message="Change README %i" % i)
+            for i in range(2)]
+    # A commit for the same bug that doesn't change wpt
+    upstream_gecko_commit(other_changes={"example": "Other change\n"}, bug=bug,
+                          message="Change non-wpt file")
+    revs.append(upstream_gecko_commit(test_changes={"README": "Change README 2\n"}, bug=bug,
+                                      message="Change README 2"))
+
+    update_repositories(git_gecko, git_wpt, wait_gecko_commit=revs[-1])
+    upstream.gecko_push(git_gecko, git_wpt, "autoland", revs[-1], raise_on_error=True)
+    sync = upstream.UpstreamSync.for_bug(git_gecko, git_wpt, bug, flat=True).pop()
+    git_revs = [git_gecko.cinnabar.hg2git(rev) for rev in revs]
+    assert [item.sha1 for item in sync.gecko_commits] == git_revs
+
+    commits = sync.gecko_commits
+    # Iterating stops reading commits when the caller stops; each commit read from
+    # the walker is checked against the path filter
+    with patch.object(sync_commit, "changes_paths",
+                      wraps=sync_commit.changes_paths) as changes_paths:
+        assert next(commits.iter_commits()).sha1 == git_revs[0]
+    assert changes_paths.call_count == 1
+
+    # Another range with the same base, head and filter uses the cached result
+    new_range = CommitRange(git_gecko, commits._base, commits._head_ref,
+                            sync_commit.GeckoCommit, upstream.BackoutCommitFilter(bug))
+    with patch.object(CommitRange, "iter_commits") as iter_commits:
+        assert [item.sha1 for item in new_range] == git_revs
+    assert not iter_commits.called
+
+    # Filters that don't opt in to caching always read the range
+    new_range = CommitRange(git_gecko, commits._base, commits._head_ref,
+                            sync_commit.GeckoCommit, CommitFilter())
+    with patch.object(CommitRange, "iter_commits", return_value=iter([])) as iter_commits:
+        assert list(new_range) == []
+    assert iter_commits.called